@@ -146,10 +146,165 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Ensure this path points to the directory containing your GeoLite2-City.mmdb file.
 # Example: if GeoLite2-City.mmdb is in 'your_project_name/geoip/'
 GEOIP_PATH = os.path.join(BASE_DIR, 'geoip', 'GeoLite2-City.mmdb')
+# Optional: GeoLite2-ASN.mmdb in the same directory adds the AS number and
+# organization to every log row. Looked up and cached together with the city.
+GEOIP_ASN_PATH = os.path.join(BASE_DIR, 'geoip', 'GeoLite2-ASN.mmdb')
+# detect_anomalies flags the heavier IPs of any ASN above this many requests/hour.
+IP_TRACKING_ASN_THRESHOLD = 1000
 
 # Optional: Configure the default cache for django-ratelimit (it uses 'default' by default)
 # RATELIMIT_DEFAULT_CACHE = 'default'
 
+# --- Client IP Resolution ---
+# X-Forwarded-For is only trusted on requests from these networks (the load
+# balancer / reverse proxies); add their ranges here. The client is the
+# right-most forwarded address outside them.
+IP_TRACKING_TRUSTED_PROXIES = [
+    '127.0.0.1/32',
+    '::1/128',
+]
+# Clients are aggregated into networks of these prefix lengths for rate limits,
+# anomaly rules, geo caching, counting and RequestLog.client_network. An IPv6
+# host usually controls a whole /64, so per-address keys are easy to evade.
+IP_TRACKING_IPV4_PREFIX_LENGTH = 32
+IP_TRACKING_IPV6_PREFIX_LENGTH = 64
+# Make django-ratelimit's key='ip' use the same resolved address and networks.
+RATELIMIT_IP_META_KEY = 'tracking_ip.client.client_ip'
+RATELIMIT_IPV4_MASK = IP_TRACKING_IPV4_PREFIX_LENGTH
+RATELIMIT_IPV6_MASK = IP_TRACKING_IPV6_PREFIX_LENGTH
+
+# --- Request Logging Exclusions and Sampling ---
+# Blocklist checks always run; these only control which requests get a RequestLog row.
+# Path patterns are regexes matched against the start of request.path.
+IP_TRACKING_EXCLUDE_PATHS = [
+    r'/static/',         # Static files, including the admin's own assets
+    r'/favicon\.ico$',
+    r'/health/?$',       # Load balancer health checks
+    r'/admin/jsi18n/',
+    r'/metrics$',        # Prometheus scrapes
+]
+IP_TRACKING_EXCLUDE_METHODS = ['HEAD', 'OPTIONS']
+# Ordered (pattern, rate) pairs; the first match wins. Rates are rounded to 1/n.
+IP_TRACKING_SAMPLE_RATES = [
+    # (r'/api/', 0.1), # Example: log 1 in 10 API requests
+]
+IP_TRACKING_DEFAULT_SAMPLE_RATE = 1.0
+# Lower the logging rate while log writes are slow or backing up.
+IP_TRACKING_ADAPTIVE_SAMPLING = {
+    'ENABLED': True,
+    'LATENCY_THRESHOLD_MS': 50, # EWMA of RequestLog insert latency
+    'BACKLOG_THRESHOLD': 8,     # Concurrent in-flight log writes per process
+    'MIN_FACTOR': 0.01,         # Never sample below 1% of the configured rate
+}
+
+# --- Path Categories ---
+# Every RequestLog row is tagged with the id of the category whose prefix its path
+# matches (longest prefix wins, 0 for none); rules and stats filter on the id.
+# Ids are stored, so never reuse one for a different category. Changing prefixes
+# only affects rows logged afterwards.
+IP_TRACKING_PATH_CATEGORIES = {
+    1: ('admin', ['/admin/']),
+    2: ('login', ['/login/']),
+    3: ('sensitive_api', ['/api/v1/sensitive_data/']),
+    4: ('api', ['/api/']),
+    5: ('static', ['/static/', '/favicon.ico']),
+}
+# Categories watched by detect_anomalies' sensitive path rule.
+IP_TRACKING_SENSITIVE_CATEGORIES = ['admin', 'login', 'sensitive_api']
+
+# --- Tracking Metrics ---
+# Directory shared by all worker processes (gunicorn workers, Celery) so that
+# /metrics reports totals across processes. Leave unset for per-process metrics.
+IP_TRACKING_METRICS_DIR = os.environ.get('IP_TRACKING_METRICS_DIR')
+
+# --- Logging Database ---
+# Set IP_TRACKING_LOG_DB to keep the tracking_ip tables in their own SQLite file,
+# so log inserts do not contend with auth, session and admin writes for the
+# single write lock. Create its tables with: python manage.py migrate --database=tracking
+if os.environ.get('IP_TRACKING_LOG_DB'):
+    DATABASES['tracking'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, os.environ['IP_TRACKING_LOG_DB']),
+    }
+IP_TRACKING_DATABASE = 'tracking' if 'tracking' in DATABASES else 'default'
+# Applied to every new SQLite connection to IP_TRACKING_DATABASE, if it is a
+# dedicated database. A shared 'default' database is left alone unless
+# IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT is True.
+IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT = False
+IP_TRACKING_SQLITE_PRAGMAS = {
+    'page_size': 8192,          # Only takes effect on a new, empty database file
+    'journal_mode': 'WAL',      # Readers and the writer no longer block each other
+    'synchronous': 'NORMAL',    # fsync at checkpoints only; a power loss can drop the last commits
+    'busy_timeout': 5000,       # ms to wait for the write lock before "database is locked"
+    'wal_autocheckpoint': 1000, # Pages; bounds the size of the WAL file
+}
+
+# --- Log Sink ---
+# 'database' writes a RequestLog row per logged request. 'segments' appends it to
+# local, append-only segment files instead, for nodes that cannot rely on reaching
+# the database; load them with `python manage.py load_segments` (e.g. from cron).
+IP_TRACKING_LOG_SINK = os.environ.get('IP_TRACKING_LOG_SINK', 'database')
+IP_TRACKING_SEGMENTS = {
+    'DIRECTORY': os.path.join(BASE_DIR, 'segments'),
+    'SEGMENT_BYTES': 64 * 1024 * 1024, # Close a segment at this size...
+    'MAX_AGE': 300,                    # ...or after this many seconds
+    'FSYNC_INTERVAL': 1.0,             # Group commit; a crash loses at most this many seconds
+}
+
+# --- Read Replica ---
+# Stats, admin changelists and anomaly scans may read from a replica of
+# IP_TRACKING_DATABASE; writes and the blocklist always use the primary. To try
+# it locally with two SQLite files: copy the tracking database (db.sqlite3 by
+# default) to replica.sqlite3 and set IP_TRACKING_REPLICA_DB.
+if os.environ.get('IP_TRACKING_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, os.environ['IP_TRACKING_REPLICA_DB']),
+        'TEST': {'MIRROR': IP_TRACKING_DATABASE},
+    }
+DATABASE_ROUTERS = [
+    'tracking_ip.routers.TrackingReplicaRouter',
+    'tracking_ip.routers.TrackingDatabaseRouter',
+]
+IP_TRACKING_READ_REPLICA = 'replica' if 'replica' in DATABASES else None
+# Assumed replication lag in seconds when it cannot be measured (non-PostgreSQL).
+IP_TRACKING_REPLICA_LAG_SECONDS = float(os.environ.get('IP_TRACKING_REPLICA_LAG_SECONDS', 5))
+
+# --- Unique Visitors ---
+# HyperLogLog sketches of distinct client IPs per hour, country and path prefix,
+# kept in Redis and rolled up into days and weeks. Counted before sampling, so
+# their 0.81% standard error does not grow with IP_TRACKING_SAMPLE_RATES.
+# Needs CACHE_ALIAS to be a django-redis cache; otherwise counting is disabled.
+IP_TRACKING_UNIQUE_VISITORS = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    'PATH_DEPTH': 1,  # '/api/v1/items/' is counted under '/api/'
+}
+
+# --- Heavy Hitters ---
+# Per-worker Space-Saving top-K of client IPs, /24 (/48) subnets and paths,
+# merged into per-minute Redis sorted sets. Read with /api/top/ or
+# `python manage.py top_talkers`; neither touches the database.
+IP_TRACKING_HEAVY_HITTERS = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default', # Must be a django-redis cache
+    'CAPACITY': 1000,         # Counters per dimension, per worker and per minute in Redis
+    'FLUSH_INTERVAL': 10,     # Seconds between merges into Redis
+    'WINDOW': 300,            # Seconds of history kept and queried by default
+}
+
+# --- Geolocation Cache Warming ---
+# After a cache flush or Redis restart, the busiest client networks of the last
+# HOURS are geolocated and loaded in batches, at most RATE keys/s. Runs when Celery
+# workers start and every minute if the cache is found empty; deploy scripts
+# without Celery can run `python manage.py warm_geo_cache --if-cold` instead.
+IP_TRACKING_GEO_CACHE_WARMING = {
+    'LIMIT': 10000,     # Client networks to load
+    'HOURS': 24,        # Of RequestLog history to rank them by
+    'BATCH_SIZE': 500,  # Keys per set_many (one Redis pipeline)
+    'RATE': 5000,       # Keys per second; 0 for no limit
+}
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0' # Use database 0 for Celery broker
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0' # Same for results (optional)
@@ -166,4 +321,16 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': 3600.0, # Run every 3600 seconds (1 hour)
         # 'schedule': timedelta(minutes=1), # For testing, run every minute
     },
+    'rollup-unique-visitors-hourly': {
+        'task': 'tracking_ip.tasks.rollup_unique_visitors',
+        'schedule': 3600.0,
+    },
+    'rollup-latency': {
+        'task': 'tracking_ip.tasks.rollup_latency',
+        'schedule': 300.0, # Latency stats lag by at most this much
+    },
+    'warm-geo-cache-if-cold': {
+        'task': 'tracking_ip.tasks.warm_geo_cache_if_cold',
+        'schedule': 60.0, # Only does work after the cache was flushed
+    },
 }
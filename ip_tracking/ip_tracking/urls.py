@@ -25,4 +25,9 @@ urlpatterns = [
     path('', views.home_view, name='home_view'),
     path('api/test/', views.api_test, name='api_test'),
     path('api/stats/', views.geolocation_stats, name='geolocation_stats'),
+    path('api/stats/uniques/', views.unique_visitors, name='unique_visitors'),
+    path('api/stats/latency/', views.latency_stats, name='latency_stats'),
+    path('api/top/', views.top_talkers, name='top_talkers'),
+    path('api/logs/', views.request_logs, name='request_logs'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
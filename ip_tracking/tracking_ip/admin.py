@@ -1,20 +1,256 @@
+from abc import ABC, abstractmethod
 from django.contrib import admin
-from .models import RequestLog, BlockedIP, SuspiciousIP
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.db import models
+from .models import (
+    RequestLog, BlockedIP, SuspiciousIP, DetectionEvent, DetectionRule, GeoLocation, RequestPath,
+)
+from .categories import get_categorizer
+from .pagination import EstimatedCountPaginator, keyset_page
+from .routers import replica_reads
+import ipaddress
+
+CURSOR_VAR = 'cursor'
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList that pages with an opaque (timestamp, id) cursor ("Show
+    more") instead of OFFSET, so deep pages cost the same as the first.
+    """
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = request.GET.get(CURSOR_VAR) or None
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Changing filters, search or ordering starts again from the top.
+        if not new_params or CURSOR_VAR not in new_params:
+            remove = list(remove or []) + [CURSOR_VAR]
+        return super().get_query_string(new_params, remove)
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        try:
+            rows, self.next_cursor = keyset_page(
+                self.queryset, self.model_admin.keyset_field,
+                cursor=self.cursor, size=self.list_per_page)
+        except ValueError:
+            self.cursor = None
+            rows, self.next_cursor = keyset_page(
+                self.queryset, self.model_admin.keyset_field, size=self.list_per_page)
+        self.result_list = rows
+        self.result_count = paginator.count
+        self.result_count_is_estimate = paginator.is_estimate
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = self.next_cursor is not None or self.cursor is not None
+        self.paginator = paginator
+        self.first_page_url = self.get_query_string(remove=[CURSOR_VAR])
+        self.next_page_url = self.get_query_string({CURSOR_VAR: self.next_cursor}) \
+            if self.next_cursor else None
+
+
+class KeysetAdminMixin:
+    """
+    Changelist settings for tables too large to count or page by OFFSET.
+    Ordering is pinned to `keyset_field` (newest first) so the cursor
+    stays valid; column sorting is disabled for the same reason.
+    """
+    keyset_field = None
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    sortable_by = ()
+
+    # Browsing may lag the primary by a few seconds; change forms and
+    # actions (POST) still read from the primary.
+    replica_max_lag = 10
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with replica_reads(max_lag=self.replica_max_lag):
+            response = super().changelist_view(request, extra_context)
+            # Render here so lazy querysets in the template use the replica too.
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
+class CachedFacetFilter(admin.SimpleListFilter, ABC):
+    """
+    List filter whose choices come from a small dictionary table and are
+    cached, instead of a SELECT DISTINCT over the filtered table.
+    """
+    cache_timeout = 600
+
+    @abstractmethod
+    def facet_values(self, request):
+        """
+        The filter's choices, read from the dictionary table.
+        """
+
+    def cache_key(self, request):
+        return f'tracking_ip:admin:facets:{self.parameter_name}'
+
+    def lookups(self, request, model_admin):
+        key = self.cache_key(request)
+        values = cache.get(key)
+        if values is None:
+            values = list(self.facet_values(request))
+            cache.set(key, values, self.cache_timeout)
+        return [(value, value) for value in values]
+
+
+class CountryFilter(CachedFacetFilter):
+    title = 'country'
+    parameter_name = 'country'
+
+    def facet_values(self, request):
+        return GeoLocation.objects.exclude(country=None).order_by(
+            'country').values_list('country', flat=True).distinct()
+
+    def queryset(self, request, queryset):
+        if self.value():
+            # Resolved against the geo dictionary, then matched on the geo_id index.
+            return queryset.filter(geo__in=GeoLocation.objects.filter(country=self.value()))
+        return queryset
+
+
+class CityFilter(CachedFacetFilter):
+    """
+    Cities are only offered once a country is chosen; the full city list
+    is far too long to be a useful facet.
+    """
+    title = 'city'
+    parameter_name = 'city'
+
+    def cache_key(self, request):
+        return f"{super().cache_key(request)}:{request.GET.get('country', '')}"
+
+    def facet_values(self, request):
+        country = request.GET.get('country')
+        if not country:
+            return []
+        return GeoLocation.objects.filter(country=country).exclude(city=None).order_by(
+            'city').values_list('city', flat=True).distinct()
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(geo__in=GeoLocation.objects.filter(city=self.value()))
+        return queryset
+
+
+class CategoryFilter(admin.SimpleListFilter):
+    title = 'path category'
+    parameter_name = 'category'
+
+    def lookups(self, request, model_admin):
+        return sorted(get_categorizer().names.items())
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(category=self.value())
+        return queryset
+
 
 @admin.register(RequestLog)
-class RequestLogAdmin(admin.ModelAdmin):
-    list_display = ('timestamp', 'ip_address', 'path', 'country', 'city')
-    list_filter = ('country', 'city')
-    search_fields = ('ip_address', 'path', 'country', 'city')
+class RequestLogAdmin(KeysetAdminMixin, admin.ModelAdmin):
+    list_display = ('timestamp', 'ip_address', 'method', 'path', 'status', 'duration_us',
+                    'country', 'city', 'autonomous_system')
+    list_filter = (CategoryFilter, CountryFilter, CityFilter)
+    list_select_related = ('path_ref', 'geo', 'autonomous_system')
+    search_fields = ('path_ref__path', 'geo__country', 'geo__city')
+    search_help_text = (
+        "Search by exact IP address, client network (e.g. '2001:db8::/64'), path prefix "
+        "(starting with '/'), AS number (e.g. 'AS13335'), or exact country or city name."
+    )
     readonly_fields = ('timestamp',) # Logs should not be editable
+    keyset_field = 'timestamp'
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Indexed search modes instead of '%term%' scans over the log table:
+        exact IP, anchored path prefix, AS number, or exact geo name. Paths and geo
+        names are resolved against their small dictionary tables first.
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        try:
+            ipaddress.ip_address(term)
+        except ValueError:
+            pass
+        else:
+            # IPs are stored as binary, so they are matched exactly.
+            return queryset.filter(ip_address=term), False
+        if '/' in term:
+            try:
+                network = ipaddress.ip_network(term, strict=False)
+            except ValueError:
+                pass
+            else:
+                # A client network, e.g. '2001:db8:1:2::/64'
+                return queryset.filter(client_network=str(network.network_address)), False
+        if term[:2].upper() == 'AS' and term[2:].isdigit():
+            return queryset.filter(autonomous_system=int(term[2:])), False
+        if term.startswith('/'):
+            return queryset.filter(
+                path_ref__in=RequestPath.objects.filter(path__startswith=term)
+            ), False
+        return queryset.filter(geo__in=GeoLocation.objects.filter(
+            models.Q(country__iexact=term) | models.Q(city__iexact=term)
+        )), False
 
 @admin.register(BlockedIP)
 class BlockedIPAdmin(admin.ModelAdmin):
     list_display = ('ip_address', 'created_at')
     search_fields = ('ip_address',)
 
+
+class RuleFilter(admin.SimpleListFilter):
+    """
+    IPs that any detection event of the chosen rule fired for.
+    """
+    title = 'rule'
+    parameter_name = 'rule'
+
+    def lookups(self, request, model_admin):
+        return DetectionRule.choices
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(ip_address__in=DetectionEvent.objects.filter(
+                rule=self.value()).values('ip_address'))
+        return queryset
+
+
 @admin.register(SuspiciousIP)
-class SuspiciousIPAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'reason', 'flagged_at')
-    list_filter = ('reason',)
-    search_fields = ('ip_address', 'reason')
+class SuspiciousIPAdmin(KeysetAdminMixin, admin.ModelAdmin):
+    list_display = ('ip_address', 'score', 'max_severity', 'event_count', 'last_rule', 'last_seen')
+    list_filter = ('max_severity', RuleFilter, 'last_seen')
+    search_fields = ('=ip_address',)
+    search_help_text = "Search by exact IP address."
+    readonly_fields = ('flagged_at',)
+    keyset_field = 'last_seen'
+
+
+@admin.register(DetectionEvent)
+class DetectionEventAdmin(KeysetAdminMixin, admin.ModelAdmin):
+    list_display = ('detected_at', 'ip_address', 'rule', 'target', 'observed_count', 'severity')
+    list_filter = ('rule', 'severity')
+    search_fields = ('=ip_address',)
+    search_help_text = "Search by exact IP address."
+    readonly_fields = ('detected_at',)
+    keyset_field = 'detected_at'
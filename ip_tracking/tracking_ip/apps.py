@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class TrackingIpConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tracking_ip'
+
+    def ready(self):
+        from .database import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='tracking_ip.configure_connection')
@@ -0,0 +1,385 @@
+"""
+Helpers for benchmarking the tracking middleware offline: synthetic traffic
+distributions, a minimal MaxMind DB writer for temporary GeoIP2 databases,
+and a runner that times each middleware stage.
+"""
+from django.http import HttpResponse
+from django.test import RequestFactory
+from tracking_ip import middleware as tracking_middleware
+from tracking_ip.middleware import BasicIPLoggingMiddleware
+from tracking_ip.models import AutonomousSystem, GeoLocation, RequestPath
+import ipaddress
+import itertools
+import logging
+import random
+import struct
+import time
+
+
+STAGES = {
+    'ip_extraction': 'get_ip_address',
+    'block_check': 'is_blocked',
+    'geo_lookup': 'geolocate',
+    'log_write': 'write_log',
+}
+
+GEO_LOCATIONS = [
+    ('United States', 'Mountain View'),
+    ('Germany', 'Berlin'),
+    ('Japan', 'Tokyo'),
+    ('Brazil', 'São Paulo'),
+    ('Australia', 'Sydney'),
+    ('Canada', 'Toronto'),
+]
+
+AUTONOMOUS_SYSTEMS = [
+    (15169, 'GOOGLE'),
+    (3320, 'Deutsche Telekom AG'),
+    (2516, 'KDDI CORPORATION'),
+    (16509, 'AMAZON-02'),
+]
+
+
+# --- Synthetic traffic ---
+
+def geo_networks(count=16):
+    """
+    IPv4 /16 networks that the benchmark GeoIP2 database knows about.
+    """
+    return [ipaddress.ip_network(f'{11 + i}.{i}.0.0/16') for i in range(count)]
+
+
+def ip_pool(size, geo_hit_rate, rng, networks=None):
+    """
+    Build `size` distinct client IPs; `geo_hit_rate` of them fall inside the
+    networks of the benchmark GeoIP2 database, the rest in 100.0.0.0/8.
+    """
+    networks = networks or geo_networks()
+    pool = set()
+    while len(pool) < size:
+        if rng.random() < geo_hit_rate:
+            network = rng.choice(networks)
+            host = rng.randrange(1, network.num_addresses - 1)
+            pool.add(str(network.network_address + host))
+        else:
+            pool.add(f'100.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}')
+    return sorted(pool)
+
+
+def uniform_ips(pool, count, rng):
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def zipf_ips(pool, count, rng, s=1.1):
+    """
+    Few heavy hitters, long tail: IP of rank k is drawn with weight 1/k^s.
+    """
+    weights = list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, len(pool) + 1)))
+    return rng.choices(pool, cum_weights=weights, k=count)
+
+
+def rotating_subnet_ips(count, rng, rotate_every=50, ipv6=False):
+    """
+    An attacker hopping to a fresh /24 (or IPv6 /64) every `rotate_every`
+    requests, with a random host address on each request.
+    """
+    ips = []
+    for start in range(0, count, rotate_every):
+        if ipv6:
+            prefix = ipaddress.IPv6Address(f'2001:db8:{rng.randrange(65536):x}:{rng.randrange(65536):x}::')
+            batch = [str(prefix + rng.randrange(1, 2 ** 64)) for _ in range(rotate_every)]
+        else:
+            base = f'{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}'
+            batch = [f'{base}.{rng.randrange(1, 255)}' for _ in range(rotate_every)]
+        ips.extend(batch)
+    return ips[:count]
+
+
+def blocked_ips(count):
+    """
+    Blocklist entries, taken from a range ordinary traffic never uses.
+    """
+    base = ipaddress.IPv4Address('198.18.0.0')
+    return [str(base + i) for i in range(1, count + 1)]
+
+
+def generate_traffic(distribution, requests, pool_size=5000, geo_hit_rate=0.8,
+                     blocklist=(), blocked_fraction=0.0, paths=50, seed=0):
+    """
+    Return a list of (ip, path) pairs for the requested distribution.
+    """
+    rng = random.Random(seed)
+    if distribution == 'rotating':
+        ips = rotating_subnet_ips(requests, rng)
+    elif distribution == 'rotating6':
+        ips = rotating_subnet_ips(requests, rng, ipv6=True)
+    else:
+        pool = ip_pool(pool_size, geo_hit_rate, rng)
+        if distribution == 'zipf':
+            ips = zipf_ips(pool, requests, rng)
+        elif distribution == 'uniform':
+            ips = uniform_ips(pool, requests, rng)
+        else:
+            raise ValueError(f"Unknown distribution '{distribution}'")
+    if blocklist and blocked_fraction:
+        ips = [rng.choice(blocklist) if rng.random() < blocked_fraction else ip for ip in ips]
+    path_list = ['/'] + [f'/api/items/{i}/' for i in range(paths - 1)]
+    return [(ip, rng.choice(path_list)) for ip in ips]
+
+
+# --- Minimal MaxMind DB writer ---
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+
+def _encode_control(type_id, size):
+    if type_id <= 7:
+        first, extended = type_id << 5, b''
+    else:
+        first, extended = 0, bytes([type_id - 7])
+    if size < 29:
+        return bytes([first | size]) + extended
+    if size < 285:
+        return bytes([first | 29]) + extended + bytes([size - 29])
+    if size < 65821:
+        return bytes([first | 30]) + extended + struct.pack('>H', size - 285)
+    return bytes([first | 31]) + extended + struct.pack('>I', size - 65821)[1:]
+
+
+class _UInt(int):
+    """
+    Integer pinned to a MaxMind DB unsigned type (5=uint16, 6=uint32, 9=uint64);
+    libmaxminddb insists on exact types for the metadata fields.
+    """
+    def __new__(cls, value, type_id):
+        obj = super().__new__(cls, value)
+        obj.type_id = type_id
+        return obj
+
+
+def _encode_value(value):
+    if isinstance(value, _UInt):
+        raw = int(value).to_bytes((value.bit_length() + 7) // 8, 'big')
+        return _encode_control(value.type_id, len(raw)) + raw
+    if isinstance(value, str):
+        raw = value.encode('utf-8')
+        return _encode_control(2, len(raw)) + raw
+    if isinstance(value, bool):
+        return _encode_control(14, int(value))
+    if isinstance(value, int):
+        raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+        type_id = 5 if value < 2 ** 16 else 6 if value < 2 ** 32 else 9
+        return _encode_control(type_id, len(raw)) + raw
+    if isinstance(value, dict):
+        return _encode_control(7, len(value)) + b''.join(
+            _encode_value(key) + _encode_value(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return _encode_control(11, len(value)) + b''.join(_encode_value(item) for item in value)
+    raise TypeError(f"Cannot encode {type(value).__name__} in a MaxMind DB")
+
+
+def write_mmdb(filename, records, database_type='GeoLite2-City'):
+    """
+    Write a MaxMind DB (format 2.0, IPv6 tree, 24-bit records) mapping each
+    network in `records` ({network: data dict}) to its data. IPv4 networks
+    are placed in the ::/96 subtree, as in the real GeoLite2 databases.
+    Enough for readers in tests and benchmarks; not a general-purpose writer.
+    """
+    root = [None, None]
+    data_section = bytearray()
+    offsets = {}
+    for network, data in records.items():
+        network = ipaddress.ip_network(network)
+        address = int(network.network_address)
+        prefixlen = network.prefixlen + (96 if network.version == 4 else 0)
+        encoded = _encode_value(data)
+        if encoded not in offsets:
+            offsets[encoded] = len(data_section)
+            data_section += encoded
+        node = root
+        for depth in range(prefixlen):
+            bit = (address >> (127 - depth)) & 1
+            if depth == prefixlen - 1:
+                node[bit] = ('data', offsets[encoded])
+            else:
+                if not isinstance(node[bit], list):
+                    node[bit] = [None, None]
+                node = node[bit]
+
+    # Number the nodes breadth-first, then emit their two records.
+    nodes = [root]
+    for node in nodes:
+        nodes.extend(child for child in node if isinstance(child, list))
+    node_ids = {id(node): index for index, node in enumerate(nodes)}
+    node_count = len(nodes)
+    tree = bytearray()
+    for node in nodes:
+        for child in node:
+            if child is None:
+                value = node_count
+            elif isinstance(child, list):
+                value = node_ids[id(child)]
+            else:
+                value = node_count + 16 + child[1]
+            tree += value.to_bytes(3, 'big')
+
+    metadata = {
+        'binary_format_major_version': _UInt(2, 5),
+        'binary_format_minor_version': _UInt(0, 5),
+        'build_epoch': _UInt(int(time.time()), 9),
+        'database_type': database_type,
+        'description': {'en': 'Synthetic database for tracking_ip benchmarks'},
+        'ip_version': _UInt(6, 5),
+        'languages': ['en'],
+        'node_count': _UInt(node_count, 6),
+        'record_size': _UInt(24, 5),
+    }
+    with open(filename, 'wb') as mmdb:
+        mmdb.write(tree)
+        mmdb.write(b'\x00' * 16)
+        mmdb.write(data_section)
+        mmdb.write(METADATA_MARKER)
+        mmdb.write(_encode_value(metadata))
+
+
+def city_record(country, city):
+    return {'country': {'names': {'en': country}}, 'city': {'names': {'en': city}}}
+
+
+def write_benchmark_city_db(filename, networks=None):
+    """
+    City database covering the benchmark geo networks.
+    """
+    networks = networks or geo_networks()
+    records = {
+        network: city_record(*GEO_LOCATIONS[index % len(GEO_LOCATIONS)])
+        for index, network in enumerate(networks)
+    }
+    write_mmdb(filename, records)
+
+
+def asn_record(number, organization):
+    return {'autonomous_system_number': _UInt(number, 6), 'autonomous_system_organization': organization}
+
+
+def write_benchmark_asn_db(filename, networks=None):
+    """
+    ASN database covering the benchmark geo networks.
+    """
+    networks = networks or geo_networks()
+    records = {
+        network: asn_record(*AUTONOMOUS_SYSTEMS[index % len(AUTONOMOUS_SYSTEMS)])
+        for index, network in enumerate(networks)
+    }
+    write_mmdb(filename, records, database_type='GeoLite2-ASN')
+
+
+# --- Throwaway database ---
+
+def clear_intern_caches():
+    RequestPath.objects.clear_cache()
+    GeoLocation.objects.clear_cache()
+    AutonomousSystem.objects.clear_cache()
+
+
+def create_benchmark_database(connection, filename):
+    """
+    Point `connection` (the tracking database) at a fresh, migrated SQLite
+    file. Returns the old database name, for destroy_test_db.
+    """
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = filename
+    clear_intern_caches()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    return old_name
+
+
+# --- Runner ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples_ns):
+    """
+    Summarize nanosecond samples as microsecond statistics.
+    """
+    values = sorted(samples_ns)
+    to_us = 1000.0
+    return {
+        'calls': len(values),
+        'mean_us': (sum(values) / len(values) / to_us) if values else 0.0,
+        'p50_us': percentile(values, 0.50) / to_us,
+        'p90_us': percentile(values, 0.90) / to_us,
+        'p99_us': percentile(values, 0.99) / to_us,
+        'p999_us': percentile(values, 0.999) / to_us,
+        'max_us': (values[-1] / to_us) if values else 0.0,
+        'total_ms': sum(values) / 1e6,
+    }
+
+
+def _timed(method, samples):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter_ns() - start)
+    return wrapper
+
+
+def run_middleware_benchmark(traffic, geoip_reader=None, warmup=0, asn_reader=None):
+    """
+    Drive BasicIPLoggingMiddleware (request and response phase, around an
+    empty view) with RequestFactory requests for each (ip, path) in
+    `traffic` and time every stage.
+    `geoip_reader` and `asn_reader` replace the module-level readers for the run.
+    """
+    factory = RequestFactory()
+    middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+    stage_samples = {stage: [] for stage in STAGES}
+    for stage, method_name in STAGES.items():
+        setattr(middleware, method_name,
+                _timed(getattr(middleware, method_name), stage_samples[stage]))
+
+    # Requests are built up front so their cost is not part of the timings.
+    requests = [factory.get(path, REMOTE_ADDR=ip) for ip, path in traffic]
+    saved_readers = tracking_middleware._geoip_reader, tracking_middleware._asn_reader
+    tracking_middleware._geoip_reader = geoip_reader
+    tracking_middleware._asn_reader = asn_reader
+    # Per-request warnings (e.g. for blocked IPs) would dominate the timings.
+    middleware_logger = logging.getLogger(tracking_middleware.__name__)
+    saved_level = middleware_logger.level
+    middleware_logger.setLevel(logging.ERROR)
+    latencies = []
+    blocked = 0
+    try:
+        for request in requests[:warmup]:
+            middleware(request)
+        for samples in stage_samples.values():
+            samples.clear()
+        started = time.perf_counter()
+        for request in requests[warmup:]:
+            start = time.perf_counter_ns()
+            response = middleware(request)
+            latencies.append(time.perf_counter_ns() - start)
+            if response.status_code == 403:
+                blocked += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        tracking_middleware._geoip_reader, tracking_middleware._asn_reader = saved_readers
+        middleware_logger.setLevel(saved_level)
+
+    measured = len(requests) - warmup
+    return {
+        'requests': measured,
+        'blocked': blocked,
+        'elapsed_s': elapsed,
+        'throughput_rps': measured / elapsed if elapsed else 0.0,
+        'latency': summarize(latencies),
+        'stages': {stage: summarize(samples) for stage, samples in stage_samples.items()},
+    }
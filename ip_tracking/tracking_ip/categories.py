@@ -0,0 +1,108 @@
+"""
+Path categories, assigned to every RequestLog row when it is written, so
+rules and stats filter on a small indexed integer instead of running a
+LIKE 'prefix%' scan per sensitive path.
+
+The category prefixes (IP_TRACKING_PATH_CATEGORIES) are compiled once into
+a single anchored regex shaped like a prefix trie: shared leading
+characters are matched once, and each category's end is marked by an
+empty named group, so `match.lastgroup` identifies the longest matching prefix.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+import re
+
+UNCATEGORIZED = 0
+
+DEFAULT_PATH_CATEGORIES = {
+    1: ('admin', ['/admin/']),
+    2: ('login', ['/login/']),
+    3: ('sensitive_api', ['/api/v1/sensitive_data/']),
+}
+DEFAULT_SENSITIVE_CATEGORIES = ['admin', 'login', 'sensitive_api']
+
+
+def _trie_pattern(node, groups):
+    """
+    Regex source for the trie below `node` ({char: child, None: category id}).
+    Longer prefixes are tried before a category ends at this node. Each
+    end gets its own group name ('e<n>'); `groups` collects their category ids.
+    """
+    branches = [re.escape(char) + _trie_pattern(child, groups)
+                for char, child in sorted(node.items(), key=lambda item: item[0] or '')
+                if char is not None]
+    if None in node:
+        branches.append(f'(?P<e{len(groups)}>)')
+        groups.append(node[None])
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+
+class PathCategorizer:
+    """
+    Maps a request path to the id of the category with the longest
+    matching prefix, or UNCATEGORIZED.
+    `categories` is {id: (name, [prefixes])}; ids are stored in
+    RequestLog.category, so an id must never be reused for another name.
+    """
+    def __init__(self, categories, sensitive=()):
+        self.names = {category_id: name for category_id, (name, _) in categories.items()}
+        self.prefixes = {category_id: list(prefixes) for category_id, (_, prefixes) in categories.items()}
+        self.ids = {name: category_id for category_id, name in self.names.items()}
+        root = {}
+        for category_id, prefixes in self.prefixes.items():
+            for prefix in prefixes:
+                node = root
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                # The first category to claim a prefix keeps it.
+                node.setdefault(None, category_id)
+        self.groups = []
+        self.pattern = re.compile(_trie_pattern(root, self.groups)) if root else None
+        self.sensitive_ids = [self.ids[name] for name in sensitive if name in self.ids]
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            getattr(settings, 'IP_TRACKING_PATH_CATEGORIES', DEFAULT_PATH_CATEGORIES),
+            getattr(settings, 'IP_TRACKING_SENSITIVE_CATEGORIES', DEFAULT_SENSITIVE_CATEGORIES),
+        )
+
+    def categorize(self, path):
+        if self.pattern is not None:
+            match = self.pattern.match(path)
+            if match:
+                return self.groups[int(match.lastgroup[1:])]
+        return UNCATEGORIZED
+
+    def name(self, category_id):
+        return self.names.get(category_id, 'uncategorized')
+
+    def describe(self, category_id):
+        """
+        The prefixes of a category, for display: '/admin/' or '/a/, /b/'.
+        """
+        return ', '.join(self.prefixes.get(category_id, [])) or self.name(category_id)
+
+
+_categorizer = None
+
+
+def get_categorizer():
+    """
+    The process-wide PathCategorizer, compiled on first use.
+    """
+    global _categorizer
+    if _categorizer is None:
+        _categorizer = PathCategorizer.from_settings()
+    return _categorizer
+
+
+def _reset_categorizer(setting, **kwargs):
+    global _categorizer
+    if setting in ('IP_TRACKING_PATH_CATEGORIES', 'IP_TRACKING_SENSITIVE_CATEGORIES'):
+        _categorizer = None
+
+
+setting_changed.connect(_reset_categorizer, dispatch_uid='tracking_ip_reset_categorizer')
@@ -0,0 +1,149 @@
+"""
+Request-scoped client context: the client address is resolved once per
+request, from REMOTE_ADDR and the X-Forwarded-For entries added by
+trusted proxies, and shared by the middleware, views and rate limiter.
+
+Forwarded headers are only believed when the request arrives from one of
+IP_TRACKING_TRUSTED_PROXIES. The chain is then walked from the right
+(the entry our own proxy appended) past further trusted proxies; the
+first untrusted address is the client. Anything to its left was sent by
+the client and is ignored, so it cannot be spoofed.
+"""
+from django.conf import settings
+import ipaddress
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRUSTED_PROXIES = ['127.0.0.1/32', '::1/128']
+
+_trusted_networks = {}
+
+
+def trusted_networks():
+    """
+    IP_TRACKING_TRUSTED_PROXIES parsed into networks, memoized per setting value.
+    """
+    proxies = tuple(getattr(settings, 'IP_TRACKING_TRUSTED_PROXIES', DEFAULT_TRUSTED_PROXIES))
+    networks = _trusted_networks.get(proxies)
+    if networks is None:
+        networks = [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+        _trusted_networks[proxies] = networks
+    return networks
+
+
+def parse_address(value):
+    """
+    Parse one address as found in REMOTE_ADDR or X-Forwarded-For, tolerating
+    ports ('1.2.3.4:80', '[2001:db8::1]:443') and IPv4-mapped IPv6.
+    Returns an ipaddress object, or None if `value` is not an address.
+    """
+    value = value.strip()
+    if value.startswith('['):
+        value = value[1:].partition(']')[0]
+    elif value.count(':') == 1:
+        value = value.partition(':')[0]
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+def _is_trusted(address, networks):
+    return any(address in network for network in networks)
+
+
+def prefix_length(version):
+    """
+    Aggregation prefix length for IPv4 or IPv6 clients
+    (IP_TRACKING_IPV4_PREFIX_LENGTH / IP_TRACKING_IPV6_PREFIX_LENGTH).
+    """
+    if version == 6:
+        return getattr(settings, 'IP_TRACKING_IPV6_PREFIX_LENGTH', 64)
+    return getattr(settings, 'IP_TRACKING_IPV4_PREFIX_LENGTH', 32)
+
+
+class ClientContext:
+    """
+    The resolved client of one request.
+    `address` is an ipaddress object (None if unknown) and `ip` its
+    normalized string. `network` is the aggregation network containing it
+    (the /64 for IPv6, the address itself for IPv4 by default),
+    `network_address` that network's address as stored in
+    RequestLog.client_network, and `prefix` its text key: the bare address
+    for a full-length prefix, 'address/length' otherwise.
+    """
+    __slots__ = ('address', 'ip', 'network', 'network_address', 'prefix')
+
+    def __init__(self, address):
+        self.address = address
+        if address is None:
+            self.ip = self.network = self.network_address = self.prefix = None
+            return
+        self.ip = str(address)
+        length = prefix_length(address.version)
+        self.network = ipaddress.ip_network((address, length), strict=False)
+        self.network_address = str(self.network.network_address)
+        if length == address.max_prefixlen:
+            self.prefix = self.ip
+        else:
+            self.prefix = str(self.network)
+
+    def __repr__(self):
+        return f'ClientContext({self.ip!r})'
+
+
+def resolve_client(meta):
+    """
+    Resolve the client address from a request's META.
+    """
+    remote = parse_address(meta.get('REMOTE_ADDR', ''))
+    if remote is None:
+        return ClientContext(None)
+    networks = trusted_networks()
+    header = getattr(settings, 'IP_TRACKING_FORWARDED_HEADER', 'HTTP_X_FORWARDED_FOR')
+    forwarded = meta.get(header)
+    if not forwarded or not _is_trusted(remote, networks):
+        return ClientContext(remote)
+    client = remote
+    for value in reversed(forwarded.split(',')):
+        address = parse_address(value)
+        if address is None:
+            # A malformed hop ends the chain; keep the proxy that reported it.
+            logger.debug(f"Ignoring malformed forwarded address {value.strip()!r}")
+            break
+        client = address
+        if not _is_trusted(address, networks):
+            break
+    return ClientContext(client)
+
+
+def get_client(request):
+    """
+    The ClientContext of `request`, resolved on first use and attached
+    to it as `request.client`.
+    """
+    client = getattr(request, 'client', None)
+    if client is None:
+        client = resolve_client(request.META)
+        request.client = client
+    return client
+
+
+def client_ip(request):
+    """
+    RATELIMIT_IP_META_KEY: makes django-ratelimit's key='ip' use the
+    resolved client address.
+    """
+    return get_client(request).ip or request.META.get('REMOTE_ADDR', '')
+
+
+def ratelimit_key(group, request):
+    """
+    django-ratelimit key function: one bucket per client prefix, so an
+    IPv6 client cannot reset its limit by rotating addresses in its /64.
+    """
+    return get_client(request).prefix or 'unknown'
@@ -0,0 +1,63 @@
+"""
+Connection setup for the database that holds the tracking tables
+(IP_TRACKING_DATABASE), tuned for many small appends.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'page_size': 8192,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'wal_autocheckpoint': 1000,
+}
+
+# page_size must be set before journal_mode switches the file to WAL.
+PRAGMA_ORDER = ['page_size', 'journal_mode']
+
+
+def tracking_database():
+    """
+    Alias of the database holding the tracking_ip tables.
+    """
+    return getattr(settings, 'IP_TRACKING_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def pragma_statements(pragmas):
+    """
+    PRAGMA statements for `pragmas`, in an order SQLite accepts.
+    """
+    names = sorted(pragmas, key=lambda name: (
+        PRAGMA_ORDER.index(name) if name in PRAGMA_ORDER else len(PRAGMA_ORDER)))
+    return [f'PRAGMA {name} = {pragmas[name]}' for name in names]
+
+
+def apply_sqlite_pragmas(cursor, pragmas):
+    for statement in pragma_statements(pragmas):
+        cursor.execute(statement)
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    connection_created handler: apply IP_TRACKING_SQLITE_PRAGMAS to new
+    SQLite connections to the tracking database.
+    Only a dedicated tracking database is tuned by default: the PRAGMAs
+    trade durability (synchronous=NORMAL) for append speed, which the
+    auth and session data of a shared 'default' database did not ask for.
+    Set IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT to tune a shared one anyway.
+    """
+    alias = tracking_database()
+    if connection.vendor != 'sqlite' or connection.alias != alias:
+        return
+    if alias == DEFAULT_DB_ALIAS and not getattr(settings, 'IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT', False):
+        return
+    pragmas = getattr(settings, 'IP_TRACKING_SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        apply_sqlite_pragmas(cursor, pragmas)
+    logger.debug(f"Applied SQLite PRAGMAs to '{connection.alias}': {pragmas}")
@@ -0,0 +1,60 @@
+from django.db import models
+import ipaddress
+
+
+def pack_ip(value):
+    """
+    Pack an IPv4/IPv6 address into 16 fixed-width bytes.
+    IPv4 addresses are stored in their IPv4-mapped IPv6 form (::ffff:a.b.c.d),
+    so both families share one column and sort in numeric order.
+    """
+    ip = ipaddress.ip_address(value)
+    if ip.version == 4:
+        return b'\x00' * 10 + b'\xff\xff' + ip.packed
+    return ip.packed
+
+
+def unpack_ip(value):
+    """
+    Turn 16 packed bytes back into the textual IP address.
+    """
+    ip = ipaddress.IPv6Address(bytes(value))
+    if ip.ipv4_mapped:
+        return str(ip.ipv4_mapped)
+    return str(ip)
+
+
+class PackedIPAddressField(models.BinaryField):
+    """
+    IP address stored as a 16-byte binary column instead of text.
+    Reads and writes textual addresses, so lookups such as
+    `ip_address='1.2.3.4'` and `values('ip_address')` keep working.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs['max_length'] = 16
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['max_length']
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return unpack_ip(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return unpack_ip(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        if isinstance(value, (bytes, memoryview)):
+            return bytes(value)
+        return pack_ip(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
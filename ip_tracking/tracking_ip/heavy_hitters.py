@@ -0,0 +1,206 @@
+"""
+Streaming top-K ("heavy hitter") counts of IPs, subnets and paths, for
+live incidents when the database is too busy to GROUP BY RequestLog.
+
+Each worker process keeps a Space-Saving summary per dimension, updated
+by the middleware in O(1). Every FLUSH_INTERVAL seconds the summaries
+are added (ZINCRBY) into per-minute Redis sorted sets trimmed to the
+same capacity, and reset. Queries merge the minutes in the window, so
+they read a few small sorted sets from Redis and never touch the database.
+"""
+from collections import Counter
+from django.conf import settings
+import ipaddress
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('ip', 'subnet', 'path')
+
+
+def subnet_of(client):
+    """
+    The /24 (IPv4) or /48 (IPv6) network containing `client`, an IP or a
+    client network key such as '2001:db8:1:2::/64'.
+    """
+    if ':' not in client and client.count('.') == 3:
+        # Hot path for already-validated IPv4 strings; avoids ipaddress.
+        return client.partition('/')[0].rpartition('.')[0] + '.0/24'
+    address = ipaddress.ip_address(client.partition('/')[0])
+    prefix = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False))
+
+
+class SpaceSaving:
+    """
+    Space-Saving summary (Metwally et al.) of the most frequent items in a
+    stream, in at most `capacity` counters. Once full, a new item takes
+    over the counter of a least-frequent item and inherits its count as
+    its `error`; every item seen more than total/capacity times is kept,
+    and its true count lies in [count - error, count].
+
+    Counters are grouped into buckets by count ("stream summary"), so
+    `offer` is O(1) whether or not it evicts.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # count -> {item: None}, an insertion-ordered set of items.
+        self.buckets = {}
+        self.min_count = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _move(self, item, old, new):
+        if old:
+            bucket = self.buckets[old]
+            del bucket[item]
+            if not bucket:
+                del self.buckets[old]
+        self.buckets.setdefault(new, {})[item] = None
+
+    def offer(self, item):
+        self.total += 1
+        count = self.counts.get(item)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+                self.errors[item] = 0
+            else:
+                count = self.min_count
+                victim = next(iter(self.buckets[count]))
+                del self.buckets[count][victim]
+                del self.counts[victim], self.errors[victim]
+                self.buckets.setdefault(count, {})[item] = None
+                self.errors[item] = count
+        self.counts[item] = count + 1
+        self._move(item, count, count + 1)
+        if count == 0:
+            self.min_count = 1
+        elif count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+
+    def top(self, k):
+        """
+        [(item, count, error)] for the `k` items with the highest counts.
+        """
+        items = sorted(self.counts.items(), key=lambda item: -item[1])[:k]
+        return [(item, count, self.errors[item]) for item, count in items]
+
+
+class HeavyHitterTracker:
+    """
+    Per-process Space-Saving summaries of client IPs, subnets and paths,
+    merged periodically into Redis. `client` is a redis-py client.
+    """
+
+    def __init__(self, client, capacity=1000, flush_interval=10.0, window=300, prefix='tracking:top'):
+        self.client = client
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.window = window
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._summaries = self._new_summaries()
+        self._last_flush = time.monotonic()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Tracker for IP_TRACKING_HEAVY_HITTERS, or None if it is disabled or
+        the configured cache is not backed by Redis.
+        """
+        config = getattr(settings, 'IP_TRACKING_HEAVY_HITTERS', None) or {}
+        if not config.get('ENABLED', False):
+            return None
+        alias = config.get('CACHE_ALIAS', 'default')
+        try:
+            from django_redis import get_redis_connection
+            client = get_redis_connection(alias)
+        except (ImportError, NotImplementedError) as e:
+            logger.info(f"Heavy hitter tracking disabled: cache '{alias}' is not a Redis cache ({e})")
+            return None
+        return cls(
+            client,
+            capacity=config.get('CAPACITY', 1000),
+            flush_interval=config.get('FLUSH_INTERVAL', 10.0),
+            window=config.get('WINDOW', 300),
+        )
+
+    def _new_summaries(self):
+        return {dimension: SpaceSaving(self.capacity) for dimension in DIMENSIONS}
+
+    def key(self, dimension, minute):
+        return f'{self.prefix}:{dimension}:{minute}'
+
+    # --- Writes ---
+
+    def offer(self, client, path):
+        """
+        Count a request from `client` (the IP, or its client network key) to `path`.
+        """
+        try:
+            subnet = subnet_of(client)
+        except ValueError:
+            subnet = None
+        with self._lock:
+            self._summaries['ip'].offer(client)
+            if subnet is not None:
+                self._summaries['subnet'].offer(subnet)
+            self._summaries['path'].offer(path)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            try:
+                self.flush()
+            except Exception as e:
+                # The counts of this interval are lost; requests are unaffected.
+                logger.error(f"Error flushing heavy hitters to Redis: {e}")
+
+    def flush(self, now=None):
+        """
+        Add this process's counts since the last flush to the current
+        minute's sorted sets, keeping the `capacity` largest entries.
+        """
+        with self._lock:
+            summaries, self._summaries = self._summaries, self._new_summaries()
+        minute = int((now or time.time()) // 60)
+        pipe = self.client.pipeline(transaction=False)
+        for dimension, summary in summaries.items():
+            if not summary.counts:
+                continue
+            key = self.key(dimension, minute)
+            for item, count in summary.counts.items():
+                pipe.zincrby(key, count, item)
+            pipe.zremrangebyrank(key, 0, -(self.capacity + 1))
+            pipe.expire(key, self.window + 120)
+        pipe.execute()
+
+    # --- Queries ---
+
+    def top(self, dimension, k=10, window=None, now=None):
+        """
+        [(item, count)] for the `k` heaviest items of `dimension` over the
+        last `window` seconds, across all worker processes.
+        """
+        window = window or self.window
+        minute = int((now or time.time()) // 60)
+        minutes = range(minute - max(int(window // 60), 1) + 1, minute + 1)
+        pipe = self.client.pipeline(transaction=False)
+        for m in minutes:
+            pipe.zrange(self.key(dimension, m), 0, -1, withscores=True)
+        totals = Counter()
+        for entries in pipe.execute():
+            for item, count in entries:
+                item = item.decode() if isinstance(item, bytes) else item
+                totals[item] += int(count)
+        return totals.most_common(k)
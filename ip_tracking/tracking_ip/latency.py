@@ -0,0 +1,109 @@
+"""
+Per-path latency percentiles from hourly rollups.
+
+rollup_hour() groups an hour of RequestLog rows by path and by
+logarithmic duration bucket in the database, and stores the weighted
+counts as LatencyRollup rows. Bucket counts add up across hours, so the
+p50/p95/p99 of any period are read from a few rollup rows per path,
+however many requests it served. A percentile is reported as the
+geometric middle of its bucket, within LATENCY_BUCKET_GROWTH^0.5 - 1
+(about 12%) of the exact value.
+"""
+from datetime import timedelta
+from django.db import router, transaction
+from django.db.models import FloatField, Sum, Value
+from django.db.models.functions import Floor, Greatest, Ln
+from tracking_ip.models import LatencyRollup, RequestLog, RequestPath
+from tracking_ip.routers import replica_reads
+import math
+
+LATENCY_BUCKET_GROWTH = 1.25
+RELATIVE_ERROR = math.sqrt(LATENCY_BUCKET_GROWTH) - 1
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def bucket_expression():
+    """
+    Database expression for the latency bucket of a row's duration_us.
+    """
+    return Floor(Ln(Greatest('duration_us', Value(1), output_field=FloatField()))
+                 / Value(math.log(LATENCY_BUCKET_GROWTH)))
+
+
+def bucket_of(duration_us):
+    return math.floor(math.log(max(duration_us, 1)) / math.log(LATENCY_BUCKET_GROWTH))
+
+
+def bucket_value(bucket):
+    """
+    Representative duration (µs) of a bucket: the geometric middle of its bounds.
+    """
+    return LATENCY_BUCKET_GROWTH ** (bucket + 0.5)
+
+
+def percentiles(counts, fractions=PERCENTILES):
+    """
+    [duration µs] at each fraction of the weighted {bucket: requests} counts.
+    """
+    total = sum(counts.values())
+    results = []
+    for fraction in fractions:
+        target = fraction * total
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= target:
+                results.append(bucket_value(bucket))
+                break
+    return results
+
+
+def rollup_hour(hour):
+    """
+    (Re)build the LatencyRollup rows of the hour starting at `hour`.
+    Idempotent, so the current hour can be rolled up repeatedly.
+    """
+    # A couple of minutes of replication lag is caught by the next run.
+    with replica_reads(max_lag=120):
+        rows = list(
+            RequestLog.objects.filter(
+                timestamp__gte=hour, timestamp__lt=hour + timedelta(hours=1),
+                duration_us__isnull=False,
+            ).order_by().annotate(bucket=bucket_expression())
+            .values('path_ref', 'bucket').annotate(requests=Sum('sample_weight'))
+        )
+    with transaction.atomic(using=router.db_for_write(LatencyRollup)):
+        LatencyRollup.objects.filter(hour=hour).delete()
+        LatencyRollup.objects.bulk_create([
+            LatencyRollup(hour=hour, path_ref_id=row['path_ref'], bucket=int(row['bucket']),
+                          requests=row['requests'])
+            for row in rows
+        ], batch_size=1000)
+    return len(rows)
+
+
+def latency_by_path(since, until=None, path_prefix=None):
+    """
+    [{'path', 'requests', 'p50_us', 'p95_us', 'p99_us'}] per path for the
+    rolled-up hours from `since` (rounded down to the hour) to `until`.
+    """
+    rollups = LatencyRollup.objects.filter(hour__gte=since.replace(minute=0, second=0, microsecond=0))
+    if until is not None:
+        rollups = rollups.filter(hour__lt=until)
+    if path_prefix:
+        rollups = rollups.filter(path_ref__in=RequestPath.objects.filter(path__startswith=path_prefix))
+    counts = {}
+    for row in rollups.values('path_ref', 'bucket').annotate(requests=Sum('requests')).order_by():
+        counts.setdefault(row['path_ref'], {})[row['bucket']] = row['requests']
+    paths = RequestPath.objects.in_bulk(list(counts))
+    results = []
+    for path_id, buckets in counts.items():
+        p50, p95, p99 = percentiles(buckets)
+        results.append({
+            'path': paths[path_id].path,
+            'requests': sum(buckets.values()),
+            'p50_us': p50,
+            'p95_us': p95,
+            'p99_us': p99,
+        })
+    return results
@@ -0,0 +1,173 @@
+from django.core.management.base import BaseCommand, CommandError
+from tracking_ip.benchmarks import summarize
+from tracking_ip.database import DEFAULT_SQLITE_PRAGMAS, apply_sqlite_pragmas
+from tracking_ip.fields import pack_ip
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+LOG_SCHEMA = """
+CREATE TABLE requestlog (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    ip_address BLOB NOT NULL,
+    timestamp datetime NOT NULL,
+    path_ref_id bigint NOT NULL,
+    geo_id bigint NULL,
+    sample_weight integer NOT NULL
+);
+CREATE INDEX requestlog_time_id ON requestlog (timestamp, id);
+"""
+
+# Stand-in for the session/auth/admin writes of the rest of the site.
+APP_SCHEMA = """
+CREATE TABLE session (
+    session_key varchar(40) PRIMARY KEY,
+    session_data text NOT NULL,
+    expire_date datetime NOT NULL
+);
+"""
+
+# Python's sqlite3 default: rollback journal, synchronous=FULL, 5 s busy timeout.
+STOCK_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000}
+
+SCENARIOS = {
+    # name: (pragmas for the log database, logs in their own file)
+    'shared-stock': (STOCK_PRAGMAS, False),
+    'shared-tuned': (DEFAULT_SQLITE_PRAGMAS, False),
+    'dedicated-tuned': (DEFAULT_SQLITE_PRAGMAS, True),
+}
+
+
+def _connect(filename, pragmas):
+    # Autocommit, like Django: every insert is its own transaction.
+    conn = sqlite3.connect(filename, isolation_level=None, timeout=pragmas['busy_timeout'] / 1000)
+    apply_sqlite_pragmas(conn, pragmas)
+    return conn
+
+
+def _insert_log(conn, rng):
+    row = (pack_ip(f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'),
+           time.strftime('%Y-%m-%d %H:%M:%S'), rng.randrange(1, 500), rng.randrange(1, 50), 1)
+    conn.execute(
+        "INSERT INTO requestlog (ip_address, timestamp, path_ref_id, geo_id, sample_weight) "
+        "VALUES (?, ?, ?, ?, ?)", row)
+
+
+def _write_session(conn, rng):
+    conn.execute(
+        "INSERT OR REPLACE INTO session VALUES (?, ?, datetime('now', '+1 day'))",
+        (f'{rng.randrange(10000):040d}', 'x' * 200))
+    # The site does other work between writes; log writers do not pause.
+    time.sleep(0.001)
+
+
+def _writer(kind, filename, pragmas, seconds, seed, start, results):
+    """
+    Run one kind of write ('log' or 'app') in a loop for `seconds`, and
+    always report (kind, latencies_ns, locked_errors) back to the parent.
+    """
+    rng = random.Random(seed)
+    write = _insert_log if kind == 'log' else _write_session
+    latencies = []
+    errors = 0
+    try:
+        conn = _connect(filename, pragmas)
+        start.wait()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            began = time.perf_counter_ns()
+            try:
+                write(conn, rng)
+            except sqlite3.OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter_ns() - began)
+        conn.close()
+    finally:
+        results.put((kind, latencies, errors))
+
+
+class Command(BaseCommand):
+    """
+    Measure concurrent RequestLog insert throughput on SQLite, with the
+    stock connection setup and with IP_TRACKING_SQLITE_PRAGMAS, with the
+    log table sharing a file with app writes or in its own file.
+    Usage: python manage.py bench_log_db --workers 4 --seconds 5
+    """
+    help = 'Benchmark concurrent log inserts on a shared vs. dedicated, stock vs. tuned SQLite database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Concurrent log-writing processes.')
+        parser.add_argument('--seconds', type=float, default=5.0,
+                            help='Duration of each scenario.')
+        parser.add_argument('--no-app-writer', action='store_true',
+                            help='Do not run the competing app-write process.')
+        parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                            help='Scenario to run (repeatable); all by default.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 0 or options['seconds'] <= 0:
+            raise CommandError('--workers and --seconds must be positive.')
+        self.stdout.write(
+            f"{'scenario':<18}{'inserts/s':>11}{'p50 us':>10}{'p99 us':>11}"
+            f"{'max ms':>9}{'locked':>8}{'app w/s':>9}{'app p99 ms':>12}"
+        )
+        for name in options['scenario'] or SCENARIOS:
+            pragmas, dedicated = SCENARIOS[name]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                result = self._run(tmpdir, pragmas, dedicated, options)
+            self._report(name, result, options['seconds'])
+
+    def _run(self, tmpdir, pragmas, dedicated, options):
+        log_file = os.path.join(tmpdir, 'tracking.sqlite3')
+        app_file = os.path.join(tmpdir, 'app.sqlite3') if dedicated else log_file
+        # page_size has to be set before the first table is created.
+        conn = _connect(log_file, pragmas)
+        conn.executescript(LOG_SCHEMA)
+        conn.close()
+        # Sharing a file means sharing its connection setup, as the app's
+        # own connections would get the same PRAGMAs.
+        app_pragmas = STOCK_PRAGMAS if dedicated else pragmas
+        conn = _connect(app_file, app_pragmas)
+        conn.executescript(APP_SCHEMA)
+        conn.close()
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=_writer, args=(
+                'log', log_file, pragmas, options['seconds'], options['seed'] + i, start, results))
+            for i in range(options['workers'])
+        ]
+        if not options['no_app_writer']:
+            processes.append(multiprocessing.Process(target=_writer, args=(
+                'app', app_file, app_pragmas, options['seconds'], options['seed'], start, results)))
+        for process in processes:
+            process.start()
+        start.set()
+        collected = {'log': ([], 0), 'app': ([], 0)}
+        # Drain the queue before joining; children block until it is read.
+        for _ in processes:
+            kind, latencies, errors = results.get()
+            previous_latencies, previous_errors = collected[kind]
+            collected[kind] = (previous_latencies + latencies, previous_errors + errors)
+        for process in processes:
+            process.join()
+        return collected
+
+    def _report(self, name, result, seconds):
+        log_latencies, log_errors = result['log']
+        app_latencies, _ = result['app']
+        log = summarize(log_latencies)
+        app = summarize(app_latencies)
+        self.stdout.write(
+            f"{name:<18}{len(log_latencies) / seconds:>11,.0f}{log['p50_us']:>10.0f}"
+            f"{log['p99_us']:>11.0f}{log['max_us'] / 1000:>9.1f}{log_errors:>8}"
+            f"{len(app_latencies) / seconds:>9,.0f}{app['p99_us'] / 1000:>12.2f}"
+        )
@@ -0,0 +1,163 @@
+from django.core.management.base import BaseCommand
+from tracking_ip.fields import pack_ip
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE requestlog (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    ip_address char(39) NOT NULL,
+    timestamp datetime NOT NULL,
+    path varchar(254) NOT NULL,
+    country varchar(100) NULL,
+    city varchar(100) NULL
+);
+"""
+
+COMPACT_SCHEMA = """
+CREATE TABLE requestpath (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    path varchar(254) NOT NULL UNIQUE
+);
+CREATE TABLE geolocation (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    country varchar(100) NULL,
+    city varchar(100) NULL,
+    UNIQUE (country, city)
+);
+CREATE TABLE requestlog (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    ip_address BLOB NOT NULL,
+    timestamp datetime NOT NULL,
+    path_ref_id bigint NOT NULL REFERENCES requestpath (id),
+    geo_id bigint NULL REFERENCES geolocation (id)
+);
+CREATE INDEX requestlog_path_ref_id ON requestlog (path_ref_id);
+CREATE INDEX requestlog_geo_id ON requestlog (geo_id);
+"""
+
+LEGACY_QUERIES = {
+    'by country': "SELECT country, COUNT(*) FROM requestlog GROUP BY country",
+    'by path': "SELECT path, COUNT(*) FROM requestlog GROUP BY path",
+    'by ip': "SELECT ip_address, COUNT(*) FROM requestlog GROUP BY ip_address",
+}
+
+COMPACT_QUERIES = {
+    'by country': (
+        "SELECT g.country, SUM(c.n) FROM "
+        "(SELECT geo_id, COUNT(*) AS n FROM requestlog GROUP BY geo_id) c "
+        "LEFT JOIN geolocation g ON g.id = c.geo_id GROUP BY g.country"
+    ),
+    'by path': (
+        "SELECT p.path, c.n FROM "
+        "(SELECT path_ref_id, COUNT(*) AS n FROM requestlog GROUP BY path_ref_id) c "
+        "JOIN requestpath p ON p.id = c.path_ref_id"
+    ),
+    'by ip': "SELECT ip_address, COUNT(*) FROM requestlog GROUP BY ip_address",
+}
+
+COUNTRIES = [
+    ('United States', ['New York', 'Mountain View', 'Chicago', 'Seattle']),
+    ('Germany', ['Berlin', 'Frankfurt am Main', 'Munich']),
+    ('Brazil', ['São Paulo', 'Rio de Janeiro']),
+    ('Japan', ['Tokyo', 'Osaka']),
+    ('Australia', ['Sydney', 'Melbourne']),
+    (None, [None]),
+]
+
+
+class Command(BaseCommand):
+    """
+    Compare the legacy flat RequestLog layout against the compact one.
+    Usage: python manage.py bench_storage --rows 200000
+    """
+    help = 'Benchmark on-disk size and aggregate speed of the RequestLog layouts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000,
+                            help='Number of synthetic log rows to insert.')
+        parser.add_argument('--paths', type=int, default=500,
+                            help='Number of distinct request paths.')
+        parser.add_argument('--ips', type=int, default=20000,
+                            help='Number of distinct client IPs.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed for the synthetic data.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        paths = [f"/api/v1/resource{i}/items/" for i in range(options['paths'])]
+        ips = [
+            f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+            for _ in range(options['ips'])
+        ]
+        geos = [(country, city) for country, cities in COUNTRIES for city in cities]
+        rows = [
+            (rng.choice(ips), '2025-07-20 12:00:00', rng.choice(paths), *rng.choice(geos))
+            for _ in range(options['rows'])
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            legacy = self._build(os.path.join(tmpdir, 'legacy.sqlite3'), LEGACY_SCHEMA,
+                                 self._load_legacy, rows)
+            compact = self._build(os.path.join(tmpdir, 'compact.sqlite3'), COMPACT_SCHEMA,
+                                  self._load_compact, rows)
+            self._report('size (bytes)', legacy['size'], compact['size'])
+            for name in LEGACY_QUERIES:
+                legacy_time = self._time_query(legacy['conn'], LEGACY_QUERIES[name])
+                compact_time = self._time_query(compact['conn'], COMPACT_QUERIES[name])
+                self._report(f'group {name} (ms)', legacy_time * 1000, compact_time * 1000)
+            legacy['conn'].close()
+            compact['conn'].close()
+
+    def _build(self, filename, schema, loader, rows):
+        conn = sqlite3.connect(filename)
+        conn.executescript(schema)
+        loader(conn, rows)
+        conn.commit()
+        conn.execute('VACUUM')
+        return {'conn': conn, 'size': os.path.getsize(filename)}
+
+    def _load_legacy(self, conn, rows):
+        conn.executemany(
+            "INSERT INTO requestlog (ip_address, timestamp, path, country, city) "
+            "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _load_compact(self, conn, rows):
+        path_ids = {}
+        geo_ids = {}
+        compact_rows = []
+        for ip_address, timestamp, path, country, city in rows:
+            if path not in path_ids:
+                path_ids[path] = conn.execute(
+                    "INSERT INTO requestpath (path) VALUES (?)", (path,)).lastrowid
+            geo_id = None
+            if country or city:
+                if (country, city) not in geo_ids:
+                    geo_ids[(country, city)] = conn.execute(
+                        "INSERT INTO geolocation (country, city) VALUES (?, ?)",
+                        (country, city)).lastrowid
+                geo_id = geo_ids[(country, city)]
+            compact_rows.append((pack_ip(ip_address), timestamp, path_ids[path], geo_id))
+        conn.executemany(
+            "INSERT INTO requestlog (ip_address, timestamp, path_ref_id, geo_id) "
+            "VALUES (?, ?, ?, ?)", compact_rows)
+
+    def _time_query(self, conn, sql, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(sql).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def _report(self, label, legacy, compact):
+        ratio = legacy / compact if compact else float('inf')
+        self.stdout.write(
+            f"{label:<24} legacy={legacy:>14,.1f}  compact={compact:>14,.1f}  "
+            f"ratio={ratio:.2f}x"
+        )
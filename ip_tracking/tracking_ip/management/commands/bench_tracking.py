@@ -0,0 +1,155 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.test.utils import override_settings
+from tracking_ip.benchmarks import (
+    blocked_ips, clear_intern_caches, create_benchmark_database, generate_traffic,
+    run_middleware_benchmark, write_benchmark_asn_db, write_benchmark_city_db,
+)
+from tracking_ip.models import BlockedIP, RequestLog
+import geoip2.database
+import json
+import os
+import random
+import tempfile
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bench-tracking',
+    }
+}
+
+
+class Command(BaseCommand):
+    """
+    Micro-benchmark BasicIPLoggingMiddleware with synthetic traffic.
+    Runs against a throwaway SQLite database, a locmem cache (unless
+    --cache=configured) and a temporary GeoIP2 City database.
+    Usage: python manage.py bench_tracking --distribution zipf --output run.json
+    ASN enrichment overhead: run once as above, then again with
+    --asn --compare run.json.
+    """
+    help = 'Benchmark the per-request cost of the IP tracking middleware.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000,
+                            help='Number of measured requests.')
+        parser.add_argument('--warmup', type=int, default=500,
+                            help='Requests sent before measuring starts.')
+        parser.add_argument('--distribution', default='zipf',
+                            choices=['uniform', 'zipf', 'rotating', 'rotating6'],
+                            help='Client IP distribution.')
+        parser.add_argument('--pool-size', type=int, default=5000,
+                            help='Distinct IPs for the uniform/zipf distributions.')
+        parser.add_argument('--geo-hit-rate', type=float, default=0.8,
+                            help='Fraction of pool IPs found in the GeoIP2 database.')
+        parser.add_argument('--blocklist-size', type=int, default=1000,
+                            help='Number of BlockedIP rows.')
+        parser.add_argument('--blocked-fraction', type=float, default=0.01,
+                            help='Fraction of requests coming from blocked IPs.')
+        parser.add_argument('--cache', choices=['locmem', 'configured'], default='locmem',
+                            help="Use a local-memory cache, or the project's configured one.")
+        parser.add_argument('--no-geoip', action='store_true',
+                            help='Run without a GeoIP2 reader.')
+        parser.add_argument('--asn', action='store_true',
+                            help='Also enrich with a temporary GeoIP2 ASN database.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed for traffic and sampling.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='Print the change against an earlier JSON result.')
+
+    def handle(self, *args, **options):
+        if options['requests'] <= 0:
+            raise CommandError('--requests must be positive.')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        blocklist = blocked_ips(options['blocklist_size'])
+        traffic = generate_traffic(
+            options['distribution'],
+            options['warmup'] + options['requests'],
+            pool_size=options['pool_size'],
+            geo_hit_rate=options['geo_hit_rate'],
+            blocklist=blocklist,
+            blocked_fraction=options['blocked_fraction'],
+            seed=options['seed'],
+        )
+
+        overrides = {
+            # Adaptive sampling depends on wall-clock timing; keep runs comparable.
+            'IP_TRACKING_ADAPTIVE_SAMPLING': None,
+            # The throwaway database holds nothing but tracking data; tune it as a dedicated one.
+            'IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT': True,
+        }
+        if options['cache'] == 'locmem':
+            overrides['CACHES'] = LOCMEM_CACHES
+
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(**overrides):
+            reader = asn_reader = None
+            if not options['no_geoip']:
+                mmdb_path = os.path.join(tmpdir, 'GeoLite2-City.mmdb')
+                write_benchmark_city_db(mmdb_path)
+                reader = geoip2.database.Reader(mmdb_path)
+            if options['asn']:
+                asn_path = os.path.join(tmpdir, 'GeoLite2-ASN.mmdb')
+                write_benchmark_asn_db(asn_path)
+                asn_reader = geoip2.database.Reader(asn_path)
+
+            connection = connections[router.db_for_write(RequestLog)]
+            old_name = create_benchmark_database(connection, os.path.join(tmpdir, 'bench.sqlite3'))
+            try:
+                BlockedIP.objects.bulk_create(
+                    BlockedIP(ip_address=ip_address) for ip_address in blocklist
+                )
+                random.seed(options['seed'])
+                results = run_middleware_benchmark(
+                    traffic, reader, warmup=options['warmup'], asn_reader=asn_reader)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                clear_intern_caches()
+                for geo_reader in (reader, asn_reader):
+                    if geo_reader is not None:
+                        geo_reader.close()
+
+        results['config'] = {
+            key: options[key] for key in (
+                'requests', 'warmup', 'distribution', 'pool_size', 'geo_hit_rate',
+                'blocklist_size', 'blocked_fraction', 'cache', 'no_geoip', 'asn', 'seed',
+            )
+        }
+        self._report(results, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def _report(self, results, baseline=None):
+        latency = results['latency']
+        self.stdout.write(
+            f"{results['requests']} requests in {results['elapsed_s']:.2f}s "
+            f"({results['throughput_rps']:,.0f} req/s, {results['blocked']} blocked)"
+        )
+        self.stdout.write(
+            f"latency us: p50={latency['p50_us']:.1f} p90={latency['p90_us']:.1f} "
+            f"p99={latency['p99_us']:.1f} p99.9={latency['p999_us']:.1f} max={latency['max_us']:.1f}"
+        )
+        self.stdout.write(f"{'stage':<16}{'calls':>8}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'share':>8}")
+        total = sum(stage['total_ms'] for stage in results['stages'].values()) or 1.0
+        for name, stage in results['stages'].items():
+            self.stdout.write(
+                f"{name:<16}{stage['calls']:>8}{stage['mean_us']:>10.1f}{stage['p50_us']:>10.1f}"
+                f"{stage['p99_us']:>10.1f}{stage['total_ms'] / total:>8.0%}"
+            )
+        if baseline:
+            self.stdout.write('\nChange against baseline:')
+            pairs = [('throughput_rps', results['throughput_rps'], baseline['throughput_rps'])]
+            pairs += [(f'latency {key}', latency[key], baseline['latency'][key])
+                      for key in ('p50_us', 'p99_us')]
+            pairs += [(f'{name} mean_us', stage['mean_us'], baseline['stages'][name]['mean_us'])
+                      for name, stage in results['stages'].items() if name in baseline['stages']]
+            for label, current, previous in pairs:
+                change = (current - previous) / previous if previous else 0.0
+                self.stdout.write(f"  {label:<28}{previous:>12.1f} -> {current:>12.1f} ({change:+.1%})")
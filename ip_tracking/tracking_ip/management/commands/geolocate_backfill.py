@@ -0,0 +1,277 @@
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+from django.db.models import Max, Min, Q
+from tracking_ip.middleware import lookup_ip
+from tracking_ip.models import AutonomousSystem, GeoLocation, RequestLog
+import geoip2.database
+import json
+import multiprocessing
+import os
+import time
+
+# Per-worker readers, opened by _init_worker. The default mode memory-maps
+# the database, so all workers share its pages through the page cache.
+_city_reader = None
+_asn_reader = None
+
+
+def _init_worker(city_path, asn_path):
+    global _city_reader, _asn_reader
+    _city_reader = geoip2.database.Reader(city_path) if city_path else None
+    _asn_reader = geoip2.database.Reader(asn_path) if asn_path else None
+
+
+def _lookup_ips(ips):
+    """
+    {ip: (country, city, asn, as_org)} for one chunk's distinct IPs.
+    """
+    results = {}
+    for ip in ips:
+        try:
+            geo = lookup_ip(ip, _city_reader, _asn_reader)
+        except ValueError:
+            # Not an address the databases can look up; leave the row as is.
+            continue
+        results[ip] = (geo['country'], geo['city'], geo.get('asn'), geo.get('as_org'))
+    return results
+
+
+class Command(BaseCommand):
+    """
+    Geolocate RequestLog rows that were logged without geolocation (the
+    GeoIP2 database was missing), and refresh stale ones after a GeoLite2
+    update: with --stale, rows logged before the databases were built,
+    which were looked up in an older release; with --before, rows logged
+    before a given time; with --all, every row. Autonomous systems whose
+    organization changed in the new release are renamed as they are seen.
+
+    Rows are read in primary key ranges of --chunk-size, and the distinct
+    IPs of each chunk are looked up by a pool of worker processes, each
+    with its own reader. At most two chunks per worker are in flight, so
+    memory stays flat however large the table is. Changed rows are written
+    with bulk_update, and with --state-file the last finished id is
+    recorded after every chunk, so an interrupted run can be resumed.
+    Usage: python manage.py geolocate_backfill --workers 4 --state-file backfill.json
+    """
+    help = 'Fill in or refresh the geolocation of logged requests.'
+
+    def add_arguments(self, parser):
+        refresh = parser.add_mutually_exclusive_group()
+        refresh.add_argument('--all', action='store_true',
+                             help='Re-geolocate every row, not only rows without geolocation.')
+        refresh.add_argument('--before', default=None,
+                             help='Also re-geolocate rows logged before this ISO date or datetime (UTC).')
+        refresh.add_argument('--stale', action='store_true',
+                             help='Also re-geolocate rows logged before the GeoIP2 databases were built.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Lookup processes.')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Rows per primary key range.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows per UPDATE statement.')
+        parser.add_argument('--start-id', type=int, default=None,
+                            help='First RequestLog id to process.')
+        parser.add_argument('--end-id', type=int, default=None,
+                            help='Last RequestLog id to process; the current maximum by default.')
+        parser.add_argument('--state-file', default=None,
+                            help='JSON file recording progress; an existing one resumes the run.')
+        parser.add_argument('--city-db', default=None,
+                            help='GeoLite2-City database; GEOIP_PATH by default.')
+        parser.add_argument('--asn-db', default=None,
+                            help='GeoLite2-ASN database; GEOIP_ASN_PATH by default.')
+        parser.add_argument('--progress-every', type=float, default=10.0,
+                            help='Seconds between progress lines.')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 0 or options['chunk_size'] <= 0 or options['batch_size'] <= 0:
+            raise CommandError('--workers, --chunk-size and --batch-size must be positive.')
+        city_path = self._database_path(options['city_db'], 'GEOIP_PATH')
+        asn_path = self._database_path(options['asn_db'], 'GEOIP_ASN_PATH')
+        if not city_path and not asn_path:
+            raise CommandError('No GeoIP2 database found; set GEOIP_PATH or pass --city-db.')
+        # Only overwrite what the available databases can answer.
+        self.fields = []
+        missing = Q()
+        if city_path:
+            self.fields.append('geo')
+            missing |= Q(geo__isnull=True)
+        if asn_path:
+            self.fields.append('autonomous_system')
+            missing |= Q(autonomous_system__isnull=True)
+        self.before = self._refresh_before(options, city_path, asn_path)
+        if self.before is not None:
+            self.stdout.write(f'Refreshing rows logged before {self.before.isoformat()}.')
+
+        # Read from the primary: replica lag could hide rows from a resumed run.
+        self.db = router.db_for_write(RequestLog)
+        queryset = RequestLog.objects.using(self.db).order_by()
+        bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            self.stdout.write('No request logs to geolocate.')
+            return
+        start = options['start_id'] if options['start_id'] is not None else bounds['low']
+        end = options['end_id'] if options['end_id'] is not None else bounds['high']
+        self.state_file = options['state_file']
+        last_id = self._read_state()
+        if last_id is not None:
+            self.stdout.write(f'Resuming after id {last_id}.')
+            start = max(start, last_id + 1)
+        if self.before is not None:
+            queryset = queryset.filter(missing | Q(timestamp__lt=self.before))
+        elif not options['all']:
+            queryset = queryset.filter(missing)
+
+        self.options = options
+        self.scanned = self.updated = 0
+        self.organizations_updated = 0
+        self.checked_asns = set()
+        self.start, self.end = start, end
+        self.started_at = self.reported_at = time.monotonic()
+        self._run(queryset, city_path, asn_path)
+        elapsed = time.monotonic() - self.started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: scanned {self.scanned:,} rows, updated {self.updated:,} '
+            f'in {elapsed:.1f}s ({self.scanned / max(elapsed, 1e-9):,.0f} rows/s).'
+        ))
+        if self.organizations_updated:
+            self.stdout.write(f'Renamed {self.organizations_updated:,} autonomous systems.')
+
+    def _refresh_before(self, options, city_path, asn_path):
+        """
+        The time before which logged rows are refreshed, or None.
+        """
+        if options['before']:
+            try:
+                before = datetime.fromisoformat(options['before'])
+            except ValueError:
+                raise CommandError('--before must be an ISO date or datetime.')
+            return before if before.tzinfo else before.replace(tzinfo=dt_timezone.utc)
+        if not options['stale']:
+            return None
+        # Rows logged before the newest release may hold answers from an
+        # older one; rows that are up to date are left unchanged.
+        epochs = []
+        for path in (city_path, asn_path):
+            if path:
+                with geoip2.database.Reader(path) as reader:
+                    epochs.append(reader.metadata().build_epoch)
+        return datetime.fromtimestamp(max(epochs), tz=dt_timezone.utc)
+
+    def _database_path(self, path, setting):
+        if path:
+            if not os.path.exists(path):
+                raise CommandError(f"GeoIP2 database '{path}' not found.")
+            return path
+        path = getattr(settings, setting, None)
+        if path and not os.path.exists(path):
+            self.stdout.write(self.style.WARNING(f'{setting} ({path}) not found; skipping it.'))
+            return None
+        return path
+
+    def _run(self, queryset, city_path, asn_path):
+        workers = self.options['workers']
+        chunk_size = self.options['chunk_size']
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                  initargs=(city_path, asn_path)) as pool:
+            pending = deque()
+            for low in range(self.start, self.end + 1, chunk_size):
+                high = min(low + chunk_size - 1, self.end)
+                rows = list(queryset.filter(pk__gte=low, pk__lte=high).values_list(
+                    'pk', 'ip_address', 'geo_id', 'autonomous_system_id', 'timestamp'))
+                ips = sorted({row[1] for row in rows})
+                lookup = pool.apply_async(_lookup_ips, (ips,)) if ips else None
+                pending.append((high, rows, lookup))
+                # Chunks finish in order, so the recorded id is always safe to resume from.
+                if len(pending) >= 2 * workers:
+                    self._finish_chunk(*pending.popleft())
+            while pending:
+                self._finish_chunk(*pending.popleft())
+
+    def _finish_chunk(self, high, rows, lookup):
+        if lookup is not None:
+            ids = self._resolve_ids(lookup.get())
+            changed = []
+            for pk, ip, geo_id, asn_id, timestamp in rows:
+                if ip not in ids:
+                    continue
+                new_geo_id, new_asn_id = ids[ip]
+                log = RequestLog(pk=pk, geo_id=geo_id, autonomous_system_id=asn_id)
+                # Values a row already has are kept, unless it is being refreshed.
+                refresh = self.options['all'] or (self.before is not None and timestamp < self.before)
+                if 'geo' in self.fields and (refresh or geo_id is None):
+                    log.geo_id = new_geo_id
+                if 'autonomous_system' in self.fields and (refresh or asn_id is None):
+                    log.autonomous_system_id = new_asn_id
+                if (log.geo_id, log.autonomous_system_id) != (geo_id, asn_id):
+                    changed.append(log)
+            if changed:
+                RequestLog.objects.using(self.db).bulk_update(
+                    changed, self.fields, batch_size=self.options['batch_size'])
+            self.scanned += len(rows)
+            self.updated += len(changed)
+        self._write_state(high)
+        now = time.monotonic()
+        if now - self.reported_at >= self.options['progress_every']:
+            self.reported_at = now
+            done = (high - self.start + 1) / max(self.end - self.start + 1, 1)
+            self.stdout.write(
+                f'id {high:,}/{self.end:,} ({done:.1%}): scanned {self.scanned:,}, '
+                f'updated {self.updated:,}, {self.scanned / (now - self.started_at):,.0f} rows/s'
+            )
+
+    def _resolve_ids(self, geo_by_ip):
+        """
+        {ip: (geo_id, asn_id)}, interning each distinct location and AS once.
+        """
+        ids = {}
+        organizations = {}
+        for ip, (country, city, asn, as_org) in geo_by_ip.items():
+            geo_id = asn_id = None
+            if country or city:
+                geo_id = GeoLocation.objects.intern(country=country, city=city)
+            if asn is not None:
+                asn_id = AutonomousSystem.objects.intern(number=asn, defaults={'organization': as_org})
+                if as_org and asn not in self.checked_asns:
+                    organizations[asn] = as_org
+            ids[ip] = (geo_id, asn_id)
+        if organizations:
+            self._update_organizations(organizations)
+        return ids
+
+    def _update_organizations(self, organizations):
+        """
+        Rename autonomous systems whose organization changed; intern() only
+        sets it when it creates the row. Each AS is checked once per run.
+        """
+        self.checked_asns.update(organizations)
+        current = AutonomousSystem.objects.using(self.db).filter(
+            number__in=list(organizations)).values_list('number', 'organization')
+        renamed = [
+            AutonomousSystem(number=number, organization=organizations[number])
+            for number, organization in current if organization != organizations[number]
+        ]
+        if renamed:
+            AutonomousSystem.objects.using(self.db).bulk_update(
+                renamed, ['organization'], batch_size=self.options['batch_size'])
+            self.organizations_updated += len(renamed)
+
+    def _read_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)['last_id']
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Cannot read state file '{self.state_file}': {e}")
+
+    def _write_state(self, last_id):
+        if not self.state_file:
+            return
+        # Write and rename, so an interruption never leaves a truncated file.
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'last_id': last_id, 'scanned': self.scanned, 'updated': self.updated}, f)
+        os.replace(tmp, self.state_file)
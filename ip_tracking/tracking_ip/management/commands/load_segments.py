@@ -0,0 +1,105 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.db.models import F
+from tracking_ip.models import LogSegment, RequestLog
+from tracking_ip.segments import (
+    complete_orphan, completed_segments, orphaned_segments, read_records, segment_name,
+    segments_config,
+)
+import mmap
+import os
+import time
+
+
+class Command(BaseCommand):
+    """
+    Load the request log segments written with IP_TRACKING_LOG_SINK =
+    'segments' into RequestLog.
+
+    Each segment is memory-mapped and read from the offset recorded in
+    its LogSegment row; every batch of rows is inserted in the same
+    transaction that advances the offset, so the command can be stopped
+    and rerun (e.g. from cron, or until the database is reachable again)
+    without loading a record twice. Open segments whose writer exited
+    (on this node) or that are stale (from another node) are completed
+    first, so nothing is left behind by a crashed process.
+    Run one loader per directory at a time.
+    Usage: python manage.py load_segments [--directory DIR] [--delete]
+    """
+    help = 'Bulk-load request log segment files into the database.'
+
+    def add_arguments(self, parser):
+        config = segments_config()
+        parser.add_argument('--directory', default=config['DIRECTORY'],
+                            help='Segment directory; IP_TRACKING_SEGMENTS DIRECTORY by default.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per INSERT transaction.')
+        parser.add_argument('--stale-after', type=float, default=2 * config['MAX_AGE'] + 60,
+                            help="Complete other nodes' open segments untouched for this many "
+                                 "seconds (their writer died).")
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete segments once they are fully loaded.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive.')
+        self.db = router.db_for_write(RequestLog)
+        started = time.monotonic()
+        total = 0
+        for path in orphaned_segments(options['directory'], options['stale_after']):
+            try:
+                complete_orphan(path)
+            except FileNotFoundError:
+                # Completed by its writer after all, or by another loader.
+                continue
+            self.stdout.write(self.style.WARNING(
+                f'{os.path.basename(path)}: its writer is gone; completed it.'))
+        for path in completed_segments(options['directory']):
+            loaded = self._load(path, options)
+            if loaded:
+                self.stdout.write(f'{os.path.basename(path)}: {loaded:,} records')
+            total += loaded
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {total:,} records in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} records/s).'
+        ))
+
+    def _load(self, path, options):
+        segment, _ = LogSegment.objects.using(self.db).get_or_create(name=segment_name(path))
+        loaded = 0
+        if not segment.completed:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size > segment.offset:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        loaded = self._load_records(segment, data, options['batch_size'])
+            segment.completed = True
+            segment.save(using=self.db, update_fields=['completed', 'updated_at'])
+        if segment.completed and options['delete']:
+            os.remove(path)
+        return loaded
+
+    def _load_records(self, segment, data, batch_size):
+        loaded = 0
+        batch = []
+        end = segment.offset
+        for end, record in read_records(data, segment.offset):
+            batch.append(RequestLog(**record))
+            if len(batch) >= batch_size:
+                loaded += self._commit(segment, batch, end)
+                batch = []
+        if batch:
+            loaded += self._commit(segment, batch, end)
+        return loaded
+
+    def _commit(self, segment, batch, end):
+        # Intern paths and geolocations before the transaction, so the
+        # per-process intern caches remember them across batches.
+        for log in batch:
+            log.resolve_refs()
+        with transaction.atomic(using=self.db):
+            RequestLog.objects.using(self.db).bulk_create(batch)
+            LogSegment.objects.using(self.db).filter(pk=segment.pk).update(
+                offset=end, records=F('records') + len(batch))
+        segment.offset = end
+        return len(batch)
@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.test.utils import override_settings
+from tracking_ip import middleware as tracking_middleware
+from tracking_ip.benchmarks import (
+    clear_intern_caches, create_benchmark_database, write_benchmark_asn_db, write_benchmark_city_db,
+)
+from tracking_ip.models import RequestLog
+from tracking_ip.replay import (
+    ATTACKS, ReactionMonitor, generate_profile, read_trace, replay, summarize_replay, write_trace,
+)
+import geoip2.database
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'replay-traffic',
+    }
+}
+
+# Per-request warnings (404s, rate limits, blocked IPs, flagged IPs) would drown the report.
+QUIET_LOGGERS = ('django.request', 'django.security', 'tracking_ip.middleware', 'tracking_ip.tasks')
+
+
+def redis_commands_processed():
+    """
+    The default cache's Redis server command counter, or None if the cache
+    is not django-redis or the server cannot be reached.
+    """
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection('default').info('stats')['total_commands_processed']
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Replay recorded request traces (NDJSON of ip/path/timestamp), or a
+    seeded traffic profile, through the full WSGI stack with a pool of
+    threads or processes, at recorded or accelerated speed, and report
+    throughput, latency percentiles, database and cache operations, and
+    how quickly anomaly detection and rejections (403/429) reacted to
+    each actor in the traffic.
+
+    Runs against a throwaway SQLite database and a locmem cache unless
+    --database/--cache configured, e.g. to load-test staging Postgres
+    and Redis.
+    Usage: python manage.py replay_traffic --profile mix --speed 10 --workers 8
+           python manage.py replay_traffic --trace traffic.ndjson --pool process
+    """
+    help = 'Replay recorded or generated traffic through the full stack and report how it held up.'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument('--trace', help='NDJSON trace to replay.')
+        source.add_argument('--profile', choices=list(ATTACKS),
+                            help='Generate traffic from a seeded profile (mix by default).')
+        parser.add_argument('--duration', type=float, default=60.0,
+                            help='Recorded seconds of generated traffic.')
+        parser.add_argument('--rate', type=float, default=50.0,
+                            help='Requests per second of ordinary generated traffic.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed for generated traffic.')
+        parser.add_argument('--save-trace', help='Also write the generated traffic to this NDJSON file.')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay speed: 1 at recorded speed, 10 ten times faster, '
+                                 '0 as fast as the workers go.')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent workers.')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Run the workers as threads, or as forked processes.')
+        parser.add_argument('--host', default='localhost',
+                            help='Host header of the replayed requests.')
+        parser.add_argument('--database', choices=['throwaway', 'configured'], default='throwaway',
+                            help="Log into a fresh SQLite file, or the project's configured database.")
+        parser.add_argument('--cache', choices=['locmem', 'configured'], default='locmem',
+                            help="Use a local-memory cache, or the project's configured one.")
+        parser.add_argument('--geoip', choices=['synthetic', 'configured', 'none'],
+                            help='GeoIP2 databases: synthetic ones covering the generated clients '
+                                 '(the default for profiles), the configured ones (the default for '
+                                 'traces), or none.')
+        parser.add_argument('--detect-every', type=float, default=5.0,
+                            help='Seconds between anomaly detection runs during the replay; 0 for none.')
+        parser.add_argument('--block-detected', action='store_true',
+                            help='Blocklist every network as soon as it is flagged.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 0 or options['duration'] <= 0 or options['rate'] <= 0:
+            raise CommandError('--workers, --duration and --rate must be positive.')
+        if options['speed'] < 0 or options['detect_every'] < 0:
+            raise CommandError('--speed and --detect-every must not be negative.')
+        if options['pool'] == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('--pool process needs fork(); use --pool thread on this platform.')
+
+        if options['trace']:
+            try:
+                with open(options['trace']) as trace:
+                    events = read_trace(trace)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read trace '{options['trace']}': {e}")
+            source = options['trace']
+        else:
+            profile = options['profile'] or 'mix'
+            events = generate_profile(profile, options['duration'], options['rate'], options['seed'])
+            source = f'{profile} profile'
+            if options['save_trace']:
+                with open(options['save_trace'], 'w') as trace:
+                    write_trace(events, trace)
+        if not events:
+            raise CommandError('There is no traffic to replay.')
+        geoip = options['geoip'] or ('configured' if options['trace'] else 'synthetic')
+        if options['pool'] == 'process' and options['cache'] == 'locmem':
+            self.stdout.write(self.style.WARNING(
+                'With --pool process and a locmem cache, rate limits and cached lookups are per process.'))
+
+        overrides = {
+            # As in production: DEBUG keeps every query in memory and renders debug error pages.
+            'DEBUG': False,
+            'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, options['host']],
+        }
+        if options['cache'] == 'locmem':
+            overrides['CACHES'] = LOCMEM_CACHES
+        if options['database'] == 'throwaway':
+            # It holds nothing but tracking data; tune it as a dedicated one.
+            overrides['IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT'] = True
+
+        loggers = [logging.getLogger(name) for name in QUIET_LOGGERS]
+        saved_levels = [logger.level for logger in loggers]
+        saved_readers = tracking_middleware._geoip_reader, tracking_middleware._asn_reader
+        with tempfile.TemporaryDirectory() as tmpdir, override_settings(**overrides):
+            readers = []
+            if geoip == 'synthetic':
+                city_path = os.path.join(tmpdir, 'GeoLite2-City.mmdb')
+                asn_path = os.path.join(tmpdir, 'GeoLite2-ASN.mmdb')
+                write_benchmark_city_db(city_path)
+                write_benchmark_asn_db(asn_path)
+                readers = [geoip2.database.Reader(city_path), geoip2.database.Reader(asn_path)]
+                tracking_middleware._geoip_reader, tracking_middleware._asn_reader = readers
+            elif geoip == 'none':
+                tracking_middleware._geoip_reader = tracking_middleware._asn_reader = None
+
+            connection = connections[router.db_for_write(RequestLog)]
+            old_name = None
+            if options['database'] == 'throwaway':
+                old_name = create_benchmark_database(connection, os.path.join(tmpdir, 'replay.sqlite3'))
+            for logger in loggers:
+                logger.setLevel(logging.ERROR)
+            monitor = None
+            if options['detect_every']:
+                monitor = ReactionMonitor(options['detect_every'], block=options['block_detected'])
+            try:
+                redis_before = redis_commands_processed()
+                results, counts, elapsed = replay(
+                    events, options['workers'], options['pool'], options['speed'], options['host'], monitor)
+                redis_after = redis_commands_processed()
+            finally:
+                for logger, level in zip(loggers, saved_levels):
+                    logger.setLevel(level)
+                tracking_middleware._geoip_reader, tracking_middleware._asn_reader = saved_readers
+                for reader in readers:
+                    reader.close()
+                if old_name is not None:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+                    clear_intern_caches()
+
+        if redis_before is not None and redis_after is not None:
+            # Less the second INFO; other clients of the server are included.
+            counts['redis_commands'] = redis_after - redis_before - 1
+        results = summarize_replay(results, counts, elapsed, options['speed'], monitor)
+        results['config'] = {
+            'source': source,
+            'geoip': geoip,
+            **{key: options[key] for key in (
+                'duration', 'rate', 'seed', 'speed', 'workers', 'pool', 'database', 'cache',
+                'detect_every', 'block_detected',
+            )},
+        }
+        self._report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def _report(self, results):
+        config = results['config']
+        speed = config['speed']
+        requests = results['requests']
+        self.stdout.write(
+            f"{requests:,} requests ({config['source']}, speed {speed:g}x, {config['workers']} "
+            f"{config['pool']} workers) in {results['elapsed_s']:.2f}s: "
+            f"{results['throughput_rps']:,.0f} req/s"
+        )
+        latency = results['latency']
+        lag = results['schedule_lag_p99_ms']
+        self.stdout.write(
+            f"latency ms: p50={latency['p50_us'] / 1000:.2f} p90={latency['p90_us'] / 1000:.2f} "
+            f"p99={latency['p99_us'] / 1000:.2f} max={latency['max_us'] / 1000:.2f}"
+            + (f"  schedule lag p99={lag:.1f}" if lag is not None else '')
+        )
+        self.stdout.write('statuses: ' + ' '.join(
+            f'{status}={count:,}' for status, count in results['statuses'].items()))
+        operations = results['operations']
+        line = (f"per request: {operations['db_reads'] / requests:.2f} DB reads, "
+                f"{operations['db_writes'] / requests:.2f} DB writes, "
+                f"{operations['db_other'] / requests:.2f} other statements, "
+                f"{operations['cache_calls'] / requests:.2f} cache calls")
+        if 'redis_commands' in operations:
+            line += f", {operations['redis_commands'] / requests:.2f} Redis commands"
+        self.stdout.write(line)
+
+        self.stdout.write(
+            f"\n{'actor':<22}{'requests':>9}{'rejected':>10}{'networks':>10}{'flagged':>9}"
+            f"{'detected after':>16}{'rejected after':>16}"
+        )
+        for actor, stats in sorted(results['actors'].items()):
+            self.stdout.write(
+                f"{actor:<22}{stats['requests']:>9,}{stats['rejected']:>10,}{stats['networks']:>10,}"
+                f"{stats['flagged_networks']:>9,}{self._seconds(stats['detected_after_s']):>16}"
+                f"{self._seconds(stats['rejected_after_s']):>16}"
+            )
+        if results['detection_runs'] or results['detection_errors']:
+            self.stdout.write(
+                f"Seconds after each actor's first request; anomaly detection ran "
+                f"{results['detection_runs']} times ({results['detection_errors']} failed)"
+                + (f"; times {speed:g}x in recorded time." if speed and speed != 1 else '.')
+            )
+
+    def _seconds(self, value):
+        return '-' if value is None else f'{value:.1f}s'
@@ -1,8 +1,8 @@
 from django.core.management.base import BaseCommand
+from django.http import HttpResponse
 from django.test import RequestFactory
 from tracking_ip.middleware import BasicIPLoggingMiddleware
 from tracking_ip.models import RequestLog
-import time
 
 
 class Command(BaseCommand):
@@ -34,7 +34,7 @@ class Command(BaseCommand):
         ]
 
         factory = RequestFactory()
-        middleware = BasicIPLoggingMiddleware(lambda request: None)
+        middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
 
         self.stdout.write('Testing geolocation with real external IP addresses...\n')
 
@@ -46,7 +46,7 @@ class Command(BaseCommand):
             
             # Process the request through middleware
             try:
-                middleware.process_request(request)
+                middleware(request)
                 
                 # Fetch the created log entry
                 log_entry = RequestLog.objects.filter(ip_address=ip).last()
@@ -75,7 +75,6 @@ class Command(BaseCommand):
                 )
             
             self.stdout.write('')  # Empty line for readability
-            time.sleep(0.5)  # Small delay to avoid overwhelming the GeoIP database
 
         # Summary
         total_logs = RequestLog.objects.count()
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from tracking_ip.heavy_hitters import DIMENSIONS, HeavyHitterTracker
+import time
+
+
+class Command(BaseCommand):
+    """
+    Print the current heavy hitters by IP, subnet and path from the Redis
+    sketches, without querying the database.
+    Usage: python manage.py top_talkers --limit 20 --window 120 [--watch 5]
+    """
+    help = 'Show the busiest client IPs, subnets and paths right now.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dimension', action='append', choices=DIMENSIONS,
+                            help='Dimension to show (repeatable); all by default.')
+        parser.add_argument('--limit', type=int, default=10,
+                            help='Entries per dimension.')
+        parser.add_argument('--window', type=int, default=None,
+                            help='Seconds of history; IP_TRACKING_HEAVY_HITTERS WINDOW by default.')
+        parser.add_argument('--watch', type=float, default=None,
+                            help='Refresh every N seconds until interrupted.')
+
+    def handle(self, *args, **options):
+        tracker = HeavyHitterTracker.from_settings()
+        if tracker is None:
+            raise CommandError('Heavy hitter tracking is disabled or the cache is not Redis.')
+        if options['limit'] <= 0:
+            raise CommandError('--limit must be positive.')
+        while True:
+            self._report(tracker, options)
+            if not options['watch']:
+                return
+            try:
+                time.sleep(options['watch'])
+            except KeyboardInterrupt:
+                return
+
+    def _report(self, tracker, options):
+        window = options['window'] or tracker.window
+        self.stdout.write(f"Top talkers over the last {window}s ({time.strftime('%H:%M:%S')}):")
+        for dimension in options['dimension'] or DIMENSIONS:
+            self.stdout.write(f"\n{dimension:<44}{'requests':>10}")
+            for item, count in tracker.top(dimension, k=options['limit'], window=window):
+                self.stdout.write(f"{item:<44}{count:>10,}")
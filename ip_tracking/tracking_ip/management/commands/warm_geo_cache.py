@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from tracking_ip.warming import claim_cold_cache, mark_cold, recent_clients, warm_geo_cache, warming_config
+import time
+
+
+class Command(BaseCommand):
+    """
+    Load the geolocation cache with the busiest client networks of the
+    last hours, e.g. after a Redis restart or as a post-deploy step.
+    Usage: python manage.py warm_geo_cache --limit 20000 --rate 2000 [--if-cold]
+    """
+    help = 'Preload geolocation cache entries for the busiest recent clients.'
+
+    def add_arguments(self, parser):
+        config = warming_config()
+        parser.add_argument('--limit', type=int, default=config['LIMIT'],
+                            help='Client networks to load.')
+        parser.add_argument('--hours', type=float, default=config['HOURS'],
+                            help='Hours of request logs to rank clients by.')
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='Keys per set_many.')
+        parser.add_argument('--rate', type=float, default=config['RATE'],
+                            help='Maximum keys per second; 0 for no limit.')
+        parser.add_argument('--if-cold', action='store_true',
+                            help='Only warm a cache that was flushed or restarted empty.')
+
+    def handle(self, *args, **options):
+        if options['limit'] <= 0 or options['batch_size'] <= 0 or options['rate'] < 0:
+            raise CommandError('--limit and --batch-size must be positive and --rate not negative.')
+        if options['if_cold'] and not claim_cold_cache():
+            self.stdout.write('Geolocation cache is warm; nothing to do.')
+            return
+        started = time.monotonic()
+        try:
+            clients = recent_clients(options['limit'], options['hours'])
+            ranked = time.monotonic() - started
+            loaded = warm_geo_cache(clients, options['batch_size'], options['rate'])
+        except Exception:
+            if options['if_cold']:
+                mark_cold()
+            raise
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {loaded:,} of {len(clients):,} client networks in {elapsed:.2f}s '
+            f'(ranking {ranked:.2f}s, {loaded / max(elapsed - ranked, 1e-9):,.0f} keys/s).'
+        ))
@@ -0,0 +1,318 @@
+"""
+Low-overhead, in-process metrics for the tracking pipeline, rendered in the
+Prometheus text exposition format. With IP_TRACKING_METRICS_DIR set, each
+process periodically snapshots its metrics into that directory and the
+/metrics view merges the snapshots of all live processes.
+"""
+from django.conf import settings
+from bisect import bisect_left
+import copy
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds; spans cheap in-process stages up to the hourly anomaly scan.
+DEFAULT_BUCKETS = (
+    0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe((time.perf_counter_ns() - self.start) / 1e9)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labels):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return self.name + json.dumps(self.labels, sort_keys=True)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+        self.registry.maybe_flush()
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+        self.registry.maybe_flush()
+
+    def time(self):
+        """
+        Context manager that observes the duration of its block.
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class Registry:
+    """
+    Holds every metric of this process and renders them for Prometheus.
+    """
+    flush_interval = 5.0
+
+    def __init__(self):
+        self.metrics = {}
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labels, **kwargs):
+        metric = cls(self, name, documentation, labels, **kwargs)
+        return self.metrics.setdefault(metric.key, metric)
+
+    def counter(self, name, documentation, **labels):
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, **labels):
+        return self._register(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS, **labels):
+        return self._register(Histogram, name, documentation, labels, buckets=buckets)
+
+    # --- Cross-process aggregation ---
+
+    def metrics_dir(self):
+        return getattr(settings, 'IP_TRACKING_METRICS_DIR', None)
+
+    def snapshot(self):
+        return {key: metric.snapshot() for key, metric in self.metrics.items()}
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            self.flush()
+
+    def flush(self):
+        """
+        Write this process's snapshot into the shared metrics directory.
+        Errors are logged, never raised: flushes happen inside requests.
+        """
+        directory = self.metrics_dir()
+        if not directory:
+            return
+        try:
+            with self._flush_lock:
+                os.makedirs(directory, exist_ok=True)
+                filename = os.path.join(directory, f'metrics-{os.getpid()}.json')
+                # A temporary file of its own, so concurrent writers never share one.
+                with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.metrics-',
+                                                 suffix='.tmp', delete=False) as snapshot_file:
+                    json.dump(self.snapshot(), snapshot_file)
+                try:
+                    os.replace(snapshot_file.name, filename)
+                except OSError:
+                    os.remove(snapshot_file.name)
+                    raise
+        except Exception as e:
+            logger.error(f"Error writing metrics snapshot to {directory}: {e}")
+
+    def collect(self):
+        """
+        Return [(metric, snapshot, pid)] for this process, or for every
+        live process that has written to the shared directory. Snapshots
+        of processes that have exited are deleted.
+        """
+        directory = self.metrics_dir()
+        if not directory:
+            return [(metric, metric.snapshot(), None) for metric in self.metrics.values()]
+        self.flush()
+        samples = []
+        for filename in sorted(glob.glob(os.path.join(directory, 'metrics-*.json'))):
+            pid = os.path.basename(filename)[len('metrics-'):-len('.json')]
+            if not process_alive(pid):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(filename) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            for key, values in snapshot.items():
+                if key in self.metrics:
+                    samples.append((self.metrics[key], values, pid))
+        return samples
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text format (version 0.0.4).
+        Counters and histograms are summed across processes; gauges keep
+        one series per process, labelled with its pid.
+        """
+        merged = {}
+        for metric, values, pid in self.collect():
+            labels = metric.labels
+            if metric.kind == 'gauge' and pid:
+                labels = dict(labels, pid=pid)
+            key = (metric.name, json.dumps(labels, sort_keys=True))
+            if key not in merged:
+                merged[key] = (metric, labels, copy.deepcopy(values))
+                continue
+            total = merged[key][2]
+            if metric.kind == 'histogram':
+                total['sum'] += values['sum']
+                total['counts'] = [a + b for a, b in zip(total['counts'], values['counts'])]
+            else:
+                total['value'] += values['value']
+
+        lines = []
+        described = set()
+        for (name, _), (metric, labels, values) in sorted(merged.items(), key=lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {metric.documentation}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+            if metric.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), values['counts']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{_format_labels(dict(labels, le=le))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {values["sum"]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {values["value"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def process_alive(pid):
+    """
+    Whether process `pid` (an int or numeric string) on this host is running.
+    """
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # Alive, but owned by another user.
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())
+    )
+    return '{' + pairs + '}'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = {
+    stage: REGISTRY.histogram(
+        'tracking_stage_seconds',
+        'Time spent in each stage of the IP tracking middleware.',
+        stage=stage,
+    )
+    for stage in ('ip_extraction', 'block_check', 'geo_cache', 'geoip_lookup',
+                  'heavy_hitters', 'unique_visitors', 'log_write')
+}
+DETECT_ANOMALIES_SECONDS = REGISTRY.histogram(
+    'tracking_detect_anomalies_seconds',
+    'Duration of the detect_anomalies task.',
+)
+GEO_CACHE_REQUESTS = {
+    result: REGISTRY.counter(
+        'tracking_geo_cache_requests_total',
+        'Geolocation cache lookups by result.',
+        result=result,
+    )
+    for result in ('hit', 'miss')
+}
+BLOCKED_REQUESTS = REGISTRY.counter(
+    'tracking_blocked_requests_total',
+    'Requests rejected because the client IP is blocked.',
+)
+LOGGED_REQUESTS = REGISTRY.counter(
+    'tracking_logged_requests_total',
+    'RequestLog rows written.',
+)
+UNLOGGED_REQUESTS = REGISTRY.counter(
+    'tracking_unlogged_requests_total',
+    'Requests not logged because they were excluded or sampled out.',
+)
+LOG_WRITE_FAILURES = REGISTRY.counter(
+    'tracking_log_write_failures_total',
+    'RequestLog writes that raised an error.',
+)
+LOG_WRITES_IN_FLIGHT = REGISTRY.gauge(
+    'tracking_log_writes_in_flight',
+    'RequestLog writes currently in progress (the write backlog).',
+)
+SAMPLING_FACTOR = REGISTRY.gauge(
+    'tracking_sampling_factor',
+    'Current adaptive sampling factor applied to logging rates.',
+)
+SAMPLING_FACTOR.set(1.0)
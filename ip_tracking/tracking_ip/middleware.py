@@ -1,12 +1,19 @@
-from tracking_ip.models import RequestLog, BlockedIP
+from tracking_ip.models import RequestLog, BlockedIP, HttpMethod
+from tracking_ip.sampling import RequestSampler
+from tracking_ip.uniques import UniqueVisitorCounter
+from tracking_ip.heavy_hitters import HeavyHitterTracker
+from tracking_ip.segments import SegmentWriter
+from tracking_ip import metrics
 from django.utils.deprecation import MiddlewareMixin
 from django.http import HttpResponseForbidden
-from ipware import get_client_ip
+from tracking_ip.client import get_client
 import geoip2.database
 from django.conf import settings
 from django.core.cache import cache
+from django.db import DatabaseError
 import logging
 import os
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -25,70 +32,272 @@ except Exception as e:
     logger.error(f"Error initializing GeoIP2 reader: {e}", exc_info=True)
     _geoip_reader = None # Ensure it's None if initialization fails
 
+# Optional GeoLite2-ASN reader; ASN enrichment is skipped without it.
+_asn_reader = None
+try:
+    asn_path = getattr(settings, 'GEOIP_ASN_PATH', None)
+    if asn_path and os.path.exists(asn_path):
+        _asn_reader = geoip2.database.Reader(asn_path)
+    elif asn_path:
+        logger.info("GeoLite2-ASN.mmdb not found. ASN enrichment will be skipped.")
+except Exception as e:
+    logger.error(f"Error initializing GeoIP2 ASN reader: {e}", exc_info=True)
+    _asn_reader = None
+
+
+# Geolocation cache entries, keyed by client network key (or IP).
+GEO_CACHE_TIMEOUT = 86400
+
+# Largest value of a PositiveIntegerField on every backend: durations are
+# capped at about 35 minutes and sizes at 2 GiB.
+MAX_COLUMN_VALUE = 2 ** 31 - 1
+
+
+def geo_cache_key(client):
+    return f"geolocation:{client}"
+
+
+def lookup_ip(ip_address, city_reader, asn_reader=None):
+    """
+    Geolocation of the IP from the given readers, as a dict with 'country'
+    and 'city', plus 'asn' and 'as_org' when an ASN reader is given.
+    Shared by the middleware and geolocate_backfill.
+    """
+    geo_data = {'country': None, 'city': None}
+    if city_reader:
+        try:
+            response = city_reader.city(ip_address)
+            geo_data['country'] = response.country.name
+            geo_data['city'] = response.city.name
+        except geoip2.errors.AddressNotFoundError:
+            logger.debug(f"Geolocation: IP address {ip_address} not found in database.")
+    if asn_reader:
+        geo_data['asn'] = geo_data['as_org'] = None
+        try:
+            response = asn_reader.asn(ip_address)
+            geo_data['asn'] = response.autonomous_system_number
+            geo_data['as_org'] = response.autonomous_system_organization
+        except geoip2.errors.AddressNotFoundError:
+            logger.debug(f"ASN: IP address {ip_address} not found in database.")
+    return geo_data
+
+
+def response_details(request, response, started):
+    """
+    The RequestLog response columns for `response`; `started` is the
+    time.monotonic() at which the view was entered.
+    """
+    size = response.get('Content-Length')
+    if size is None and not response.streaming:
+        size = len(response.content)
+    try:
+        size = min(int(size), MAX_COLUMN_VALUE) if size is not None else None
+    except ValueError:
+        size = None
+    return {
+        'method': HttpMethod.code(request.method),
+        'status': response.status_code,
+        'duration_us': min(int((time.monotonic() - started) * 1_000_000), MAX_COLUMN_VALUE),
+        'response_bytes': size,
+    }
+
 
 class BasicIPLoggingMiddleware(MiddlewareMixin):
     """
     Middleware to log and block IP addresses.
-    Uses django-ipware for IP, geoip2 for location,
+    Uses the request's ClientContext for IP, geoip2 for location,
     and Django cache for caching lookups.
+    Every request is checked against the blocklist, and every blocked one
+    is logged with its 403; of the others, only requests that pass the
+    exclusion and sampling rules are geolocated and logged.
+    The log row is written in the response phase, with the status,
+    method, duration and size of the response.
     """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        # Exclusion/sampling patterns are compiled once, at startup.
+        self.sampler = RequestSampler.from_settings()
+        self.uniques = UniqueVisitorCounter.from_settings()
+        self.heavy_hitters = HeavyHitterTracker.from_settings()
+        # Set when logs go to local segment files instead of the database.
+        self.segments = SegmentWriter.from_settings()
+
     def process_request(self, request):
         """
         Process the request to log IP details and block malicious IPs,
         and geolocate.
         """
-        ip_address, _ = get_client_ip(request)
-        if ip_address is None:
-            ip_address = request.META.get('REMOTE_ADDR', 'unknown')
-            logger.warning(f"Could not determine client IP with ipware, "
-                          f"falling back to REMOTE_ADDR: {ip_address}")
+        with metrics.STAGE_SECONDS['ip_extraction'].time():
+            ip_address = self.get_ip_address(request)
 
-        if ip_address and ip_address != 'unknown':
+        if ip_address:
             # --- IP Blacklisting Logic ---
-            if BlockedIP.objects.filter(ip_address=ip_address).exists():
+            with metrics.STAGE_SECONDS['block_check'].time():
+                blocked = self.is_blocked(ip_address)
+            # Counting, caching and logging are keyed on the client's network,
+            # so rotating through an IPv6 /64 does not look like new clients.
+            client = get_client(request)
+            if blocked:
+                metrics.BLOCKED_REQUESTS.inc()
                 logger.warning(
                     f"Blocked request from blacklisted IP: {ip_address}"
                 )
+                # Every rejection is logged, unsampled and without geolocation,
+                # whatever the exclusion rules, so blocked traffic stays visible.
+                request._tracking_log = (ip_address, {}, 1, client.network_address, time.monotonic())
                 return HttpResponseForbidden("You are blocked.")
 
+            # --- Exclusions and Sampling ---
+            if self.sampler.is_excluded(request):
+                metrics.UNLOGGED_REQUESTS.inc()
+                return None
+            # Top talkers are exact up to the sketch error, so count every request.
+            if self.heavy_hitters is not None:
+                with metrics.STAGE_SECONDS['heavy_hitters'].time():
+                    self.heavy_hitters.offer(client.prefix, request.path)
+            sample_weight = self.sampler.sample_weight(request.path)
+            # Unique visitors are counted for sampled-out requests too;
+            # distinct counts cannot be scaled back up like request counts.
+            if sample_weight is None and self.uniques is None:
+                metrics.UNLOGGED_REQUESTS.inc()
+                return None
+
             # --- Geolocation Logic ---
-            country = None
-            city = None
-            geolocation_cache_key = f"geolocation:{ip_address}"
-            # Try to get geolocation from cache first
-            cached_geo_data = cache.get(geolocation_cache_key)
+            geo = self.geolocate(ip_address, client.prefix)
+
+            if self.uniques is not None:
+                with metrics.STAGE_SECONDS['unique_visitors'].time():
+                    self.count_unique(client.prefix, request.path, geo.get('country'))
+            if sample_weight is None:
+                metrics.UNLOGGED_REQUESTS.inc()
+                return None
 
-            if cached_geo_data:
-                country = cached_geo_data.get('country')
-                city = cached_geo_data.get('city')
-                # logger.debug(f"Geolocation from cache for {ip_address}: {city}, {country}")
-            elif _geoip_reader:
-                try:
-                    # Perform geolocation lookup if not in cache
-                    response = _geoip_reader.city(ip_address)
-                    country = response.country.name
-                    city = response.city.name
-                    # Cache the result for 24 hours (86400 seconds)
-                    cache.set(geolocation_cache_key, {'country': country, 'city': city}, 86400)
-                    # logger.debug(f"Geolocation from GeoIP2 for {ip_address}: {city}, {country}")
-                except geoip2.errors.AddressNotFoundError:
-                    logger.debug(f"Geolocation: IP address {ip_address} not found in database.")
-                except Exception as e:
-                    logger.error(f"Error during GeoIP2 lookup for {ip_address}: {e}", exc_info=True)
-            else:
-                logger.debug(f"Skipping geolocation for {ip_address}: GeoIP2 reader not initialized.")
-            
             # --- Basic IP Logging Logic (from Task 0) ---
-            path = request.path
-            try:
+            # Written in process_response, once the status and duration are known.
+            request._tracking_log = (ip_address, geo, sample_weight, client.network_address,
+                                     time.monotonic())
+        return None
+
+    def process_response(self, request, response):
+        """
+        Write the log row of a tracked request, with its response details.
+        """
+        pending = getattr(request, '_tracking_log', None)
+        if pending is not None:
+            ip_address, geo, sample_weight, network, started = pending
+            del request._tracking_log
+            self.write_log(ip_address, request.path, geo, sample_weight, network,
+                           response_details(request, response, started))
+        return response
+
+    def get_ip_address(self, request):
+        """
+        Resolve the client IP once for the request; views and the rate
+        limiter read the same `request.client`.
+        """
+        ip_address = get_client(request).ip
+        if ip_address is None:
+            logger.warning(f"Could not determine client IP from REMOTE_ADDR "
+                           f"{request.META.get('REMOTE_ADDR')!r}")
+        return ip_address
+
+    def is_blocked(self, ip_address):
+        try:
+            return BlockedIP.objects.filter(ip_address=ip_address).exists()
+        except DatabaseError as e:
+            if self.segments is None:
+                raise
+            # The segment sink is there to keep serving and logging through a
+            # database outage, so the blocklist fails open.
+            logger.error(f"Blocklist unavailable, not blocking {ip_address}: {e}")
+            return False
+
+    def geolocate(self, ip_address, network=None):
+        """
+        Return the geolocation of the IP as a dict with 'country' and 'city',
+        plus 'asn' and 'as_org' when a GeoLite2-ASN database is configured.
+        Both lookups are cached together, under one key per client network
+        (`network`, e.g. '2001:db8::/64') or per IP.
+        """
+        geolocation_cache_key = geo_cache_key(network or ip_address)
+        # Try to get geolocation from cache first
+        with metrics.STAGE_SECONDS['geo_cache'].time():
+            cached_geo_data = cache.get(geolocation_cache_key)
+        metrics.GEO_CACHE_REQUESTS['hit' if cached_geo_data else 'miss'].inc()
+
+        if cached_geo_data:
+            # logger.debug(f"Geolocation from cache for {ip_address}: {cached_geo_data}")
+            return cached_geo_data
+        if not _geoip_reader and not _asn_reader:
+            logger.debug(f"Skipping geolocation for {ip_address}: GeoIP2 reader not initialized.")
+            return {}
+        try:
+            # Perform geolocation lookup if not in cache
+            with metrics.STAGE_SECONDS['geoip_lookup'].time():
+                geo_data = self.lookup(ip_address)
+        except Exception as e:
+            logger.error(f"Error during GeoIP2 lookup for {ip_address}: {e}", exc_info=True)
+            return {}
+        # Cache the result for 24 hours
+        cache.set(geolocation_cache_key, geo_data, GEO_CACHE_TIMEOUT)
+        return geo_data
+
+    def lookup(self, ip_address):
+        """
+        Query the City and ASN databases for the IP.
+        """
+        return lookup_ip(ip_address, _geoip_reader, _asn_reader)
+
+    def count_unique(self, client, path, country):
+        try:
+            self.uniques.add(client, path, country)
+        except Exception as e:
+            # Redis being unavailable must not fail the request.
+            logger.error(f"Error counting unique visitor: {e}")
+
+    def write_log(self, ip_address, path, geo, sample_weight=1, network=None, details=None):
+        """
+        Write one RequestLog row; `details` are the response columns
+        from response_details().
+        """
+        details = details or {}
+        if self.segments is not None:
+            self.append_segment(ip_address, path, geo, sample_weight, network, details)
+            return
+        try:
+            with metrics.STAGE_SECONDS['log_write'].time(), self.sampler.track_write():
                 RequestLog.objects.create(
                     ip_address=ip_address,
+                    client_network=network,
                     path=path,
-                    country=country,
-                    city=city
+                    country=geo.get('country'),
+                    city=geo.get('city'),
+                    asn=geo.get('asn'),
+                    as_organization=geo.get('as_org'),
+                    sample_weight=sample_weight,
+                    **details
                 )
-                # logger.info(f"Logged request: IP={ip_address}, Path={path},
-                # Country={country}, City={city}")
-            except Exception as e:
-                logger.error(f"Error logging request: {e}", exc_info=True)
-        return None
+            metrics.LOGGED_REQUESTS.inc()
+            # logger.info(f"Logged request: IP={ip_address}, Path={path},
+            # Country={country}, City={city}")
+        except Exception as e:
+            metrics.LOG_WRITE_FAILURES.inc()
+            logger.error(f"Error logging request: {e}", exc_info=True)
+
+    def append_segment(self, ip_address, path, geo, sample_weight=1, network=None, details=None):
+        try:
+            with metrics.STAGE_SECONDS['log_write'].time():
+                self.segments.append(
+                    ip_address, path,
+                    network=network,
+                    country=geo.get('country'),
+                    city=geo.get('city'),
+                    asn=geo.get('asn'),
+                    as_org=geo.get('as_org'),
+                    sample_weight=sample_weight,
+                    **(details or {})
+                )
+            metrics.LOGGED_REQUESTS.inc()
+        except Exception as e:
+            metrics.LOG_WRITE_FAILURES.inc()
+            logger.error(f"Error appending request to log segment: {e}", exc_info=True)
@@ -0,0 +1,149 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import tracking_ip.fields
+
+
+def compact_request_logs(apps, schema_editor):
+    """
+    Move existing rows onto the compact layout: pack IPs and intern paths
+    and (country, city) pairs into their dictionary tables.
+    """
+    RequestLog = apps.get_model('tracking_ip', 'RequestLog')
+    RequestPath = apps.get_model('tracking_ip', 'RequestPath')
+    GeoLocation = apps.get_model('tracking_ip', 'GeoLocation')
+    db_alias = schema_editor.connection.alias
+    path_ids = {}
+    geo_ids = {}
+    batch = []
+    for log in RequestLog.objects.using(db_alias).order_by('pk').iterator(chunk_size=2000):
+        path = log.path[:254]
+        if path not in path_ids:
+            path_ids[path] = RequestPath.objects.using(db_alias).get_or_create(path=path)[0].pk
+        log.path_ref_id = path_ids[path]
+        if log.country or log.city:
+            geo = (log.country, log.city)
+            if geo not in geo_ids:
+                geo_ids[geo] = GeoLocation.objects.using(db_alias).get_or_create(
+                    country=log.country, city=log.city)[0].pk
+            log.geo_id = geo_ids[geo]
+        log.ip_packed = log.ip_address
+        batch.append(log)
+        if len(batch) >= 2000:
+            RequestLog.objects.using(db_alias).bulk_update(batch, ['path_ref', 'geo', 'ip_packed'])
+            batch = []
+    if batch:
+        RequestLog.objects.using(db_alias).bulk_update(batch, ['path_ref', 'geo', 'ip_packed'])
+
+
+def expand_request_logs(apps, schema_editor):
+    """
+    Reverse of compact_request_logs: copy values back into the flat columns.
+    """
+    RequestLog = apps.get_model('tracking_ip', 'RequestLog')
+    db_alias = schema_editor.connection.alias
+    batch = []
+    logs = RequestLog.objects.using(db_alias).select_related('path_ref', 'geo').order_by('pk')
+    for log in logs.iterator(chunk_size=2000):
+        log.ip_address = log.ip_packed
+        log.path = log.path_ref.path
+        log.country = log.geo.country if log.geo_id else None
+        log.city = log.geo.city if log.geo_id else None
+        batch.append(log)
+        if len(batch) >= 2000:
+            RequestLog.objects.using(db_alias).bulk_update(batch, ['ip_address', 'path', 'country', 'city'])
+            batch = []
+    if batch:
+        RequestLog.objects.using(db_alias).bulk_update(batch, ['ip_address', 'path', 'country', 'city'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0005_suspiciousip'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeoLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(blank=True, help_text='Country derived from IP geolocation.', max_length=100, null=True, verbose_name='Country')),
+                ('city', models.CharField(blank=True, help_text='City derived from IP geolocation.', max_length=100, null=True, verbose_name='City')),
+            ],
+            options={
+                'verbose_name': 'Geolocation',
+                'verbose_name_plural': 'Geolocations',
+                'unique_together': {('country', 'city')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RequestPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='The path of the requested URL.', max_length=254, unique=True, verbose_name='Request Path')),
+            ],
+            options={
+                'verbose_name': 'Request Path',
+                'verbose_name_plural': 'Request Paths',
+            },
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='ip_packed',
+            field=tracking_ip.fields.PackedIPAddressField(null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='path_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='tracking_ip.requestpath'),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='geo',
+            field=models.ForeignKey(blank=True, help_text='Country and city derived from IP geolocation.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='tracking_ip.geolocation', verbose_name='Geolocation'),
+        ),
+        # Relax the old columns first so the migration can be reversed:
+        # they are re-added empty and only filled by expand_request_logs.
+        migrations.AlterField(
+            model_name='requestlog',
+            name='ip_address',
+            field=models.GenericIPAddressField(help_text='The IP address of the client.', null=True, verbose_name='IP Address'),
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='path',
+            field=models.CharField(help_text='The path of the requested URL.', max_length=254, null=True, verbose_name='Request Path'),
+        ),
+        migrations.RunPython(compact_request_logs, expand_request_logs),
+        migrations.RemoveField(
+            model_name='requestlog',
+            name='ip_address',
+        ),
+        migrations.RemoveField(
+            model_name='requestlog',
+            name='path',
+        ),
+        migrations.RemoveField(
+            model_name='requestlog',
+            name='country',
+        ),
+        migrations.RemoveField(
+            model_name='requestlog',
+            name='city',
+        ),
+        migrations.RenameField(
+            model_name='requestlog',
+            old_name='ip_packed',
+            new_name='ip_address',
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='ip_address',
+            field=tracking_ip.fields.PackedIPAddressField(help_text='The IP address of the client.', verbose_name='IP Address'),
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='path_ref',
+            field=models.ForeignKey(help_text='The path of the requested URL.', on_delete=django.db.models.deletion.PROTECT, related_name='+', to='tracking_ip.requestpath', verbose_name='Request Path'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0006_compact_requestlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='sample_weight',
+            field=models.PositiveIntegerField(default=1, help_text='How many requests this row stands for (1 / sampling rate).', verbose_name='Sample Weight'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0007_requestlog_sample_weight'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['timestamp', 'id'], name='requestlog_time_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='suspiciousip',
+            index=models.Index(fields=['flagged_at', 'id'], name='suspiciousip_time_id_idx'),
+        ),
+    ]
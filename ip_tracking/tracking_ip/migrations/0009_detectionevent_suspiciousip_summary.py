@@ -0,0 +1,178 @@
+from datetime import timedelta
+from django.db import migrations, models
+import re
+
+
+HIGH_TRAFFIC_RE = re.compile(r"Exceeded 100 requests \((\d+)\)")
+SENSITIVE_PATH_RE = re.compile(r"Accessed sensitive path '([^']*)' (\d+) times")
+
+
+def _severity(observed, threshold, base):
+    # Same escalation as tracking_ip.tasks._severity, frozen for this migration.
+    return min(base + (observed >= 3 * threshold) + (observed >= 10 * threshold), 4)
+
+
+def reasons_to_events(apps, schema_editor):
+    """
+    Turn each '; '-joined reason into DetectionEvents and fill in the
+    summary fields. Reasons in an unknown format are dropped.
+    """
+    SuspiciousIP = apps.get_model('tracking_ip', 'SuspiciousIP')
+    DetectionEvent = apps.get_model('tracking_ip', 'DetectionEvent')
+    db_alias = schema_editor.connection.alias
+    suspicious_ips = SuspiciousIP.objects.using(db_alias).order_by('pk')
+    for suspicious_ip in suspicious_ips.iterator(chunk_size=2000):
+        flagged_at = suspicious_ip.flagged_at
+        events = []
+        for reason in (suspicious_ip.reason or '').split('; '):
+            match = HIGH_TRAFFIC_RE.match(reason)
+            if match:
+                count = int(match.group(1))
+                events.append(DetectionEvent(
+                    ip_address=suspicious_ip.ip_address, rule='high_traffic',
+                    observed_count=count, severity=_severity(count, 100, 1),
+                    window_start=flagged_at - timedelta(hours=1), window_end=flagged_at,
+                ))
+                continue
+            match = SENSITIVE_PATH_RE.match(reason)
+            if match:
+                count = int(match.group(2))
+                events.append(DetectionEvent(
+                    ip_address=suspicious_ip.ip_address, rule='sensitive_path',
+                    target=match.group(1), observed_count=count,
+                    severity=_severity(count, 5, 2),
+                    window_start=flagged_at - timedelta(hours=1), window_end=flagged_at,
+                ))
+        DetectionEvent.objects.using(db_alias).bulk_create(events)
+        # detected_at is auto_now_add; backdate the migrated events.
+        DetectionEvent.objects.using(db_alias).filter(
+            ip_address=suspicious_ip.ip_address).update(detected_at=flagged_at)
+        suspicious_ip.score = sum(event.severity for event in events)
+        suspicious_ip.max_severity = max([1] + [event.severity for event in events])
+        suspicious_ip.event_count = len(events)
+        suspicious_ip.last_rule = events[-1].rule if events else ''
+        suspicious_ip.last_seen = flagged_at
+        suspicious_ip.save(update_fields=[
+            'score', 'max_severity', 'event_count', 'last_rule', 'last_seen'])
+
+
+def events_to_reasons(apps, schema_editor):
+    """
+    Reverse of reasons_to_events: rebuild the reason text from the events.
+    """
+    SuspiciousIP = apps.get_model('tracking_ip', 'SuspiciousIP')
+    DetectionEvent = apps.get_model('tracking_ip', 'DetectionEvent')
+    db_alias = schema_editor.connection.alias
+    reasons = {}
+    events = DetectionEvent.objects.using(db_alias).order_by('detected_at', 'pk')
+    for event in events.iterator(chunk_size=2000):
+        if event.rule == 'sensitive_path':
+            reason = (f"Accessed sensitive path '{event.target}' "
+                      f"{event.observed_count} times in the last hour.")
+        else:
+            reason = f"Exceeded 100 requests ({event.observed_count}) in the last hour."
+        ip_reasons = reasons.setdefault(event.ip_address, [])
+        if reason not in ip_reasons:
+            ip_reasons.append(reason)
+    batch = []
+    for suspicious_ip in SuspiciousIP.objects.using(db_alias).order_by('pk').iterator(chunk_size=2000):
+        suspicious_ip.reason = '; '.join(reasons.get(suspicious_ip.ip_address, []))
+        batch.append(suspicious_ip)
+    SuspiciousIP.objects.using(db_alias).bulk_update(batch, ['reason'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0008_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='The IP address the rule fired for.', verbose_name='IP Address')),
+                ('rule', models.CharField(choices=[('high_traffic', 'High traffic'), ('sensitive_path', 'Sensitive path access')], help_text='Code of the detection rule that fired.', max_length=32)),
+                ('target', models.CharField(blank=True, default='', help_text='What the rule matched on, e.g. the sensitive path prefix.', max_length=254)),
+                ('window_start', models.DateTimeField(help_text='Start of the evaluated window.')),
+                ('window_end', models.DateTimeField(help_text='End of the evaluated window.')),
+                ('observed_count', models.PositiveIntegerField(help_text='Estimated number of matching requests in the window.')),
+                ('severity', models.PositiveSmallIntegerField(choices=[(1, 'Low'), (2, 'Medium'), (3, 'High'), (4, 'Critical')])),
+                ('detected_at', models.DateTimeField(auto_now_add=True, verbose_name='Detected At')),
+            ],
+            options={
+                'verbose_name': 'Detection Event',
+                'verbose_name_plural': 'Detection Events',
+                'ordering': ['-detected_at'],
+                'indexes': [
+                    models.Index(fields=['ip_address', 'detected_at'], name='detection_ip_time_idx'),
+                    models.Index(fields=['detected_at', 'severity'], name='detection_time_sev_idx'),
+                    models.Index(fields=['rule', 'detected_at'], name='detection_rule_time_idx'),
+                ],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='suspiciousip',
+            name='suspiciousip_time_id_idx',
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='score',
+            field=models.PositiveIntegerField(default=0, help_text='Sum of the severities of all detection events for this IP.'),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='max_severity',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Low'), (2, 'Medium'), (3, 'High'), (4, 'Critical')], default=1, verbose_name='Max Severity'),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='event_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Events'),
+        ),
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='last_rule',
+            field=models.CharField(blank=True, choices=[('high_traffic', 'High traffic'), ('sensitive_path', 'Sensitive path access')], max_length=32, verbose_name='Last Rule'),
+        ),
+        # Nullable until the data migration has filled it in.
+        migrations.AddField(
+            model_name='suspiciousip',
+            name='last_seen',
+            field=models.DateTimeField(null=True),
+        ),
+        # Nullable so the migration can be reversed with rows present.
+        migrations.AlterField(
+            model_name='suspiciousip',
+            name='reason',
+            field=models.TextField(null=True, verbose_name='Reason for Flagging'),
+        ),
+        migrations.RunPython(reasons_to_events, events_to_reasons),
+        migrations.RemoveField(
+            model_name='suspiciousip',
+            name='reason',
+        ),
+        migrations.AlterField(
+            model_name='suspiciousip',
+            name='last_seen',
+            field=models.DateTimeField(help_text='The time of the latest detection event for this IP.', verbose_name='Last Seen'),
+        ),
+        migrations.AlterField(
+            model_name='suspiciousip',
+            name='flagged_at',
+            field=models.DateTimeField(auto_now_add=True, help_text='The time the IP was first flagged.', verbose_name='Flagged At'),
+        ),
+        migrations.AlterModelOptions(
+            name='suspiciousip',
+            options={'ordering': ['-last_seen'], 'verbose_name': 'Suspicious IP', 'verbose_name_plural': 'Suspicious IPs'},
+        ),
+        migrations.AddIndex(
+            model_name='suspiciousip',
+            index=models.Index(fields=['last_seen', 'id'], name='suspiciousip_seen_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='suspiciousip',
+            index=models.Index(fields=['last_seen', 'score'], name='suspiciousip_seen_score_idx'),
+        ),
+    ]
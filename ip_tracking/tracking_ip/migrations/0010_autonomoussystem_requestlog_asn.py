@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0009_detectionevent_suspiciousip_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AutonomousSystem',
+            fields=[
+                ('number', models.PositiveIntegerField(primary_key=True, serialize=False, verbose_name='AS Number')),
+                ('organization', models.CharField(blank=True, help_text='Organization (ISP, hosting provider) that operates the AS.', max_length=254, null=True, verbose_name='Organization')),
+            ],
+            options={
+                'verbose_name': 'Autonomous System',
+                'verbose_name_plural': 'Autonomous Systems',
+            },
+        ),
+        migrations.AlterField(
+            model_name='detectionevent',
+            name='rule',
+            field=models.CharField(choices=[('high_traffic', 'High traffic'), ('sensitive_path', 'Sensitive path access'), ('asn_traffic', 'High traffic from one network (ASN)')], help_text='Code of the detection rule that fired.', max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='suspiciousip',
+            name='last_rule',
+            field=models.CharField(blank=True, choices=[('high_traffic', 'High traffic'), ('sensitive_path', 'Sensitive path access'), ('asn_traffic', 'High traffic from one network (ASN)')], max_length=32, verbose_name='Last Rule'),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='autonomous_system',
+            field=models.ForeignKey(blank=True, help_text='AS number and organization derived from GeoLite2-ASN.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='tracking_ip.autonomoussystem', verbose_name='Autonomous System'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:24
+
+import tracking_ip.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0010_autonomoussystem_requestlog_asn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='client_network',
+            field=tracking_ip.fields.PackedIPAddressField(help_text="Address of the client's aggregation network (its /64 for IPv6, the IP itself for IPv4 by default).", null=True, verbose_name='Client Network'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['client_network', 'timestamp'], name='requestlog_net_time_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:26
+
+from django.db import migrations, models
+
+
+def categorize_existing_rows(apps, schema_editor):
+    """
+    Categorize the interned paths (a small table) with the current
+    IP_TRACKING_PATH_CATEGORIES, then tag the log rows with one UPDATE
+    per category, matched on path_ref_id.
+    """
+    from tracking_ip.categories import UNCATEGORIZED, PathCategorizer
+
+    RequestPath = apps.get_model('tracking_ip', 'RequestPath')
+    RequestLog = apps.get_model('tracking_ip', 'RequestLog')
+    db_alias = schema_editor.connection.alias
+    categorizer = PathCategorizer.from_settings()
+    path_ids = {}
+    for path_id, path in RequestPath.objects.using(db_alias).values_list('pk', 'path').iterator():
+        category = categorizer.categorize(path)
+        if category != UNCATEGORIZED:
+            path_ids.setdefault(category, []).append(path_id)
+    for category, ids in path_ids.items():
+        for start in range(0, len(ids), 500):
+            RequestLog.objects.using(db_alias).filter(
+                path_ref_id__in=ids[start:start + 500]).update(category=category)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0011_requestlog_client_network'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='category',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Id of the IP_TRACKING_PATH_CATEGORIES entry whose prefix the path matched (0: none). Set when the row is written.', verbose_name='Path Category'),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['category', 'timestamp'], name='requestlog_cat_time_idx'),
+        ),
+        migrations.RunPython(categorize_existing_rows, migrations.RunPython.noop),
+    ]
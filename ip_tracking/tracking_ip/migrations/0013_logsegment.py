@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0012_requestlog_category'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Segment file name, without its .seg / .seg.open suffix.', max_length=254, unique=True)),
+                ('offset', models.PositiveBigIntegerField(default=0, help_text='Bytes of the segment loaded into RequestLog.')),
+                ('records', models.PositiveIntegerField(default=0, help_text='Records loaded from the segment.')),
+                ('completed', models.BooleanField(default=False, help_text='The whole (closed) segment is loaded.')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Log Segment',
+                'verbose_name_plural': 'Log Segments',
+            },
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, help_text='The time the request was made.', verbose_name='Timestamp'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0013_logsegment'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['ip_address', 'timestamp', 'id'], name='requestlog_ip_time_idx'),
+        ),
+    ]
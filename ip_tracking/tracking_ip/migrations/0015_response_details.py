@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking_ip', '0014_requestlog_ip_time_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='duration_us',
+            field=models.PositiveIntegerField(help_text="Time from the end of the tracking middleware's request phase to its response phase, i.e. the view and the middleware below it.", null=True, verbose_name='Duration (µs)'),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='method',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'GET'), (2, 'HEAD'), (3, 'POST'), (4, 'PUT'), (5, 'PATCH'), (6, 'DELETE'), (7, 'OPTIONS'), (8, 'Other')], null=True, verbose_name='Method'),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='response_bytes',
+            field=models.PositiveIntegerField(help_text='Response body size in bytes (unknown for streamed responses).', null=True, verbose_name='Response Size'),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='status',
+            field=models.PositiveSmallIntegerField(help_text='HTTP status code of the response.', null=True, verbose_name='Status'),
+        ),
+        migrations.CreateModel(
+            name='LatencyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(help_text='Start of the hour (UTC).')),
+                ('bucket', models.PositiveSmallIntegerField(help_text='Latency bucket index.')),
+                ('requests', models.PositiveBigIntegerField(help_text='Estimated requests (sum of sample weights) in the bucket.')),
+                ('path_ref', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='tracking_ip.requestpath', verbose_name='Request Path')),
+            ],
+            options={
+                'verbose_name': 'Latency Rollup',
+                'verbose_name_plural': 'Latency Rollups',
+                'unique_together': {('hour', 'path_ref', 'bucket')},
+            },
+        ),
+    ]
@@ -1,49 +1,478 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .categories import get_categorizer
+from .fields import PackedIPAddressField
 
-class RequestLog(models.Model):
+class InternManager(models.Manager):
     """
-    Model to log details of incoming requests.
+    Manager for small dictionary tables (paths, geo values).
+    Maps a value to its primary key, memoizing the mapping per process so
+    the hot logging path does not hit the database for known values.
+    """
+    cache_size = 10000
+
+    def __init__(self):
+        super().__init__()
+        self._ids = {}
+
+    def intern(self, defaults=None, **values):
+        """
+        Return the primary key for `values`, creating the row (with
+        `defaults`) if needed.
+        """
+        key = tuple(sorted(values.items()))
+        pk = self._ids.get(key)
+        if pk is not None:
+            return pk
+        pk = self.get_or_create(defaults=defaults, **values)[0].pk
+        # Only remember ids that are committed; a rolled back insert must not
+        # leave a dangling id behind in the process-wide cache.
+        transaction.on_commit(lambda: self._remember(key, pk),
+                              using=router.db_for_write(self.model))
+        return pk
+
+    def _remember(self, key, pk):
+        if len(self._ids) >= self.cache_size:
+            self._ids.clear()
+        self._ids[key] = pk
+
+    def clear_cache(self):
+        self._ids.clear()
+
+
+class RequestPath(models.Model):
+    """
+    Interned request path, referenced by RequestLog rows.
     """
-    ip_address = models.GenericIPAddressField(
-        verbose_name="IP Address",
-        help_text="The IP address of the client."
-    )
-    timestamp = models.DateTimeField(
-        auto_now_add=True,
-        verbose_name="Timestamp",
-        help_text="The time the request was made."
-    )
     path = models.CharField(
         max_length=254,
+        unique=True,
         verbose_name="Request Path",
         help_text="The path of the requested URL."
     )
 
+    objects = InternManager()
+
+    class Meta:
+        verbose_name = "Request Path"
+        verbose_name_plural = "Request Paths"
+
+    def __str__(self):
+        return self.path
+
+
+class GeoLocation(models.Model):
+    """
+    Dictionary-encoded (country, city) pair, referenced by RequestLog rows.
+    """
     country = models.CharField(
         max_length=100,
-        blank=True, # Allow empty, as geolocation might fail or not be available
+        blank=True,
         null=True,
         verbose_name="Country",
         help_text="Country derived from IP geolocation."
     )
     city = models.CharField(
         max_length=100,
-        blank=True, # Allow empty
+        blank=True,
         null=True,
         verbose_name="City",
         help_text="City derived from IP geolocation."
     )
 
+    objects = InternManager()
+
+    class Meta:
+        verbose_name = "Geolocation"
+        verbose_name_plural = "Geolocations"
+        unique_together = ('country', 'city')
+
+    def __str__(self):
+        return ", ".join(value for value in (self.city, self.country) if value)
+
+
+class AutonomousSystem(models.Model):
+    """
+    Autonomous system from GeoLite2-ASN, keyed by its AS number so that
+    RequestLog rows store the number itself.
+    """
+    number = models.PositiveIntegerField(
+        primary_key=True,
+        verbose_name="AS Number"
+    )
+    organization = models.CharField(
+        max_length=254,
+        blank=True,
+        null=True,
+        verbose_name="Organization",
+        help_text="Organization (ISP, hosting provider) that operates the AS."
+    )
+
+    objects = InternManager()
+
+    class Meta:
+        verbose_name = "Autonomous System"
+        verbose_name_plural = "Autonomous Systems"
+
+    def __str__(self):
+        return f"AS{self.number} {self.organization or ''}".rstrip()
+
+
+class HttpMethod(models.IntegerChoices):
+    """
+    Request methods, stored as a small integer in RequestLog.method.
+    """
+    GET = 1, 'GET'
+    HEAD = 2, 'HEAD'
+    POST = 3, 'POST'
+    PUT = 4, 'PUT'
+    PATCH = 5, 'PATCH'
+    DELETE = 6, 'DELETE'
+    OPTIONS = 7, 'OPTIONS'
+    OTHER = 8, 'Other'
+
+    @classmethod
+    def code(cls, method):
+        return cls.__members__.get(method, cls.OTHER)
+
+
+# Old RequestLog column names and where they live in the compact layout.
+_COMPAT_FIELDS = {
+    'path': 'path_ref__path',
+    'country': 'geo__country',
+    'city': 'geo__city',
+    'asn': 'autonomous_system',
+    'as_organization': 'autonomous_system__organization',
+}
+
+
+def _compat_lookup(name):
+    """
+    Translate a lookup on an old column name ('path__startswith',
+    '-country') into the normalized one ('path_ref__path__startswith').
+    """
+    prefix = '-' if name.startswith('-') else ''
+    field, sep, rest = name.lstrip('-').partition('__')
+    if field in _COMPAT_FIELDS:
+        return prefix + _COMPAT_FIELDS[field] + sep + rest
+    return name
+
+
+def _compat_q(q):
+    """
+    Copy of the Q object `q` with old column names translated, nested Q
+    objects included.
+    """
+    translated = q.copy()
+    translated.children = [
+        _compat_q(child) if isinstance(child, Q) else (_compat_lookup(child[0]), child[1])
+        for child in q.children
+    ]
+    return translated
+
+
+class RequestLogQuerySet(models.QuerySet):
+    """
+    QuerySet that accepts the old flat column names (path, country, city)
+    in filters (keyword arguments and Q objects), ordering and values(),
+    so existing callers keep working against the normalized storage layout.
+    """
+    def filter(self, *args, **kwargs):
+        return super().filter(*self._compat_args(args), **self._compat_kwargs(kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return super().exclude(*self._compat_args(args), **self._compat_kwargs(kwargs))
+
+    def order_by(self, *field_names):
+        return super().order_by(*(_compat_lookup(name) for name in field_names))
+
+    def values(self, *fields, **expressions):
+        for name in fields:
+            if name in _COMPAT_FIELDS:
+                expressions[name] = F(_COMPAT_FIELDS[name])
+        fields = [name for name in fields if name not in _COMPAT_FIELDS]
+        return super().values(*fields, **expressions)
+
+    def values_list(self, *fields, **kwargs):
+        fields = [F(_COMPAT_FIELDS[name]) if name in _COMPAT_FIELDS else name
+                  for name in fields]
+        return super().values_list(*fields, **kwargs)
+
+    def with_network(self):
+        """
+        Annotate rows with `network`, their client network key (the /64 for
+        IPv6), so counts are per network and address rotation does not
+        dilute them. Rows logged before client_network was recorded count per IP.
+        """
+        return self.annotate(network=Coalesce(
+            'client_network', 'ip_address', output_field=PackedIPAddressField()))
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.resolve_refs()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    @staticmethod
+    def _compat_args(args):
+        return [_compat_q(arg) if isinstance(arg, Q) else arg for arg in args]
+
+    @staticmethod
+    def _compat_kwargs(kwargs):
+        return {_compat_lookup(name): value for name, value in kwargs.items()}
+
+
+class RequestLogManager(models.Manager.from_queryset(RequestLogQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().select_related('path_ref', 'geo', 'autonomous_system')
+
+
+class RequestLog(models.Model):
+    """
+    Model to log details of incoming requests.
+    Stored compactly: the IP is a 16-byte binary column and the path and
+    geolocation are references into interned dictionary tables. The old
+    `path`, `country` and `city` attributes are still available.
+    """
+    ip_address = PackedIPAddressField(
+        verbose_name="IP Address",
+        help_text="The IP address of the client."
+    )
+    timestamp = models.DateTimeField(
+        default=timezone.now, # Not auto_now_add: rows loaded from segments keep their time
+        editable=False,
+        verbose_name="Timestamp",
+        help_text="The time the request was made."
+    )
+    client_network = PackedIPAddressField(
+        null=True, # Rows logged before networks were recorded
+        verbose_name="Client Network",
+        help_text="Address of the client's aggregation network (its /64 for IPv6, "
+                  "the IP itself for IPv4 by default)."
+    )
+    path_ref = models.ForeignKey(
+        RequestPath,
+        on_delete=models.PROTECT,
+        related_name='+',
+        verbose_name="Request Path",
+        help_text="The path of the requested URL."
+    )
+    category = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name="Path Category",
+        help_text="Id of the IP_TRACKING_PATH_CATEGORIES entry whose prefix the path "
+                  "matched (0: none). Set when the row is written."
+    )
+    geo = models.ForeignKey(
+        GeoLocation,
+        on_delete=models.PROTECT,
+        related_name='+',
+        blank=True, # Allow empty, as geolocation might fail or not be available
+        null=True,
+        verbose_name="Geolocation",
+        help_text="Country and city derived from IP geolocation."
+    )
+    autonomous_system = models.ForeignKey(
+        AutonomousSystem,
+        on_delete=models.PROTECT,
+        related_name='+',
+        blank=True, # Only set when a GeoLite2-ASN database is configured
+        null=True,
+        verbose_name="Autonomous System",
+        help_text="AS number and organization derived from GeoLite2-ASN."
+    )
+    sample_weight = models.PositiveIntegerField(
+        default=1,
+        verbose_name="Sample Weight",
+        help_text="How many requests this row stands for (1 / sampling rate)."
+    )
+    # Response details; null on rows logged before they were recorded.
+    method = models.PositiveSmallIntegerField(
+        choices=HttpMethod.choices,
+        null=True,
+        verbose_name="Method"
+    )
+    status = models.PositiveSmallIntegerField(
+        null=True,
+        verbose_name="Status",
+        help_text="HTTP status code of the response."
+    )
+    duration_us = models.PositiveIntegerField(
+        null=True,
+        verbose_name="Duration (µs)",
+        help_text="Time from the end of the tracking middleware's request phase "
+                  "to its response phase, i.e. the view and the middleware below it."
+    )
+    response_bytes = models.PositiveIntegerField(
+        null=True,
+        verbose_name="Response Size",
+        help_text="Response body size in bytes (unknown for streamed responses)."
+    )
+
+    objects = RequestLogManager()
+
     class Meta:
         verbose_name = "Request Log"
         verbose_name_plural = "Request Logs"
         ordering = ['-timestamp']
+        indexes = [
+            # Keyset pagination over (timestamp, id), newest first
+            models.Index(fields=['timestamp', 'id'], name='requestlog_time_id_idx'),
+            # Per-IP history, newest first (/api/logs/?ip=)
+            models.Index(fields=['ip_address', 'timestamp', 'id'], name='requestlog_ip_time_idx'),
+            # Per-network history and counts
+            models.Index(fields=['client_network', 'timestamp'], name='requestlog_net_time_idx'),
+            # Sensitive-path rules and per-category stats
+            models.Index(fields=['category', 'timestamp'], name='requestlog_cat_time_idx'),
+        ]
+
+    @property
+    def path(self):
+        if hasattr(self, '_path'):
+            return self._path
+        return self.path_ref.path
+
+    @path.setter
+    def path(self, value):
+        self._path = value
+
+    @property
+    def country(self):
+        if hasattr(self, '_geo'):
+            return self._geo[0]
+        return self.geo.country if self.geo_id else None
+
+    @country.setter
+    def country(self, value):
+        self._geo = (value, self.city)
+
+    @property
+    def city(self):
+        if hasattr(self, '_geo'):
+            return self._geo[1]
+        return self.geo.city if self.geo_id else None
+
+    @city.setter
+    def city(self, value):
+        self._geo = (self.country, value)
+
+    @property
+    def asn(self):
+        if hasattr(self, '_asn'):
+            return self._asn[0]
+        return self.autonomous_system_id
+
+    @asn.setter
+    def asn(self, value):
+        self._asn = (value, self.as_organization)
+
+    @property
+    def as_organization(self):
+        if hasattr(self, '_asn'):
+            return self._asn[1]
+        return self.autonomous_system.organization if self.autonomous_system_id else None
+
+    @as_organization.setter
+    def as_organization(self, value):
+        self._asn = (self.asn, value)
+
+    def resolve_refs(self):
+        """
+        Intern pending path/geo values into their dictionary tables, and
+        categorize a new path.
+        """
+        if hasattr(self, '_path'):
+            self.path_ref_id = RequestPath.objects.intern(path=self._path[:254])
+            self.category = get_categorizer().categorize(self._path)
+            del self._path
+        if hasattr(self, '_geo'):
+            country, city = self._geo
+            if country or city:
+                self.geo_id = GeoLocation.objects.intern(country=country, city=city)
+            else:
+                self.geo_id = None
+            del self._geo
+        if hasattr(self, '_asn'):
+            number, organization = self._asn
+            if number is not None:
+                self.autonomous_system_id = AutonomousSystem.objects.intern(
+                    number=number, defaults={'organization': organization})
+            else:
+                self.autonomous_system_id = None
+            del self._asn
+
+    def save(self, *args, **kwargs):
+        self.resolve_refs()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         geo_info = f" ({self.city}, {self.country})" if self.city or self.country else ""
         return f"[{self.timestamp.strftime('%Y-%m-%d %H:%M:%S')}] {self.ip_address}{geo_info} - {self.path}"
 
 
+class LatencyRollup(models.Model):
+    """
+    Weighted request counts per hour, path and latency bucket, written by
+    the rollup_latency task. Percentiles for any period are computed from
+    these rows instead of scanning RequestLog. Bucket k holds durations in
+    [LATENCY_BUCKET_GROWTH^k, LATENCY_BUCKET_GROWTH^(k+1)) microseconds.
+    """
+    hour = models.DateTimeField(help_text="Start of the hour (UTC).")
+    path_ref = models.ForeignKey(
+        RequestPath,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name="Request Path"
+    )
+    bucket = models.PositiveSmallIntegerField(help_text="Latency bucket index.")
+    requests = models.PositiveBigIntegerField(
+        help_text="Estimated requests (sum of sample weights) in the bucket."
+    )
+
+    class Meta:
+        verbose_name = "Latency Rollup"
+        verbose_name_plural = "Latency Rollups"
+        unique_together = ('hour', 'path_ref', 'bucket')
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} {self.path_ref_id}/{self.bucket}: {self.requests}"
+
+
+class LogSegment(models.Model):
+    """
+    How far load_segments got through one segment file of the segment
+    sink. Advanced in the same transaction as the rows it loads, so
+    loading can be interrupted and repeated without duplicates.
+    """
+    name = models.CharField(
+        max_length=254,
+        unique=True,
+        help_text="Segment file name, without its .seg / .seg.open suffix."
+    )
+    offset = models.PositiveBigIntegerField(
+        default=0,
+        help_text="Bytes of the segment loaded into RequestLog."
+    )
+    records = models.PositiveIntegerField(
+        default=0,
+        help_text="Records loaded from the segment."
+    )
+    completed = models.BooleanField(
+        default=False,
+        help_text="The whole (closed) segment is loaded."
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Updated At")
+
+    class Meta:
+        verbose_name = "Log Segment"
+        verbose_name_plural = "Log Segments"
+
+    def __str__(self):
+        return f"{self.name} ({self.records} records)"
+
+
 class BlockedIP(models.Model):
     """
     Model to store IP addresses that should be blocked.
@@ -68,30 +497,117 @@ class BlockedIP(models.Model):
         return self.ip_address
 
 
+class Severity(models.IntegerChoices):
+    LOW = 1, 'Low'
+    MEDIUM = 2, 'Medium'
+    HIGH = 3, 'High'
+    CRITICAL = 4, 'Critical'
+
+
+class DetectionRule(models.TextChoices):
+    HIGH_TRAFFIC = 'high_traffic', 'High traffic'
+    SENSITIVE_PATH = 'sensitive_path', 'Sensitive path access'
+    ASN_TRAFFIC = 'asn_traffic', 'High traffic from one network (ASN)'
+
+
+class DetectionEvent(models.Model):
+    """
+    Append-only record of one detection rule firing for one IP over one
+    time window. SuspiciousIP holds the per-IP summary of these events.
+    """
+    ip_address = models.GenericIPAddressField(
+        verbose_name="IP Address",
+        help_text="The IP address the rule fired for."
+    )
+    rule = models.CharField(
+        max_length=32,
+        choices=DetectionRule.choices,
+        help_text="Code of the detection rule that fired."
+    )
+    target = models.CharField(
+        max_length=254,
+        blank=True,
+        default='',
+        help_text="What the rule matched on, e.g. the sensitive path prefix."
+    )
+    window_start = models.DateTimeField(help_text="Start of the evaluated window.")
+    window_end = models.DateTimeField(help_text="End of the evaluated window.")
+    observed_count = models.PositiveIntegerField(
+        help_text="Estimated number of matching requests in the window."
+    )
+    severity = models.PositiveSmallIntegerField(choices=Severity.choices)
+    detected_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name="Detected At"
+    )
+
+    class Meta:
+        verbose_name = "Detection Event"
+        verbose_name_plural = "Detection Events"
+        ordering = ['-detected_at']
+        indexes = [
+            models.Index(fields=['ip_address', 'detected_at'], name='detection_ip_time_idx'),
+            models.Index(fields=['detected_at', 'severity'], name='detection_time_sev_idx'),
+            models.Index(fields=['rule', 'detected_at'], name='detection_rule_time_idx'),
+        ]
+
+    @property
+    def description(self):
+        if self.rule == DetectionRule.SENSITIVE_PATH:
+            return f"Accessed sensitive path '{self.target}' {self.observed_count} times."
+        if self.rule == DetectionRule.ASN_TRAFFIC:
+            return f"Sent {self.observed_count} requests from {self.target}, a network over its threshold."
+        return f"Exceeded the request threshold ({self.observed_count} requests)."
+
+    def __str__(self):
+        return f"{self.ip_address} - {self.get_rule_display()} ({self.get_severity_display()})"
+
+
 class SuspiciousIP(models.Model):
     """
-    Model to store IP addresses flagged as suspicious.
+    Per-IP summary of DetectionEvents, updated incrementally by
+    detect_anomalies: every event adds its severity to `score`.
     """
     ip_address = models.GenericIPAddressField(
         unique=True,
         verbose_name="Suspicious IP Address",
         help_text="The IP address flagged as suspicious."
     )
-    reason = models.TextField(
-        verbose_name="Reason for Flagging",
-        help_text="Why this IP was flagged as suspicious."
+    score = models.PositiveIntegerField(
+        default=0,
+        help_text="Sum of the severities of all detection events for this IP."
+    )
+    max_severity = models.PositiveSmallIntegerField(
+        choices=Severity.choices,
+        default=Severity.LOW,
+        verbose_name="Max Severity"
+    )
+    event_count = models.PositiveIntegerField(default=0, verbose_name="Events")
+    last_rule = models.CharField(
+        max_length=32,
+        choices=DetectionRule.choices,
+        blank=True,
+        verbose_name="Last Rule"
     )
     flagged_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name="Flagged At",
-        help_text="The time the IP was flagged."
+        help_text="The time the IP was first flagged."
+    )
+    last_seen = models.DateTimeField(
+        verbose_name="Last Seen",
+        help_text="The time of the latest detection event for this IP."
     )
-    # You could add more fields like 'is_blocked' or 'severity'
 
     class Meta:
         verbose_name = "Suspicious IP"
         verbose_name_plural = "Suspicious IPs"
-        ordering = ['-flagged_at']
+        ordering = ['-last_seen']
+        indexes = [
+            models.Index(fields=['last_seen', 'id'], name='suspiciousip_seen_id_idx'),
+            # "Top offenders seen since ..." range scans
+            models.Index(fields=['last_seen', 'score'], name='suspiciousip_seen_score_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.ip_address} - {self.reason}"
+        return f"{self.ip_address} - score {self.score}"
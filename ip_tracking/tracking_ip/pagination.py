@@ -0,0 +1,112 @@
+"""
+Pagination helpers for very large tables: cheap row-count estimates and
+keyset (cursor) pagination over a (timestamp, pk) ordering.
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+import base64
+import json
+
+
+def estimate_row_count(model, using='default'):
+    """
+    Estimate the number of rows in `model`'s table without COUNT(*).
+    Uses planner statistics where the backend keeps them, otherwise the
+    span of primary keys (an upper bound for append-mostly tables).
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+            row = cursor.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                return row[0]
+    bounds = model._default_manager.using(using).aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['high'] is None:
+        return 0
+    return bounds['high'] - bounds['low'] + 1
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never runs an unbounded COUNT(*). Unfiltered querysets
+    use estimate_row_count(); filtered ones count at most `count_limit`
+    rows. `is_estimate` tells whether `count` is exact.
+    """
+    count_limit = 10000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_estimate = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            self.is_estimate = True
+            return estimate_row_count(queryset.model, using=queryset.db)
+        limited = queryset.order_by()[:self.count_limit + 1].count()
+        self.is_estimate = limited > self.count_limit
+        return min(limited, self.count_limit)
+
+
+def encode_cursor(timestamp, pk):
+    """
+    Opaque cursor for the row at (timestamp, pk).
+    """
+    raw = json.dumps([timestamp.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return (timestamp, pk) for a cursor; raise ValueError if it is invalid.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        timestamp = parse_datetime(timestamp)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if timestamp is None or not isinstance(pk, int):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return timestamp, pk
+
+
+def keyset_queryset(queryset, time_field, cursor=None):
+    """
+    `queryset` ordered newest first on (time_field, pk) and starting after
+    `cursor`. The seek predicate is served by an index on (time_field, id),
+    so every page costs the same no matter how deep it is.
+    """
+    queryset = queryset.order_by(f'-{time_field}', '-pk')
+    if cursor is not None:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f'{time_field}__lt': timestamp}) |
+            Q(**{time_field: timestamp, 'pk__lt': pk})
+        )
+    return queryset
+
+
+def keyset_page(queryset, time_field, cursor=None, size=100):
+    """
+    Return (rows, next_cursor) for the page after `cursor`, newest first.
+    """
+    rows = list(keyset_queryset(queryset, time_field, cursor)[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, time_field), last.pk)
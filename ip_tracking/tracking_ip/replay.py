@@ -0,0 +1,452 @@
+"""
+Replay of recorded or generated traffic through the project's full WSGI
+stack (every middleware, URL routing, the views, rate limits), for
+end-to-end throughput tests of the tracking pipeline under load.
+
+Traces are NDJSON, one request per line:
+    {"timestamp": 1700000000.25, "ip": "192.0.2.1", "path": "/login/",
+     "method": "POST", "actor": "credential_stuffing"}
+`timestamp` is seconds since the epoch or an ISO 8601 string; `method`
+(GET) and `actor` ('recorded') are optional. Actors group requests in
+the report, e.g. to see how quickly an attack was detected.
+
+Seeded profiles generate such traces: ordinary visitors (Poisson
+arrivals, Zipf-distributed clients), optionally joined after a quarter
+of the run by a flood from one client, credential stuffing from a
+botnet, or a crawler walking the site.
+
+Requests are dealt out round-robin to a pool of threads or forked
+processes, each of which sends its share at the recorded offsets
+(scaled by the replay speed) and counts the database queries and cache
+calls its requests make. A ReactionMonitor runs the anomaly detection
+task alongside, as Celery beat would.
+"""
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+from django.utils import timezone
+from tracking_ip.benchmarks import ip_pool, percentile, summarize, zipf_ips
+from tracking_ip.client import ClientContext, parse_address
+from tracking_ip.models import BlockedIP, DetectionEvent
+from tracking_ip.tasks import detect_anomalies
+from urllib.parse import unquote_to_bytes
+import io
+import ipaddress
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TraceEvent = namedtuple('TraceEvent', 'offset ip path method actor')
+
+# (path, weight) of ordinary visitors' requests.
+NORMAL_PATHS = [
+    ('/', 50),
+    ('/index/', 15),
+    ('/api/test/', 15),
+    ('/login/', 5),
+    ('/static/app.css', 15),
+]
+
+FLOOD_IP = '203.0.113.66'
+BOTNET = ipaddress.ip_network('198.51.100.0/24')
+BOTNET_HOSTS = 64
+CRAWLER_IP = '192.0.2.80'
+
+# A fixed CSRF secret, sent as both the cookie and the header: replayed
+# POSTs look like a client that fetched the form first.
+CSRF_TOKEN = 'replaytrafficcsrftoken0123456789'
+FORM_BODY = b'username=replay&password=replay'
+USER_AGENT = 'tracking-ip-replay/1.0'
+
+REJECTED_STATUSES = (403, 429)
+WRITE_VERBS = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+CACHE_OPERATIONS = ('get', 'set', 'add', 'delete', 'get_many', 'set_many',
+                    'delete_many', 'incr', 'decr', 'touch', 'has_key')
+
+# Lets the pool start up before the first request is due.
+START_DELAY = 0.25
+
+# The WSGI application, created before the pool starts: threads share it
+# like a threaded server does, forked workers inherit it.
+_handler = None
+
+
+# --- Traces ---
+
+def _parse_timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt_timezone.utc)
+    return when.timestamp()
+
+
+def read_trace(lines):
+    """
+    TraceEvents, in time order, from NDJSON `lines`; offsets are seconds
+    after the first request. Raises ValueError for an invalid line.
+    """
+    records = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+            ip = str(ipaddress.ip_address(item['ip']))
+            path = item['path']
+            if not isinstance(path, str) or not path.startswith('/'):
+                raise ValueError(f"path {path!r} is not absolute")
+            when = _parse_timestamp(item['timestamp'])
+            method = str(item.get('method') or 'GET').upper()
+            actor = str(item.get('actor') or 'recorded')
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Line {number}: invalid trace record ({e})")
+        records.append((when, ip, path, method, actor))
+    records.sort(key=lambda record: record[0])
+    if not records:
+        return []
+    first = records[0][0]
+    return [TraceEvent(when - first, ip, path, method, actor) for when, ip, path, method, actor in records]
+
+
+def write_trace(events, output, start=None):
+    """
+    Write `events` to the text file `output` as NDJSON, with timestamps
+    counted from `start` (now by default).
+    """
+    start = time.time() if start is None else start
+    for event in events:
+        output.write(json.dumps({
+            'timestamp': round(start + event.offset, 6),
+            'ip': event.ip,
+            'path': event.path,
+            'method': event.method,
+            'actor': event.actor,
+        }) + '\n')
+
+
+# --- Seeded profiles ---
+
+def _arrivals(rng, rate, start, end):
+    """
+    Poisson arrival times at `rate` per second between `start` and `end`.
+    """
+    when = start
+    while True:
+        when += rng.expovariate(rate)
+        if when >= end:
+            return
+        yield when
+
+
+def _normal(rng, duration, rate, pool_size):
+    times = list(_arrivals(rng, rate, 0.0, duration))
+    ips = zipf_ips(ip_pool(pool_size, 0.8, rng), len(times), rng)
+    paths = rng.choices([path for path, _ in NORMAL_PATHS],
+                        weights=[weight for _, weight in NORMAL_PATHS], k=len(times))
+    return [TraceEvent(when, ip, path, 'GET', 'normal') for when, ip, path in zip(times, ips, paths)]
+
+
+def _flood(rng, start, duration, rate):
+    # One client at five times the rate of all ordinary visitors together.
+    return [TraceEvent(when, FLOOD_IP, '/', 'GET', 'flood')
+            for when in _arrivals(rng, 5 * rate, start, duration)]
+
+
+def _credential_stuffing(rng, start, duration, rate):
+    # Login attempts spread over a botnet, so each host stays slow.
+    return [TraceEvent(when, str(BOTNET[rng.randrange(1, BOTNET_HOSTS + 1)]), '/login/', 'POST', 'credential_stuffing')
+            for when in _arrivals(rng, rate, start, duration)]
+
+
+def _crawler(rng, start, duration, rate):
+    # A steady walk over many distinct, mostly unknown, paths.
+    interval = 1.0 / max(rate / 5, 1.0)
+    count = int((duration - start) / interval)
+    return [TraceEvent(start + index * interval, CRAWLER_IP, f'/api/items/{index}/', 'GET', 'crawler')
+            for index in range(count)]
+
+
+ATTACKS = {
+    'normal': (),
+    'flood': (_flood,),
+    'credential_stuffing': (_credential_stuffing,),
+    'crawler': (_crawler,),
+    'mix': (_flood, _credential_stuffing, _crawler),
+}
+
+
+def generate_profile(profile, duration=60.0, rate=50.0, seed=0, pool_size=2000):
+    """
+    TraceEvents for `duration` seconds of the named profile: ordinary
+    visitors at `rate` requests per second, joined by the profile's
+    attackers after the first quarter of the run.
+    """
+    if profile not in ATTACKS:
+        raise ValueError(f"Unknown profile '{profile}'")
+    rng = random.Random(seed)
+    events = _normal(rng, duration, rate, pool_size)
+    for attack in ATTACKS[profile]:
+        events.extend(attack(rng, duration / 4, duration, rate))
+    events.sort(key=lambda event: event.offset)
+    return events
+
+
+# --- Replay ---
+
+def wsgi_environ(event, host, multiprocess=False):
+    """
+    The WSGI environ of one replayed request.
+    """
+    path, _, query = event.path.partition('?')
+    body = b''
+    environ = {
+        'REQUEST_METHOD': event.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('iso-8859-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': host,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': host,
+        'HTTP_USER_AGENT': USER_AGENT,
+        'REMOTE_ADDR': event.ip,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': not multiprocess,
+        'wsgi.multiprocess': multiprocess,
+        'wsgi.run_once': False,
+    }
+    if event.method in ('POST', 'PUT', 'PATCH'):
+        body = FORM_BODY
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        environ['HTTP_COOKIE'] = f'{settings.CSRF_COOKIE_NAME}={CSRF_TOKEN}'
+        environ[settings.CSRF_HEADER_NAME] = CSRF_TOKEN
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ['wsgi.input'] = io.BytesIO(body)
+    return environ
+
+
+def _send(event, host, multiprocess):
+    """
+    Send one request through the WSGI application; returns its status.
+    """
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(int(status_line.split(' ', 1)[0]))
+
+    response = _handler(wsgi_environ(event, host, multiprocess), start_response)
+    try:
+        # Drain the body, as a server would.
+        for _ in response:
+            pass
+    finally:
+        response.close()
+    return status[0]
+
+
+def _counted(method, counts):
+    def wrapper(*args, **kwargs):
+        counts['cache_calls'] += 1
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def _replay_share(events, start_at, speed, host, multiprocess):
+    """
+    Send `events` in order, each at its offset (divided by `speed`; all at
+    once for 0) after `start_at`, a time.time(). Returns ([(actor, ip,
+    sent, lag, status, latency ns)], {operation: count}); `sent` and `lag`
+    are in seconds, after `start_at` and after the request was due.
+    """
+    counts = {'db_reads': 0, 'db_writes': 0, 'db_other': 0, 'cache_calls': 0}
+
+    def count_query(execute, sql, params, many, context):
+        verb = sql.lstrip()[:6].upper()
+        if verb == 'SELECT':
+            counts['db_reads'] += 1
+        elif verb in WRITE_VERBS:
+            counts['db_writes'] += 1
+        else:
+            # Transaction control and connection setup.
+            counts['db_other'] += 1
+        return execute(sql, params, many, context)
+
+    results = []
+    with ExitStack() as stack:
+        # Connections and cache backends are per thread: these are this worker's own.
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(count_query))
+        for alias in settings.CACHES:
+            backend = caches[alias]
+            for name in CACHE_OPERATIONS:
+                setattr(backend, name, _counted(getattr(backend, name), counts))
+        try:
+            for event in events:
+                due = start_at + (event.offset / speed if speed else 0.0)
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                sent = time.time()
+                began = time.perf_counter_ns()
+                status = _send(event, host, multiprocess)
+                latency = time.perf_counter_ns() - began
+                results.append((event.actor, event.ip, sent - start_at,
+                                max(sent - due, 0.0) if speed else 0.0, status, latency))
+        finally:
+            connections.close_all()
+    return results, counts
+
+
+def replay(events, workers=4, pool='thread', speed=1.0, host='localhost', monitor=None):
+    """
+    Replay `events` through the project's WSGI application with `workers`
+    threads, or forked processes with pool='process'. Returns (results,
+    {operation: count}, elapsed seconds); see _replay_share.
+    `monitor`, a ReactionMonitor, runs for the duration of the replay.
+    """
+    global _handler
+    _handler = WSGIHandler()
+    multiprocess = pool == 'process'
+    if multiprocess:
+        # Workers are forked, so they inherit settings overrides and the
+        # GeoIP readers; they must not share the parent's connections.
+        connections.close_all()
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = ThreadPoolExecutor(workers, thread_name_prefix='replay')
+    start_at = time.time() + START_DELAY
+    with executor:
+        futures = [executor.submit(_replay_share, events[index::workers], start_at, speed, host, multiprocess)
+                   for index in range(workers)]
+        # Started after the fork, so no worker inherits its thread.
+        if monitor is not None:
+            monitor.start(start_at)
+        try:
+            outcomes = [future.result() for future in futures]
+        finally:
+            if monitor is not None:
+                monitor.stop()
+    elapsed = time.time() - start_at
+    results = []
+    counts = Counter()
+    for share_results, share_counts in outcomes:
+        results.extend(share_results)
+        counts.update(share_counts)
+    return results, dict(counts), elapsed
+
+
+class ReactionMonitor:
+    """
+    Runs the anomaly detection task every `interval` seconds during a
+    replay, as Celery beat would, and records when each client network
+    was first flagged. With `block`, flagged networks are added to the
+    blocklist right away, like an operator running block_ip on every
+    detection, which shows how quickly blocking takes effect.
+    """
+
+    def __init__(self, interval, block=False):
+        self.interval = interval
+        self.block = block
+        # Network address -> seconds after the start of the replay.
+        self.flagged = {}
+        self.runs = 0
+        self.errors = 0
+        self.start_at = self.since = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, start_at):
+        self.start_at = start_at
+        self.since = timezone.now()
+        self._thread = threading.Thread(target=self._run, name='replay-detection', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                self.check()
+        finally:
+            connections.close_all()
+
+    def check(self):
+        """
+        Run detection once and record (and block) newly flagged networks.
+        """
+        try:
+            detect_anomalies()
+            self.runs += 1
+            found = set(DetectionEvent.objects.filter(detected_at__gte=self.since)
+                        .values_list('ip_address', flat=True).distinct()) - set(self.flagged)
+            elapsed = time.time() - self.start_at
+            for network in found:
+                self.flagged[network] = elapsed
+            if self.block and found:
+                BlockedIP.objects.bulk_create([BlockedIP(ip_address=network) for network in found],
+                                              ignore_conflicts=True)
+        except Exception as e:
+            # Detection failing under load is a finding, not a reason to stop the replay.
+            self.errors += 1
+            logger.error(f"Error running anomaly detection during replay: {e}")
+
+
+def summarize_replay(results, counts, elapsed, speed, monitor=None):
+    """
+    Throughput, latency, status and operation counts of a replay, and
+    per actor how quickly detection and rejections (403/429) set in,
+    in seconds after the actor's first request.
+    """
+    requests = len(results)
+    latencies = [result[5] for result in results]
+    lags = sorted(result[3] for result in results)
+    flagged = monitor.flagged if monitor is not None else {}
+    actors = {}
+    for actor, ip, sent, _, status, _ in sorted(results, key=lambda result: result[2]):
+        stats = actors.get(actor)
+        if stats is None:
+            stats = actors[actor] = {'requests': 0, 'rejected': 0, 'first_request_s': sent,
+                                     'rejected_after_s': None, 'networks': set()}
+        stats['requests'] += 1
+        stats['networks'].add(ClientContext(parse_address(ip)).network_address)
+        if status in REJECTED_STATUSES:
+            stats['rejected'] += 1
+            if stats['rejected_after_s'] is None:
+                stats['rejected_after_s'] = sent - stats['first_request_s']
+    for stats in actors.values():
+        networks = stats.pop('networks')
+        detected = [flagged[network] for network in networks if network in flagged]
+        stats['networks'] = len(networks)
+        stats['flagged_networks'] = len(detected)
+        stats['detected_after_s'] = min(detected) - stats['first_request_s'] if detected else None
+    return {
+        'requests': requests,
+        'elapsed_s': elapsed,
+        'throughput_rps': requests / elapsed if elapsed > 0 else 0.0,
+        'latency': summarize(latencies),
+        'schedule_lag_p99_ms': percentile(lags, 0.99) * 1000 if speed else None,
+        'statuses': {str(status): count for status, count in sorted(Counter(r[4] for r in results).items())},
+        'operations': counts,
+        'detection_runs': monitor.runs if monitor is not None else 0,
+        'detection_errors': monitor.errors if monitor is not None else 0,
+        'actors': actors,
+    }
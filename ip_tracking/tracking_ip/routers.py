@@ -0,0 +1,143 @@
+"""
+Database routing for tracking_ip: the tracking tables may live on their
+own database (IP_TRACKING_DATABASE), and analytical reads may go to a
+read replica of it; everything else stays on the primary.
+
+Reads are only sent to the replica inside a `replica_reads(max_lag)`
+block, so each call site states how much replication lag it tolerates.
+Outside such blocks (the middleware, read-modify-write code, the admin
+change forms) every read hits the primary.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from .database import tracking_database
+import contextvars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Largest lag the current block accepts, in seconds; None means primary only.
+_max_lag = contextvars.ContextVar('tracking_ip_replica_max_lag', default=None)
+
+# The blocklist is the source of truth for enforcement; never read it stale.
+PRIMARY_ONLY_MODELS = {'blockedip'}
+
+_measured_lag = {}
+LAG_CHECK_INTERVAL = 5.0
+
+
+@contextmanager
+def replica_reads(max_lag):
+    """
+    Allow tracking_ip reads in this block to use the replica, as long as
+    its replication lag is at most `max_lag` seconds.
+    """
+    token = _max_lag.set(max_lag)
+    try:
+        yield
+    finally:
+        _max_lag.reset(token)
+
+
+def replica_lag(alias):
+    """
+    Replication lag of `alias` in seconds. Measured on PostgreSQL standbys
+    (at most every LAG_CHECK_INTERVAL seconds), otherwise the declared
+    IP_TRACKING_REPLICA_LAG_SECONDS.
+    """
+    declared = getattr(settings, 'IP_TRACKING_REPLICA_LAG_SECONDS', 5.0)
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return declared
+    checked_at, lag = _measured_lag.get(alias, (0.0, declared))
+    now = time.monotonic()
+    if now - checked_at < LAG_CHECK_INTERVAL:
+        return lag
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+            )
+            lag = float(cursor.fetchone()[0])
+    except Exception as e:
+        # An unreachable replica counts as infinitely behind.
+        logger.warning(f"Could not measure replication lag of '{alias}': {e}")
+        lag = float('inf')
+    _measured_lag[alias] = (now, lag)
+    return lag
+
+
+def replica_alias(max_lag):
+    """
+    The replica alias if one is configured and within `max_lag`, else None.
+    """
+    alias = getattr(settings, 'IP_TRACKING_READ_REPLICA', None)
+    if not alias or alias == tracking_database():
+        return None
+    if replica_lag(alias) > max_lag:
+        return None
+    return alias
+
+
+class TrackingReplicaRouter:
+    """
+    Sends tracking_ip reads inside replica_reads() blocks to the replica
+    (IP_TRACKING_READ_REPLICA). Everything else falls through to
+    TrackingDatabaseRouter.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'tracking_ip' or model._meta.model_name in PRIMARY_ONLY_MODELS:
+            return None
+        max_lag = _max_lag.get()
+        if max_lag is None:
+            return None
+        return replica_alias(max_lag)
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary.
+        replica = getattr(settings, 'IP_TRACKING_READ_REPLICA', None)
+        databases = {tracking_database(), replica}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+class TrackingDatabaseRouter:
+    """
+    Keeps the tracking_ip tables on IP_TRACKING_DATABASE, so log inserts
+    do not compete with auth, session and admin writes for the same
+    SQLite write lock. With the default alias this router changes nothing.
+    """
+
+    def _is_tracking(self, model):
+        return model._meta.app_label == 'tracking_ip'
+
+    def db_for_read(self, model, **hints):
+        return tracking_database() if self._is_tracking(model) else None
+
+    def db_for_write(self, model, **hints):
+        return tracking_database() if self._is_tracking(model) else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self._is_tracking(obj1) and self._is_tracking(obj2):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = tracking_database()
+        if alias == DEFAULT_DB_ALIAS or db == getattr(settings, 'IP_TRACKING_READ_REPLICA', None):
+            return None
+        if app_label == 'tracking_ip':
+            return db == alias
+        if db == alias:
+            return False
+        return None
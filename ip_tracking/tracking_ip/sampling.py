@@ -0,0 +1,139 @@
+from django.conf import settings
+from tracking_ip import metrics
+from contextlib import contextmanager
+import math
+import random
+import re
+import threading
+import time
+
+
+class AdaptiveThrottle:
+    """
+    Scales the logging rate down while log writes are slow or piling up,
+    and back up once they recover. Adjusts at most once per `interval`.
+    """
+    def __init__(self, latency_threshold_ms=50, backlog_threshold=8,
+                 min_factor=0.01, interval=1.0, alpha=0.2):
+        self.latency_threshold = latency_threshold_ms / 1000.0
+        self.backlog_threshold = backlog_threshold
+        self.min_factor = min_factor
+        self.interval = interval
+        self.alpha = alpha
+        self.factor = 1.0
+        self.latency = 0.0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._last_adjust = time.monotonic()
+
+    @contextmanager
+    def track_write(self):
+        """
+        Wrap a log write to feed its latency and concurrency into the throttle.
+        """
+        with self._lock:
+            self.in_flight += 1
+            backlog = self.in_flight
+            metrics.LOG_WRITES_IN_FLIGHT.set(backlog)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.latency += self.alpha * (elapsed - self.latency)
+                self._adjust(backlog)
+                metrics.LOG_WRITES_IN_FLIGHT.set(self.in_flight)
+                metrics.SAMPLING_FACTOR.set(self.factor)
+
+    def _adjust(self, backlog):
+        now = time.monotonic()
+        if now - self._last_adjust < self.interval:
+            return
+        self._last_adjust = now
+        if self.latency > self.latency_threshold or backlog > self.backlog_threshold:
+            self.factor = max(self.min_factor, self.factor * 0.5)
+        elif self.factor < 1.0:
+            self.factor = min(1.0, self.factor * 1.25)
+
+
+class RequestSampler:
+    """
+    Decides whether a request gets a RequestLog row, and with what weight.
+    Exclusion and per-route rate patterns are compiled once at startup.
+    A logged row carries `sample_weight` = 1/rate, so summing weights
+    estimates the real request count.
+    """
+    def __init__(self, exclude_paths=(), exclude_methods=(), route_rates=(),
+                 default_rate=1.0, adaptive=None):
+        self.exclude_re = re.compile('|'.join(f'(?:{p})' for p in exclude_paths)) \
+            if exclude_paths else None
+        self.exclude_methods = frozenset(m.upper() for m in exclude_methods)
+        self.route_rates = [rate for _, rate in route_rates]
+        self.route_re = re.compile('|'.join(
+            f'(?P<r{i}>{pattern})' for i, (pattern, _) in enumerate(route_rates)
+        )) if route_rates else None
+        self.default_rate = default_rate
+        self.throttle = AdaptiveThrottle(**adaptive) if adaptive is not None else None
+
+    @classmethod
+    def from_settings(cls):
+        adaptive = getattr(settings, 'IP_TRACKING_ADAPTIVE_SAMPLING', None)
+        if adaptive is not None:
+            adaptive = {key.lower(): value for key, value in adaptive.items()}
+            if not adaptive.pop('enabled', True):
+                adaptive = None
+        return cls(
+            exclude_paths=getattr(settings, 'IP_TRACKING_EXCLUDE_PATHS', ()),
+            exclude_methods=getattr(settings, 'IP_TRACKING_EXCLUDE_METHODS', ()),
+            route_rates=getattr(settings, 'IP_TRACKING_SAMPLE_RATES', ()),
+            default_rate=getattr(settings, 'IP_TRACKING_DEFAULT_SAMPLE_RATE', 1.0),
+            adaptive=adaptive,
+        )
+
+    def rate_for(self, path):
+        if self.route_re is not None:
+            match = self.route_re.match(path)
+            if match:
+                return self.route_rates[int(match.lastgroup[1:])]
+        return self.default_rate
+
+    def is_excluded(self, request):
+        if request.method in self.exclude_methods:
+            return True
+        return self.exclude_re is not None and self.exclude_re.match(request.path) is not None
+
+    def weight_for(self, request):
+        """
+        Return the sample weight for `request`, or None if it is not logged.
+        """
+        if self.is_excluded(request):
+            return None
+        return self.sample_weight(request.path)
+
+    def sample_weight(self, path):
+        """
+        Draw the sample weight for a request to `path` that is not excluded,
+        or None if it is sampled out.
+        """
+        rate = self.rate_for(path)
+        if self.throttle is not None:
+            rate *= self.throttle.factor
+        if rate >= 1.0:
+            return 1
+        if rate <= 0.0:
+            return None
+        # Quantize to 1/n so the stored integer weight is exact.
+        weight = math.ceil(1.0 / rate)
+        if random.random() * weight >= 1.0:
+            return None
+        return weight
+
+    @contextmanager
+    def track_write(self):
+        if self.throttle is None:
+            yield
+        else:
+            with self.throttle.track_write():
+                yield
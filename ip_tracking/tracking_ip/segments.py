@@ -0,0 +1,326 @@
+"""
+Append-only local segment files for request logs, for nodes that cannot
+rely on reaching the database (IP_TRACKING_LOG_SINK = 'segments').
+
+The middleware appends one length-prefixed, CRC-checked record per logged
+request to an in-memory buffer, which costs a few microseconds. A
+background thread writes the buffer out and fsyncs it every
+FSYNC_INTERVAL seconds (group commit), so a crash loses at most that
+interval. Each process writes its own segment, named
+'<node>-<pid>-<start ms>-<seq>.seg.open' while open; it is renamed to
+'.seg' once it reaches SEGMENT_BYTES or MAX_AGE seconds, and is then
+ready for `manage.py load_segments`. Open segments whose writer exited
+without completing them are renamed by the loader (see orphaned_segments).
+
+Records carry the path and geolocation values themselves rather than
+ids: ids only exist in the database, which the node may not reach.
+
+Record layout (little-endian): a header of payload length and CRC-32,
+then the payload: packed IP (16 bytes), packed client network (16 zero
+bytes if none), timestamp in microseconds since the epoch, sample weight,
+AS number (0 if none), method and status codes (0 if unknown), duration
+in microseconds and response size (2^32 - 1 if unknown), and path,
+country, city and AS organization as 2-byte length-prefixed UTF-8
+strings (empty if none).
+"""
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from tracking_ip.fields import pack_ip, unpack_ip
+from tracking_ip.metrics import process_alive
+import atexit
+import itertools
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<II')
+FIXED = struct.Struct('<16s16sqIIBHII')
+STRING_LENGTH = struct.Struct('<H')
+NO_NETWORK = bytes(16)
+# Stored for unknown durations and sizes; 0 stands for an unknown method or status.
+UNKNOWN_U32 = 2 ** 32 - 1
+
+OPEN_SUFFIX = '.seg.open'
+COMPLETE_SUFFIX = '.seg'
+
+_start_lock = threading.Lock()
+# Shared by every writer of the process, so two writers opening segments
+# in the same millisecond never pick the same name.
+_segment_seq = itertools.count(1)
+
+DEFAULT_SEGMENTS = {
+    'DIRECTORY': 'segments',
+    'SEGMENT_BYTES': 64 * 1024 * 1024,
+    'MAX_AGE': 300,
+    'FSYNC_INTERVAL': 1.0,
+}
+
+
+def segments_config():
+    """
+    IP_TRACKING_SEGMENTS over the defaults.
+    """
+    return {**DEFAULT_SEGMENTS, **(getattr(settings, 'IP_TRACKING_SEGMENTS', None) or {})}
+
+
+def _encode_string(value):
+    data = value.encode('utf-8') if value else b''
+    if len(data) > 0xFFFF:
+        # Cut on a character boundary, so the record still decodes.
+        data = data[:0xFFFF].decode('utf-8', 'ignore').encode('utf-8')
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def _unknown_if_none(value):
+    return UNKNOWN_U32 if value is None else value
+
+
+def encode_record(ip, path, timestamp, network=None, country=None, city=None,
+                  asn=None, as_org=None, sample_weight=1, method=None, status=None,
+                  duration_us=None, response_bytes=None):
+    """
+    One record, header included. `timestamp` is seconds since the epoch.
+    """
+    payload = FIXED.pack(
+        pack_ip(ip), pack_ip(network) if network else NO_NETWORK,
+        int(timestamp * 1_000_000), sample_weight, asn or 0,
+        method or 0, status or 0, _unknown_if_none(duration_us), _unknown_if_none(response_bytes),
+    ) + _encode_string(path) + _encode_string(country) + _encode_string(city) + _encode_string(as_org)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(payload):
+    (ip, network, micros, sample_weight, asn,
+     method, status, duration_us, response_bytes) = FIXED.unpack_from(payload)
+    strings = []
+    offset = FIXED.size
+    for _ in range(4):
+        (length,) = STRING_LENGTH.unpack_from(payload, offset)
+        offset += STRING_LENGTH.size
+        # 'replace': records cut mid-character by older writers must not stall the loader.
+        strings.append(bytes(payload[offset:offset + length]).decode('utf-8', 'replace') or None)
+        offset += length
+    path, country, city, as_org = strings
+    return {
+        'ip_address': unpack_ip(ip),
+        'client_network': unpack_ip(network) if network != NO_NETWORK else None,
+        'timestamp': datetime.fromtimestamp(micros / 1_000_000, tz=dt_timezone.utc),
+        'sample_weight': sample_weight,
+        'asn': asn or None,
+        'path': path or '',
+        'country': country,
+        'city': city,
+        'as_organization': as_org,
+        'method': method or None,
+        'status': status or None,
+        'duration_us': None if duration_us == UNKNOWN_U32 else duration_us,
+        'response_bytes': None if response_bytes == UNKNOWN_U32 else response_bytes,
+    }
+
+
+def read_records(buffer, offset=0):
+    """
+    Yield (end offset, record) for the records of `buffer` (bytes or an
+    mmap) from `offset`. Stops at a truncated or corrupt record, such as
+    the unsynced tail of a segment whose writer crashed.
+    """
+    view = memoryview(buffer)
+    try:
+        while offset + HEADER.size <= len(view):
+            length, crc = HEADER.unpack_from(view, offset)
+            start = offset + HEADER.size
+            end = start + length
+            if end > len(view) or zlib.crc32(view[start:end]) != crc:
+                logger.warning(f"Segment data is truncated or corrupt at offset {offset}; "
+                               f"ignoring the rest.")
+                return
+            yield end, decode_record(view[start:end])
+            offset = end
+    finally:
+        view.release()
+
+
+class SegmentWriter:
+    """
+    Buffers records in memory and group-commits them to this process's
+    open segment from a background thread.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, max_age=300,
+                 fsync_interval=1.0, node=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.node = node or socket.gethostname()
+        self._pid = None
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Writer for IP_TRACKING_SEGMENTS, or None unless IP_TRACKING_LOG_SINK
+        is 'segments'.
+        """
+        if getattr(settings, 'IP_TRACKING_LOG_SINK', 'database') != 'segments':
+            return None
+        config = segments_config()
+        return cls(
+            config['DIRECTORY'],
+            segment_bytes=config['SEGMENT_BYTES'],
+            max_age=config['MAX_AGE'],
+            fsync_interval=config['FSYNC_INTERVAL'],
+        )
+
+    def _start(self):
+        """
+        (Re)initialize per-process state. Runs on first use in every
+        process, so a writer created before a fork is safe in the workers.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = bytearray()
+        self._file = None
+        self._stop = threading.Event()
+        os.makedirs(self.directory, exist_ok=True)
+        thread = threading.Thread(target=self._run, name='tracking-segment-writer', daemon=True)
+        thread.start()
+        atexit.register(self.close)
+
+    # --- Writes ---
+
+    def append(self, ip, path, timestamp=None, **values):
+        """
+        Queue one record; it is on disk after the next group commit.
+        """
+        record = encode_record(ip, path, time.time() if timestamp is None else timestamp, **values)
+        if self._pid != os.getpid():
+            with _start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        with self._lock:
+            self._buffer += record
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # The records of this interval are lost; requests are unaffected.
+                logger.error(f"Error writing request log segment: {e}")
+
+    def flush(self):
+        """
+        Write out and fsync the buffered records, then close the segment
+        if it is full or old enough.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._flush_lock:
+            with self._lock:
+                data, self._buffer = self._buffer, bytearray()
+            if data:
+                if self._file is None:
+                    self._open()
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._size += len(data)
+            if self._file is not None and (
+                    self._size >= self.segment_bytes
+                    or time.monotonic() - self._opened_at >= self.max_age):
+                self._complete()
+
+    def close(self):
+        """
+        Flush and complete the open segment, e.g. at shutdown.
+        """
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self.flush()
+        with self._flush_lock:
+            if self._file is not None:
+                self._complete()
+
+    def _open(self):
+        name = f'{self.node}-{self._pid}-{int(time.time() * 1000)}-{next(_segment_seq):06d}'
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path + OPEN_SUFFIX, 'ab')
+        self._size = 0
+        self._opened_at = time.monotonic()
+
+    def _complete(self):
+        self._file.close()
+        self._file = None
+        os.rename(self._path + OPEN_SUFFIX, self._path + COMPLETE_SUFFIX)
+        # Make the rename itself durable.
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def completed_segments(directory):
+    """
+    Paths of the segments in `directory` that are ready to load, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith(COMPLETE_SUFFIX)]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def orphaned_segments(directory, stale_after=None, node=None):
+    """
+    Paths of the open segments in `directory` whose writer is gone: it ran
+    on this node (`node`, the host name by default) and its process has
+    exited, or, with `stale_after` (seconds), the segment of another node
+    has not been written to for that long. A live writer completes its
+    segment within MAX_AGE, so a stale one was abandoned.
+    """
+    if not os.path.isdir(directory):
+        return []
+    node = node or socket.gethostname()
+    now = time.time()
+    paths = []
+    for name in os.listdir(directory):
+        if not name.endswith(OPEN_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            writer_node, pid, _, _ = segment_name(path).rsplit('-', 3)
+        except ValueError:
+            writer_node = pid = None
+        if writer_node == node:
+            if not process_alive(pid):
+                paths.append(path)
+        elif stale_after is not None and now - os.path.getmtime(path) >= stale_after:
+            paths.append(path)
+    return sorted(paths, key=os.path.getmtime)
+
+
+def complete_orphan(path):
+    """
+    Rename an orphaned open segment to a completed one; returns its new path.
+    """
+    completed = path[:-len(OPEN_SUFFIX)] + COMPLETE_SUFFIX
+    os.rename(path, completed)
+    return completed
+
+
+def segment_name(path):
+    """
+    The segment's identity in LogSegment, the same before and after it
+    is completed.
+    """
+    name = os.path.basename(path)
+    return name[:-len(OPEN_SUFFIX)] if name.endswith(OPEN_SUFFIX) else name[:-len(COMPLETE_SUFFIX)]
@@ -1,9 +1,20 @@
 from celery import shared_task
-from tracking_ip.models import RequestLog, SuspiciousIP
-from django.db.models import Count
+from celery.signals import worker_ready
+from tracking_ip.models import RequestLog, SuspiciousIP, DetectionEvent, DetectionRule, Severity
+from tracking_ip import metrics
+from tracking_ip.categories import get_categorizer
+from tracking_ip.latency import rollup_hour
+from tracking_ip.routers import replica_reads
+from tracking_ip.uniques import UniqueVisitorCounter, period_start
+from tracking_ip.warming import claim_cold_cache, mark_cold, recent_clients, warm_geo_cache, warming_config
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Case, CharField, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Greatest
 from datetime import timedelta
 from django.utils import timezone
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -11,48 +22,223 @@ logger = logging.getLogger(__name__)
 def detect_anomalies():
     """
     Celery task to detect suspicious IP addresses based on request patterns.
-    Flags IPs exceeding 100 requests/hour or accessing sensitive paths.
+    Flags IPs exceeding 100 requests/hour, accessing sensitive paths, or
+    sending heavily from a network (ASN) over 1000 requests/hour.
+    Records a DetectionEvent per rule hit and updates the IP's
+    SuspiciousIP summary.
+    Counts are estimated from sample weights, so sampled logging keeps
+    the thresholds meaningful.
     """
+    with metrics.DETECT_ANOMALIES_SECONDS.time():
+        _detect_anomalies()
+    # Worker processes serve no /metrics; publish the timing right away.
+    metrics.REGISTRY.flush()
+
+
+def _severity(observed, threshold, base):
+    """
+    Escalate from `base` by one level at 3x and again at 10x the threshold.
+    """
+    level = base + (observed >= 3 * threshold) + (observed >= 10 * threshold)
+    return min(level, Severity.CRITICAL)
+
+
+def _detect_anomalies():
     logger.info("Starting anomaly detection task...")
     now = timezone.now()
     one_hour_ago = now - timedelta(hours=1)
 
+    # The scan covers the last hour, so a couple of minutes of replication
+    # lag only delays a detection. Summaries are updated on the primary.
+    with replica_reads(max_lag=120):
+        events = _evaluate_rules(now, one_hour_ago)
+    _record_events(events, now)
+    logger.info("Anomaly detection task completed.")
+
+
+def _evaluate_rules(now, one_hour_ago):
+    """
+    Return a DetectionEvent per rule hit in the window. Events are only
+    collected here and written in bulk afterwards, so the number of
+    queries does not grow with the number of flagged IPs.
+    Rules are evaluated per client network; the network address is what
+    gets recorded as the event's (and SuspiciousIP's) IP address.
+    """
+    events = []
+
     # Rule 1: IPs exceeding 100 requests/hour
     high_traffic_ips = RequestLog.objects.filter(
         timestamp__gte=one_hour_ago
-    ).values('ip_address').annotate(
-        request_count=Count('ip_address')
+    ).with_network().values('network').annotate(
+        request_count=Sum('sample_weight')
     ).filter(request_count__gt=100)
 
     for item in high_traffic_ips:
-        ip_address = item['ip_address']
-        reason = f"Exceeded 100 requests ({item['request_count']}) in the last hour."
-        SuspiciousIP.objects.get_or_create(ip_address=ip_address, defaults={'reason': reason})
+        ip_address = item['network']
+        events.append(DetectionEvent(
+            ip_address=ip_address,
+            rule=DetectionRule.HIGH_TRAFFIC,
+            window_start=one_hour_ago,
+            window_end=now,
+            observed_count=item['request_count'],
+            severity=_severity(item['request_count'], 100, Severity.LOW),
+        ))
         logger.warning(f"Flagged suspicious IP (high traffic): {ip_address}")
 
-    # Rule 2: IPs accessing sensitive paths frequently
-    sensitive_paths = ['/admin/', '/login/', '/api/v1/sensitive_data/'] # Define your sensitive paths
-    for path in sensitive_paths:
-        sensitive_access_ips = RequestLog.objects.filter(
+    # Rule 2: networks accessing sensitive paths frequently. Paths are
+    # categorized when logged, so this is one query on the category index
+    # however many sensitive prefixes are configured.
+    categorizer = get_categorizer()
+    if categorizer.sensitive_ids:
+        sensitive_access = RequestLog.objects.filter(
             timestamp__gte=one_hour_ago,
-            path__startswith=path # Use startswith for paths like /admin/login etc.
-        ).values('ip_address').annotate(
-            access_count=Count('ip_address')
-        ).filter(access_count__gt=5) # Example: more than 5 accesses to sensitive path in an hour
-
-        for item in sensitive_access_ips:
-            ip_address = item['ip_address']
-            reason = f"Accessed sensitive path '{path}' {item['access_count']} times in the last hour."
-            # Append reason if IP already flagged, or create new
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
+            category__in=categorizer.sensitive_ids,
+        ).with_network().values('network', 'category').annotate(
+            access_count=Sum('sample_weight')
+        ).filter(access_count__gt=5) # Example: more than 5 accesses to a sensitive category in an hour
+
+        for item in sensitive_access:
+            ip_address = item['network']
+            events.append(DetectionEvent(
                 ip_address=ip_address,
-                defaults={'reason': reason}
-            )
-            if not created:
-                # If already exists, update reason to include new flag
-                if reason not in suspicious_ip.reason: # Avoid duplicate reasons
-                    suspicious_ip.reason += f"; {reason}"
-                    suspicious_ip.save()
+                rule=DetectionRule.SENSITIVE_PATH,
+                target=categorizer.describe(item['category'])[:254],
+                window_start=one_hour_ago,
+                window_end=now,
+                observed_count=item['access_count'],
+                severity=_severity(item['access_count'], 5, Severity.MEDIUM),
+            ))
             logger.warning(f"Flagged suspicious IP (sensitive path access): {ip_address}")
 
-    logger.info("Anomaly detection task completed.")
+    # Rule 3: IPs in networks (ASNs) sending more than 1000 requests/hour.
+    # Hosting providers and botnets spread traffic over many addresses that
+    # each stay under the per-IP threshold.
+    asn_threshold = getattr(settings, 'IP_TRACKING_ASN_THRESHOLD', 1000)
+    asn_totals = {
+        item['autonomous_system']: item['request_count']
+        for item in RequestLog.objects.filter(
+            timestamp__gte=one_hour_ago, autonomous_system__isnull=False
+        ).values('autonomous_system').annotate(
+            request_count=Sum('sample_weight')
+        ).filter(request_count__gt=asn_threshold)
+    }
+    if asn_totals:
+        asn_ips = RequestLog.objects.filter(
+            timestamp__gte=one_hour_ago, autonomous_system__in=list(asn_totals)
+        ).with_network().values('autonomous_system', 'network').annotate(
+            request_count=Sum('sample_weight')
+        ).filter(request_count__gt=asn_threshold // 100) # Leave out incidental visitors
+
+        for item in asn_ips:
+            ip_address = item['network']
+            events.append(DetectionEvent(
+                ip_address=ip_address,
+                rule=DetectionRule.ASN_TRAFFIC,
+                target=f"AS{item['autonomous_system']}",
+                window_start=one_hour_ago,
+                window_end=now,
+                observed_count=item['request_count'],
+                severity=_severity(asn_totals[item['autonomous_system']], asn_threshold, Severity.LOW),
+            ))
+            logger.warning(f"Flagged suspicious IP (ASN traffic, AS{item['autonomous_system']}): {ip_address}")
+
+    return events
+
+
+def _record_events(events, now):
+    """
+    Append `events` and fold them into the per-IP SuspiciousIP summaries,
+    with a fixed number of queries per 500 IPs.
+    Summaries are incremented in the database (score = score + n), so
+    overlapping runs add up instead of overwriting each other's counts.
+    """
+    if not events:
+        return
+    by_ip = {}
+    for event in events:
+        by_ip.setdefault(event.ip_address, []).append(event)
+
+    with transaction.atomic(using=router.db_for_write(SuspiciousIP)):
+        DetectionEvent.objects.bulk_create(events, batch_size=500)
+        # Empty summaries for new IPs; one created concurrently by another
+        # run is kept, and both runs' increments below apply to it.
+        SuspiciousIP.objects.bulk_create(
+            [SuspiciousIP(ip_address=ip_address, last_seen=now) for ip_address in by_ip],
+            batch_size=500, ignore_conflicts=True,
+        )
+        ips = list(by_ip)
+        for start in range(0, len(ips), 500):
+            batch = ips[start:start + 500]
+
+            def per_ip(value, output_field=IntegerField()):
+                return Case(*[When(ip_address=ip_address, then=Value(value(by_ip[ip_address])))
+                              for ip_address in batch], output_field=output_field)
+
+            SuspiciousIP.objects.filter(ip_address__in=batch).update(
+                score=F('score') + per_ip(lambda ip_events: sum(event.severity for event in ip_events)),
+                event_count=F('event_count') + per_ip(len),
+                max_severity=Greatest(
+                    'max_severity', per_ip(lambda ip_events: max(event.severity for event in ip_events))),
+                last_rule=per_ip(lambda ip_events: ip_events[-1].rule, output_field=CharField()),
+                last_seen=now,
+            )
+
+
+@shared_task
+def rollup_unique_visitors():
+    """
+    Celery task to merge the hourly unique-visitor sketches into day and
+    week sketches. Yesterday and last week are merged again so hours that
+    ended after the previous run are included.
+    """
+    counter = UniqueVisitorCounter.from_settings()
+    if counter is None:
+        return
+    now = timezone.now()
+    today = period_start('day', now)
+    yesterday = today - timedelta(days=1)
+    for day in (yesterday, today):
+        counter.rollup('day', day)
+    for week in sorted({period_start('week', yesterday), period_start('week', today)}):
+        counter.rollup('week', week)
+    logger.info("Unique visitor rollup completed.")
+
+
+@shared_task
+def rollup_latency():
+    """
+    Celery task to roll response durations up into per-path latency
+    buckets (LatencyRollup) for the current and the previous hour, so
+    the previous hour is complete once it has ended.
+    """
+    hour = period_start('hour', timezone.now())
+    for start in (hour - timedelta(hours=1), hour):
+        rollup_hour(start)
+    logger.info("Latency rollup completed.")
+
+
+@shared_task
+def warm_geo_cache_if_cold():
+    """
+    Celery task to reload the geolocation cache when it has been flushed
+    or restarted empty, before live traffic fills it one cold lookup at a
+    time. Does nothing while the cache is warm.
+    """
+    if not claim_cold_cache():
+        return
+    config = warming_config()
+    started = time.monotonic()
+    try:
+        clients = recent_clients(config['LIMIT'], config['HOURS'])
+        loaded = warm_geo_cache(clients, config['BATCH_SIZE'], config['RATE'])
+    except Exception:
+        # Let the next run try again.
+        mark_cold()
+        raise
+    logger.info(f"Geolocation cache warmed: {loaded} keys in {time.monotonic() - started:.1f}s.")
+
+
+@worker_ready.connect
+def warm_geo_cache_on_start(sender=None, **kwargs):
+    # Workers restart on every deploy; reload the cache if it came back empty.
+    warm_geo_cache_if_cold.delay()
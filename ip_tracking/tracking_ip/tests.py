@@ -1,10 +1,58 @@
-from django.test import TestCase, RequestFactory, override_settings
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.contrib.auth.models import AnonymousUser, User
 from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import OperationalError, connection, connections, models, router
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from unittest.mock import patch, MagicMock
+import geoip2.database
 import geoip2.errors
-from tracking_ip.models import RequestLog, BlockedIP
+from tracking_ip.models import (
+    RequestLog, BlockedIP, SuspiciousIP, RequestPath, GeoLocation,
+    DetectionEvent, DetectionRule, Severity, AutonomousSystem, LogSegment,
+    HttpMethod, LatencyRollup,
+)
+from tracking_ip.admin import CachedFacetFilter
+from tracking_ip.fields import pack_ip, unpack_ip
 from tracking_ip.middleware import BasicIPLoggingMiddleware
+from tracking_ip.categories import UNCATEGORIZED, PathCategorizer, get_categorizer
+from tracking_ip.client import get_client, parse_address, ratelimit_key, resolve_client
+from tracking_ip.sampling import AdaptiveThrottle
+from tracking_ip import metrics
+from tracking_ip.views import (
+    api_test, geolocation_stats, latency_stats, request_logs, top_talkers, unique_visitors,
+)
+from tracking_ip.tasks import detect_anomalies, rollup_latency, warm_geo_cache_if_cold
+from tracking_ip.segments import SegmentWriter, encode_record, read_records
+from tracking_ip.latency import bucket_of, bucket_value, latency_by_path, rollup_hour
+from tracking_ip.replay import FLOOD_IP, ReactionMonitor, TraceEvent, generate_profile, read_trace, write_trace
+from tracking_ip.warming import WARM_SENTINEL_KEY, recent_clients, warm_geo_cache
+from tracking_ip.routers import TrackingDatabaseRouter, TrackingReplicaRouter, replica_reads
+from tracking_ip.database import DEFAULT_SQLITE_PRAGMAS, apply_sqlite_pragmas, configure_connection
+from tracking_ip.heavy_hitters import HeavyHitterTracker, SpaceSaving, subnet_of
+from tracking_ip.uniques import UniqueVisitorCounter, path_prefix, period_start
+from tracking_ip.pagination import EstimatedCountPaginator, decode_cursor, encode_cursor, keyset_page
+from tracking_ip.benchmarks import (
+    blocked_ips, generate_traffic, run_middleware_benchmark, write_benchmark_asn_db,
+    write_benchmark_city_db,
+)
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
 import json
+import random
+import os
+import sqlite3
+import statistics
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 
 
 class IPGeolocationAnalyticsTestCase(TestCase):
@@ -16,7 +64,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
     def setUp(self):
         """Set up test fixtures."""
         self.factory = RequestFactory()
-        self.middleware = BasicIPLoggingMiddleware(lambda request: None)
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
         
         # Clear cache before each test
         cache.clear()
@@ -38,7 +86,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             mock_response.city.name = 'Mountain View'
             mock_reader.city.return_value = mock_response
             
-            self.middleware.process_request(request)
+            self.middleware(request)
         
         # Verify RequestLog was created with correct IP
         log_entry = RequestLog.objects.get()
@@ -47,9 +95,10 @@ class IPGeolocationAnalyticsTestCase(TestCase):
         self.assertEqual(log_entry.country, 'United States')
         self.assertEqual(log_entry.city, 'Mountain View')
     
+    @override_settings(IP_TRACKING_TRUSTED_PROXIES=['127.0.0.1/32', '70.41.3.0/24', '150.172.238.0/24'])
     def test_ip_extraction_with_ipware(self):
         """
-        Test IP extraction using django-ipware with X-Forwarded-For header.
+        Test IP extraction from the X-Forwarded-For header behind trusted proxies.
         """
         request = self.factory.get(
             '/api/test', 
@@ -64,11 +113,11 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             mock_response.city.name = 'Sydney'
             mock_reader.city.return_value = mock_response
             
-            self.middleware.process_request(request)
+            self.middleware(request)
         
         # Verify RequestLog was created with the forwarded IP
         log_entry = RequestLog.objects.get()
-        self.assertEqual(log_entry.ip_address, '203.0.113.195')  # First IP in X-Forwarded-For
+        self.assertEqual(log_entry.ip_address, '203.0.113.195')  # First untrusted hop from the right
         self.assertEqual(log_entry.path, '/api/test')
         self.assertEqual(log_entry.country, 'Australia')
         self.assertEqual(log_entry.city, 'Sydney')
@@ -88,7 +137,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             mock_reader.city.return_value = mock_response
             
             # First request - should hit GeoIP2 database
-            self.middleware.process_request(request)
+            self.middleware(request)
             mock_reader.city.assert_called_once_with(test_ip)
         
         # Verify cache was populated
@@ -100,7 +149,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
         
         # Second request - should use cache
         with patch('tracking_ip.middleware._geoip_reader') as mock_reader:
-            self.middleware.process_request(request)
+            self.middleware(request)
             # Should not call GeoIP2 reader since data is cached
             mock_reader.city.assert_not_called()
         
@@ -123,7 +172,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             # Mock AddressNotFoundError
             mock_reader.city.side_effect = geoip2.errors.AddressNotFoundError("IP address not found")
             
-            self.middleware.process_request(request)
+            self.middleware(request)
         
         # Verify RequestLog was created without geolocation data
         log_entry = RequestLog.objects.get()
@@ -140,7 +189,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
         request = self.factory.get('/test', REMOTE_ADDR=test_ip)
         
         with patch('tracking_ip.middleware._geoip_reader', None):
-            self.middleware.process_request(request)
+            self.middleware(request)
         
         # Verify RequestLog was created without geolocation data
         log_entry = RequestLog.objects.get()
@@ -159,15 +208,19 @@ class IPGeolocationAnalyticsTestCase(TestCase):
         
         request = self.factory.get('/blocked', REMOTE_ADDR=blocked_ip)
         
-        response = self.middleware.process_request(request)
+        response = self.middleware(request)
         
         # Should return HttpResponseForbidden
         self.assertIsNotNone(response)
         self.assertEqual(response.status_code, 403)
         self.assertEqual(response.content.decode(), "You are blocked.")
         
-        # Verify no RequestLog was created for blocked IP
-        self.assertEqual(RequestLog.objects.filter(ip_address=blocked_ip).count(), 0)
+        # The rejection itself is logged, unsampled and without geolocation
+        log_entry = RequestLog.objects.get(ip_address=blocked_ip)
+        self.assertEqual((log_entry.status, log_entry.sample_weight, log_entry.path),
+                         (403, 1, '/blocked'))
+        self.assertEqual(log_entry.client_network, blocked_ip)
+        self.assertIsNone(log_entry.country)
     
     def test_cache_expiration_and_refresh(self):
         """
@@ -184,7 +237,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             mock_response.city.name = 'Toronto'
             mock_reader.city.return_value = mock_response
             
-            self.middleware.process_request(request)
+            self.middleware(request)
         
         # Manually expire the cache entry
         cache.delete(cache_key)
@@ -196,7 +249,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             mock_response.city.name = 'Vancouver'
             mock_reader.city.return_value = mock_response
             
-            self.middleware.process_request(request)
+            self.middleware(request)
             # Should call GeoIP2 reader again since cache was cleared
             mock_reader.city.assert_called_once_with(test_ip)
         
@@ -226,7 +279,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
                 else:
                     mock_reader.city.side_effect = geoip2.errors.AddressNotFoundError("IP address not found")
                 
-                self.middleware.process_request(request)
+                self.middleware(request)
         
         # Verify all entries were created
         self.assertEqual(RequestLog.objects.count(), 3)
@@ -254,7 +307,7 @@ class IPGeolocationAnalyticsTestCase(TestCase):
             # Simulate multiple requests from same IP
             for path in paths:
                 request = self.factory.get(path, REMOTE_ADDR=test_ip)
-                self.middleware.process_request(request)
+                self.middleware(request)
         
         # Should only call GeoIP2 reader once (first request)
         self.assertEqual(mock_reader.city.call_count, 1)
@@ -270,3 +323,1918 @@ class IPGeolocationAnalyticsTestCase(TestCase):
     def tearDown(self):
         """Clean up after tests."""
         cache.clear()
+
+
+class CompactStorageTestCase(TestCase):
+    """
+    Tests for the compact RequestLog layout: packed IPs, interned paths
+    and dictionary-encoded geolocation, behind the compatibility manager.
+    """
+
+    def test_ip_packing_is_fixed_width(self):
+        """
+        IPv4 and IPv6 addresses both pack to 16 bytes and round-trip.
+        """
+        for ip in ('8.8.8.8', '2001:db8::1', '::1'):
+            packed = pack_ip(ip)
+            self.assertEqual(len(packed), 16)
+            self.assertEqual(unpack_ip(packed), ip)
+
+    def test_paths_and_geo_are_interned(self):
+        """
+        Repeated paths and (country, city) pairs share one dictionary row.
+        """
+        for ip in ('1.1.1.1', '2.2.2.2', '2001:db8::2'):
+            RequestLog.objects.create(ip_address=ip, path='/shared',
+                                      country='Japan', city='Tokyo')
+        RequestLog.objects.create(ip_address='3.3.3.3', path='/other')
+
+        self.assertEqual(RequestPath.objects.count(), 2)
+        self.assertEqual(GeoLocation.objects.count(), 1)
+        self.assertIsNone(RequestLog.objects.get(ip_address='3.3.3.3').geo)
+
+    def test_compatibility_lookups(self):
+        """
+        Old column names still work in filters, values() and ordering.
+        """
+        RequestLog.objects.create(ip_address='1.1.1.1', path='/admin/login/',
+                                  country='Germany', city='Berlin')
+        RequestLog.objects.create(ip_address='1.1.1.1', path='/home',
+                                  country='Germany', city='Munich')
+        RequestLog.objects.create(ip_address='2001:db8::3', path='/home')
+
+        self.assertEqual(RequestLog.objects.filter(path__startswith='/admin/').count(), 1)
+        self.assertEqual(RequestLog.objects.filter(ip_address='1.1.1.1').count(), 2)
+        # Q objects, nested and negated, are translated too.
+        self.assertEqual(
+            RequestLog.objects.filter(Q(path='/admin/login/') | Q(country='Germany', city='Munich')).count(), 2
+        )
+        self.assertEqual(
+            RequestLog.objects.filter(Q(path='/home') & ~(Q(city='Munich') | Q(country__isnull=False))).count(), 1
+        )
+        self.assertEqual(RequestLog.objects.exclude(Q(path__startswith='/h')).count(), 1)
+        self.assertEqual(RequestLog.objects.get(Q(city='Berlin')).path, '/admin/login/')
+        self.assertEqual(
+            RequestLog.objects.exclude(country__isnull=True, city__isnull=True).count(), 2
+        )
+        country_counts = RequestLog.objects.exclude(country__isnull=True).values(
+            'country'
+        ).annotate(count=models.Count('country'))
+        self.assertEqual(list(country_counts), [{'country': 'Germany', 'count': 2}])
+        self.assertEqual(
+            list(RequestLog.objects.order_by('path').values_list('path', flat=True)),
+            ['/admin/login/', '/home', '/home']
+        )
+        self.assertEqual(
+            set(RequestLog.objects.values_list('ip_address', flat=True)),
+            {'1.1.1.1', '2001:db8::3'}
+        )
+
+    def test_geolocation_stats_groups_by_geo_key(self):
+        """
+        The stats view folds per-city counts into per-country totals.
+        """
+        RequestLog.objects.create(ip_address='1.1.1.1', path='/', country='Japan', city='Tokyo')
+        RequestLog.objects.create(ip_address='1.1.1.2', path='/', country='Japan', city='Osaka')
+        RequestLog.objects.create(ip_address='1.1.1.3', path='/', country='Brazil', city='Rio')
+        RequestLog.objects.create(ip_address='1.1.1.4', path='/')
+
+        response = self.client.get('/api/stats/', REMOTE_ADDR='127.0.0.1')
+        data = json.loads(response.content)
+        self.assertEqual(data['geolocated_requests'], 3)
+        self.assertEqual(data['top_countries'][0], {'country': 'Japan', 'count': 2})
+
+
+@override_settings(
+    IP_TRACKING_EXCLUDE_PATHS=[r'/static/', r'/health/?$'],
+    IP_TRACKING_EXCLUDE_METHODS=['HEAD'],
+    IP_TRACKING_SAMPLE_RATES=[(r'/api/', 0.25)],
+    IP_TRACKING_ADAPTIVE_SAMPLING=None,
+)
+class LoggingSamplingTestCase(TestCase):
+    """
+    Tests for logging exclusions, per-route sampling and adaptive throttling.
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        # Built inside the test so the overridden settings are compiled in.
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        cache.clear()
+
+    def test_excluded_paths_and_methods_are_not_logged(self):
+        """
+        Static files, health checks and HEAD requests produce no log rows.
+        """
+        with patch('tracking_ip.middleware._geoip_reader', None):
+            self.middleware(self.factory.get('/static/app.css', REMOTE_ADDR='8.8.8.8'))
+            self.middleware(self.factory.get('/health', REMOTE_ADDR='8.8.8.8'))
+            self.middleware(self.factory.head('/', REMOTE_ADDR='8.8.8.8'))
+            self.middleware(self.factory.get('/', REMOTE_ADDR='8.8.8.8'))
+
+        self.assertEqual(RequestLog.objects.count(), 1)
+
+    def test_blocklist_applies_to_excluded_paths(self):
+        """
+        Blocked IPs are rejected even on paths that are never logged.
+        """
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        response = self.middleware(
+            self.factory.get('/static/app.css', REMOTE_ADDR='10.0.0.1')
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(RequestLog.objects.get().status, 403)
+
+    def test_sampled_rows_carry_weight(self):
+        """
+        A route sampled at 25% logs accepted requests with weight 4.
+        """
+        with patch('tracking_ip.middleware._geoip_reader', None), \
+             patch('tracking_ip.sampling.random.random', side_effect=[0.1, 0.9]):
+            self.middleware(self.factory.get('/api/x', REMOTE_ADDR='8.8.8.8'))
+            self.middleware(self.factory.get('/api/x', REMOTE_ADDR='8.8.8.8'))
+
+        log_entry = RequestLog.objects.get()
+        self.assertEqual(log_entry.sample_weight, 4)
+        response = geolocation_stats(self.factory.get('/api/stats/'))
+        self.assertEqual(json.loads(response.content)['total_requests'], 4)
+
+    def test_adaptive_throttle_backs_off_and_recovers(self):
+        """
+        Slow writes halve the logging factor; fast writes raise it again.
+        """
+        with patch('tracking_ip.sampling.time.monotonic', side_effect=[0, 0, 1, 1]):
+            throttle = AdaptiveThrottle(latency_threshold_ms=10, interval=0, alpha=1.0)
+            with throttle.track_write():
+                pass
+        self.assertEqual(throttle.factor, 0.5)
+
+        with patch('tracking_ip.sampling.time.monotonic', side_effect=[2, 2, 2]):
+            with throttle.track_write():
+                pass
+        self.assertEqual(throttle.factor, 0.625)
+
+
+class MiddlewareBenchmarkTestCase(TestCase):
+    """
+    Tests for the benchmark helpers: synthetic GeoIP2 database, traffic
+    generators and the per-stage runner.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mmdb_path = os.path.join(self.tmpdir.name, 'GeoLite2-City.mmdb')
+        write_benchmark_city_db(self.mmdb_path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        cache.clear()
+
+    def test_synthetic_city_database_is_readable(self):
+        """
+        The generated mmdb opens with geoip2 and answers city lookups.
+        """
+        with geoip2.database.Reader(self.mmdb_path) as reader:
+            response = reader.city('12.1.200.7')
+            self.assertEqual(response.country.name, 'Germany')
+            self.assertEqual(response.city.name, 'Berlin')
+            with self.assertRaises(geoip2.errors.AddressNotFoundError):
+                reader.city('100.1.2.3')
+
+    def test_traffic_is_reproducible(self):
+        """
+        The same seed yields the same traffic; the pool honours the hit rate.
+        """
+        first = generate_traffic('zipf', 200, pool_size=50, seed=3)
+        self.assertEqual(first, generate_traffic('zipf', 200, pool_size=50, seed=3))
+        self.assertTrue(all(ip.startswith('100.') for ip, _ in
+                            generate_traffic('uniform', 50, geo_hit_rate=0.0)))
+
+    def test_runner_reports_every_stage(self):
+        """
+        Each measured request is timed per stage and blocked ones stop early.
+        """
+        blocklist = blocked_ips(5)
+        BlockedIP.objects.bulk_create(BlockedIP(ip_address=ip) for ip in blocklist)
+        traffic = generate_traffic('uniform', 40, pool_size=10, blocklist=blocklist,
+                                   blocked_fraction=0.25, seed=1)
+        with geoip2.database.Reader(self.mmdb_path) as reader:
+            results = run_middleware_benchmark(traffic, reader)
+
+        logged = RequestLog.objects.count()
+        self.assertEqual(results['requests'], 40)
+        self.assertEqual(results['stages']['ip_extraction']['calls'], 40)
+        self.assertEqual(results['stages']['block_check']['calls'], 40)
+        self.assertEqual(results['stages']['log_write']['calls'], logged)
+        # Blocked requests are logged too.
+        self.assertEqual(logged, 40)
+        self.assertEqual(RequestLog.objects.filter(status=403).count(), results['blocked'])
+        self.assertGreater(results['blocked'], 0)
+        self.assertGreater(results['throughput_rps'], 0)
+
+
+class TrackingMetricsTestCase(TestCase):
+    """
+    Tests for per-stage instrumentation and the Prometheus /metrics endpoint.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+
+    def _sample(self, text, series):
+        for line in text.splitlines():
+            if line.startswith(series + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0.0
+
+    def test_stages_and_counters_are_exposed(self):
+        """
+        A tracked request shows up in stage histograms and cache counters.
+        """
+        before = metrics.REGISTRY.render()
+        with patch('tracking_ip.middleware._geoip_reader') as mock_reader:
+            mock_response = MagicMock()
+            mock_response.country.name = 'Japan'
+            mock_response.city.name = 'Tokyo'
+            mock_reader.city.return_value = mock_response
+            self.middleware(self.factory.get('/', REMOTE_ADDR='8.8.8.8'))
+            self.middleware(self.factory.get('/', REMOTE_ADDR='8.8.8.8'))
+
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        after = response.content.decode()
+        for series, delta in (
+            ('tracking_geo_cache_requests_total{result="hit"}', 1),
+            ('tracking_geo_cache_requests_total{result="miss"}', 1),
+            ('tracking_stage_seconds_count{stage="geoip_lookup"}', 1),
+            ('tracking_stage_seconds_count{stage="log_write"}', 2),
+            ('tracking_logged_requests_total', 2),
+        ):
+            self.assertEqual(self._sample(after, series) - self._sample(before, series), delta, series)
+        self.assertIn('# TYPE tracking_stage_seconds histogram', after)
+        self.assertIn('tracking_stage_seconds_bucket{le="+Inf",stage="block_check"}', after)
+
+    def test_snapshots_are_merged_across_processes(self):
+        """
+        With a shared directory, counters from other processes are summed
+        and gauges are reported per process.
+        """
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+             override_settings(IP_TRACKING_METRICS_DIR=metrics_dir):
+            registry = metrics.Registry()
+            counter = registry.counter('test_events_total', 'Events.')
+            gauge = registry.gauge('test_depth', 'Depth.')
+            histogram = registry.histogram('test_seconds', 'Durations.', buckets=(0.1, 1.0))
+            counter.inc(2)
+            gauge.set(3)
+            histogram.observe(0.5)
+            other_pid = os.getppid()
+            with open(os.path.join(metrics_dir, f'metrics-{other_pid}.json'), 'w') as other:
+                json.dump({
+                    counter.key: {'value': 5},
+                    gauge.key: {'value': 7},
+                    histogram.key: {'counts': [1, 0, 0], 'sum': 0.05},
+                }, other)
+
+            text = registry.render()
+
+        self.assertIn('test_events_total 7', text)
+        self.assertIn(f'test_depth{{pid="{other_pid}"}} 7', text)
+        self.assertIn(f'test_depth{{pid="{os.getpid()}"}} 3', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('test_seconds_count 2', text)
+
+
+    def test_snapshots_of_exited_processes_are_pruned(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+             override_settings(IP_TRACKING_METRICS_DIR=metrics_dir):
+            registry = metrics.Registry()
+            counter = registry.counter('test_events_total', 'Events.')
+            counter.inc(2)
+            dead = os.path.join(metrics_dir, f'metrics-{exited.pid}.json')
+            with open(dead, 'w') as other:
+                json.dump({counter.key: {'value': 5}}, other)
+
+            text = registry.render()
+            self.assertFalse(os.path.exists(dead))
+        self.assertIn('test_events_total 2', text)
+
+    def test_flush_errors_do_not_propagate(self):
+        """
+        An unusable metrics directory is logged, and neither fails the
+        caller nor counts a successful log write as failed.
+        """
+        with tempfile.NamedTemporaryFile() as not_a_directory, \
+             override_settings(IP_TRACKING_METRICS_DIR=os.path.join(not_a_directory.name, 'metrics')):
+            registry = metrics.Registry()
+            counter = registry.counter('test_events_total', 'Events.')
+            with self.assertLogs('tracking_ip.metrics', 'ERROR'):
+                counter.inc()
+            self.assertEqual(counter.value, 1)
+            before = metrics.LOG_WRITE_FAILURES.value
+            metrics.REGISTRY._last_flush = 0.0
+            with patch('tracking_ip.middleware._geoip_reader', None), \
+                 self.assertLogs('tracking_ip.metrics', 'ERROR'):
+                response = self.middleware(self.factory.get('/', REMOTE_ADDR='192.0.2.1'))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(RequestLog.objects.count(), 1)
+            self.assertEqual(metrics.LOG_WRITE_FAILURES.value, before)
+
+    def test_concurrent_flushes(self):
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+             override_settings(IP_TRACKING_METRICS_DIR=metrics_dir):
+            registry = metrics.Registry()
+            registry.counter('test_events_total', 'Events.').inc()
+            with self.assertNoLogs('tracking_ip.metrics', 'ERROR'):
+                threads = [threading.Thread(target=lambda: [registry.flush() for _ in range(20)])
+                           for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(os.listdir(metrics_dir), [f'metrics-{os.getpid()}.json'])
+
+
+class CountingCache:
+    """
+    Proxy around a cache backend that records which operations were used.
+    """
+    counted = ('get', 'set', 'add', 'delete', 'get_many', 'set_many', 'incr', 'touch')
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in self.counted:
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingRedis:
+    """
+    Stand-in for a redis-py client that records each round trip to the
+    server: one per executed pipeline, as the list of its commands.
+    """
+
+    def __init__(self):
+        self.round_trips = []
+
+    def pipeline(self, transaction=True):
+        return CountingPipeline(self)
+
+
+class CountingPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queued(*args, **kwargs):
+            self.commands.append(name)
+            return self
+        return queued
+
+    def execute(self):
+        self.client.round_trips.append(self.commands)
+        return [0] * len(self.commands)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                        'LOCATION': 'perf-budget-tests'}},
+    IP_TRACKING_ADAPTIVE_SAMPLING=None,
+)
+class PerformanceBudgetTestCase(TestCase):
+    """
+    Regression gates on the cost of tracking: queries and cache operations
+    per request, allocations, and query counts that must not grow with data.
+    Runs offline against SQLite and a local-memory cache.
+    """
+
+    # Generous on purpose: these catch order-of-magnitude regressions only.
+    ALLOCATION_BUDGET_BYTES = 256 * 1024
+    WARM_REQUEST_BUDGET_MS = 25
+
+    def setUp(self):
+        cache.clear()
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        self.factory = RequestFactory()
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        self.cache = CountingCache(cache)
+        reader_patcher = patch('tracking_ip.middleware._geoip_reader')
+        self.reader = reader_patcher.start()
+        self.addCleanup(reader_patcher.stop)
+        mock_response = MagicMock()
+        mock_response.country.name = 'Japan'
+        mock_response.city.name = 'Tokyo'
+        self.reader.city.return_value = mock_response
+        cache_patcher = patch('tracking_ip.middleware.cache', self.cache)
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+        # Intern the path and geo values the way a committed request would.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.middleware(self.factory.get('/warm', REMOTE_ADDR='1.1.1.1'))
+        self.cache.calls.clear()
+
+    def tearDown(self):
+        # Interned ids point at rows this test's transaction rolls back.
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        cache.clear()
+
+    def test_blocked_request_cost(self):
+        """
+        Blocked: the blocklist query and the insert of the 403, no cache traffic.
+        """
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        with self.assertNumQueries(2):
+            response = self.middleware(
+                self.factory.get('/warm', REMOTE_ADDR='10.0.0.1'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.cache.calls, [])
+
+    def test_cached_geo_request_cost(self):
+        """
+        Cached geo: blocklist query plus the insert, and a single cache get.
+        """
+        with self.assertNumQueries(2):
+            self.middleware(self.factory.get('/warm', REMOTE_ADDR='1.1.1.1'))
+        self.assertEqual(self.cache.calls, ['get'])
+        self.reader.city.assert_called_once()
+
+    def test_cold_geo_request_cost(self):
+        """
+        Cold geo: same queries, plus one cache set after the GeoIP2 lookup.
+        """
+        with self.assertNumQueries(2):
+            self.middleware(self.factory.get('/warm', REMOTE_ADDR='2.2.2.2'))
+        self.assertEqual(self.cache.calls, ['get', 'set'])
+
+    def _enable_redis_features(self, flush_interval=10.0):
+        redis = CountingRedis()
+        self.middleware.uniques = UniqueVisitorCounter(redis)
+        self.middleware.heavy_hitters = HeavyHitterTracker(redis, flush_interval=flush_interval)
+        return redis
+
+    def test_redis_round_trips_per_request(self):
+        """
+        With unique visitors and heavy hitters on: one PFADD pipeline per
+        request (index writes only for the hour's first value), and no
+        heavy-hitter round trip between flushes.
+        """
+        redis = self._enable_redis_features()
+        for ip_address in ('1.1.1.1', '1.1.1.1', '3.3.3.3'):
+            with self.assertNumQueries(2):
+                self.middleware(self.factory.get('/warm', REMOTE_ADDR=ip_address))
+        self.assertEqual(len(redis.round_trips), 3)
+        first, *rest = redis.round_trips
+        self.assertEqual(first.count('pfadd'), 3)
+        self.assertEqual(first.count('sadd'), 3)
+        for commands in rest:
+            self.assertEqual(commands, ['pfadd'] * 3)
+
+    def test_heavy_hitter_round_trips_per_flush(self):
+        """
+        The heavy-hitter merge is one pipeline per flush interval, however
+        many requests it covers.
+        """
+        redis = self._enable_redis_features(flush_interval=3600)
+        self.middleware.uniques = None
+        for index in range(20):
+            self.middleware(self.factory.get('/warm', REMOTE_ADDR=f'1.1.1.{index}'))
+        self.assertEqual(redis.round_trips, [])
+        self.middleware.heavy_hitters.flush()
+        self.assertEqual(len(redis.round_trips), 1)
+        self.assertEqual(redis.round_trips[0].count('zincrby'), 20 + 1 + 1)
+
+    def test_blocked_request_has_no_redis_round_trips(self):
+        redis = self._enable_redis_features(flush_interval=0)
+        BlockedIP.objects.create(ip_address='10.0.0.1')
+        self.middleware(self.factory.get('/warm', REMOTE_ADDR='10.0.0.1'))
+        self.assertEqual(redis.round_trips, [])
+
+    def test_request_allocation_budget(self):
+        """
+        A warm tracked request stays within its allocation budget.
+        """
+        request = self.factory.get('/warm', REMOTE_ADDR='1.1.1.1')
+        self.middleware(request)
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            self.middleware(request)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, self.ALLOCATION_BUDGET_BYTES)
+
+    def test_request_latency_budget(self):
+        """
+        The median warm tracked request stays within its latency budget.
+        """
+        request = self.factory.get('/warm', REMOTE_ADDR='1.1.1.1')
+        durations = []
+        for _ in range(30):
+            start = time.perf_counter()
+            self.middleware(request)
+            durations.append(time.perf_counter() - start)
+        self.assertLess(statistics.median(durations) * 1000, self.WARM_REQUEST_BUDGET_MS)
+
+    def _seed_logs(self, ip_count, first=0):
+        """
+        Per IP: traffic over the hourly threshold and repeated admin access.
+        """
+        logs = []
+        for index in range(first, first + ip_count):
+            ip_address = f'203.0.{index // 250}.{index % 250 + 1}'
+            logs.append(RequestLog(ip_address=ip_address, path='/', sample_weight=101,
+                                   country='Japan', city=f'City {index % 7}'))
+            logs.append(RequestLog(ip_address=ip_address, path='/admin/', sample_weight=6))
+        RequestLog.objects.bulk_create(logs)
+
+    def _count_queries(self, func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def test_detect_anomalies_queries_do_not_grow(self):
+        """
+        Flagging 10x more IPs does not issue more queries. Both measured
+        runs create new summaries and update existing ones.
+        """
+        self._seed_logs(5)
+        detect_anomalies()
+        self._seed_logs(5, first=5)
+        small = self._count_queries(detect_anomalies)
+        self.assertEqual(SuspiciousIP.objects.count(), 10)
+        self._seed_logs(50, first=10)
+        large = self._count_queries(detect_anomalies)
+        self.assertEqual(SuspiciousIP.objects.count(), 60)
+        self.assertEqual(small, large)
+
+    def test_geolocation_stats_queries_do_not_grow(self):
+        """
+        Stats over 10x more rows and locations use the same number of queries.
+        """
+        self._seed_logs(5)
+        small = self._count_queries(lambda: geolocation_stats(self.factory.get('/api/stats/')))
+        self._seed_logs(50, first=5)
+        large = self._count_queries(lambda: geolocation_stats(self.factory.get('/api/stats/')))
+        self.assertEqual(small, large)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AdminChangelistTestCase(TestCase):
+    """
+    Keyset pagination, estimated counts and indexed search in the admin.
+    """
+
+    def setUp(self):
+        cache.clear()
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        logs = [
+            RequestLog(ip_address=f'10.0.{index // 200}.{index % 200 + 1}',
+                       path=f'/api/items/{index % 5}/',
+                       country='Japan' if index % 2 else 'Germany',
+                       city='Tokyo' if index % 2 else 'Berlin')
+            for index in range(250)
+        ]
+        RequestLog.objects.bulk_create(logs)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin)
+
+    def tearDown(self):
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+
+    def test_cursor_round_trip(self):
+        log = RequestLog.objects.first()
+        self.assertEqual(decode_cursor(encode_cursor(log.timestamp, log.pk)), (log.timestamp, log.pk))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_keyset_pages_cover_every_row_once(self):
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = keyset_page(RequestLog.objects.all(), 'timestamp', cursor=cursor, size=100)
+            seen.extend(row.pk for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 250)
+        self.assertEqual(set(seen), set(RequestLog.objects.values_list('pk', flat=True)))
+
+    def test_paginator_bounds_filtered_counts(self):
+        paginator = EstimatedCountPaginator(RequestLog.objects.all(), 100)
+        self.assertEqual(paginator.count, 250)
+        self.assertTrue(paginator.is_estimate)
+
+        filtered = RequestLog.objects.filter(country='Japan')
+        paginator = EstimatedCountPaginator(filtered, 100)
+        self.assertEqual(paginator.count, 125)
+        self.assertFalse(paginator.is_estimate)
+
+        with patch.object(EstimatedCountPaginator, 'count_limit', 50):
+            paginator = EstimatedCountPaginator(filtered, 100)
+            self.assertEqual(paginator.count, 50)
+            self.assertTrue(paginator.is_estimate)
+
+    def test_requestlog_changelist(self):
+        url = '/admin/tracking_ip/requestlog/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 100)
+        next_url = response.context['cl'].next_page_url
+        self.assertIn('cursor=', next_url)
+        self.assertContains(response, 'Show more')
+
+        response = self.client.get(url + next_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 100)
+
+        for query, expected in (('?q=10.0.0.1', 1), ('?q=/api/items/3', 50),
+                                ('?q=tokyo', 125), ('?country=Germany', 125)):
+            response = self.client.get(url + query)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['cl'].result_count, expected)
+
+        # A stale or tampered cursor falls back to the first page.
+        response = self.client.get(url + '?cursor=garbage')
+        self.assertEqual(response.status_code, 200)
+
+    def test_facet_filters_must_provide_values(self):
+        class NoValuesFilter(CachedFacetFilter):
+            title = parameter_name = 'nothing'
+
+        with self.assertRaises(TypeError):
+            NoValuesFilter(RequestFactory().get('/'), {}, RequestLog, None)
+
+    def test_suspiciousip_changelist(self):
+        now = timezone.now()
+        for ip_address, rule in (('10.0.0.1', DetectionRule.HIGH_TRAFFIC),
+                                 ('10.0.0.2', DetectionRule.SENSITIVE_PATH)):
+            SuspiciousIP.objects.create(ip_address=ip_address, score=2, event_count=1,
+                                        last_rule=rule, last_seen=now)
+            DetectionEvent.objects.create(ip_address=ip_address, rule=rule, window_start=now,
+                                          window_end=now, observed_count=150, severity=Severity.MEDIUM)
+        response = self.client.get('/admin/tracking_ip/suspiciousip/?rule=high_traffic')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row.ip_address for row in response.context['cl'].result_list], ['10.0.0.1'])
+
+
+class DetectionEventTestCase(TestCase):
+    """
+    detect_anomalies appends DetectionEvents and keeps SuspiciousIP summaries.
+    """
+
+    def setUp(self):
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+
+    def tearDown(self):
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+
+    def _log(self, ip_address, path, weight):
+        RequestLog.objects.create(ip_address=ip_address, path=path, sample_weight=weight)
+
+    def test_events_and_summary(self):
+        self._log('198.51.100.7', '/', 120)
+        self._log('198.51.100.7', '/admin/login/', 60)
+        detect_anomalies()
+
+        events = {event.rule: event for event in DetectionEvent.objects.filter(ip_address='198.51.100.7')}
+        self.assertEqual(set(events), {DetectionRule.HIGH_TRAFFIC, DetectionRule.SENSITIVE_PATH})
+        high_traffic = events[DetectionRule.HIGH_TRAFFIC]
+        self.assertEqual(high_traffic.observed_count, 180)
+        self.assertEqual(high_traffic.severity, Severity.LOW)
+        self.assertEqual(high_traffic.window_end - high_traffic.window_start, timedelta(hours=1))
+        sensitive = events[DetectionRule.SENSITIVE_PATH]
+        self.assertEqual(sensitive.target, '/admin/')
+        # 60 accesses are 12x the threshold of 5: two levels above Medium.
+        self.assertEqual(sensitive.severity, Severity.CRITICAL)
+
+        summary = SuspiciousIP.objects.get(ip_address='198.51.100.7')
+        self.assertEqual(summary.score, Severity.LOW + Severity.CRITICAL)
+        self.assertEqual(summary.max_severity, Severity.CRITICAL)
+        self.assertEqual(summary.event_count, 2)
+
+    def test_summary_is_updated_incrementally(self):
+        self._log('198.51.100.8', '/', 150)
+        detect_anomalies()
+        first = SuspiciousIP.objects.get(ip_address='198.51.100.8')
+        detect_anomalies()
+        summary = SuspiciousIP.objects.get(ip_address='198.51.100.8')
+        self.assertEqual(summary.event_count, 2)
+        self.assertEqual(summary.score, 2 * Severity.LOW)
+        self.assertEqual(summary.flagged_at, first.flagged_at)
+        self.assertGreaterEqual(summary.last_seen, first.last_seen)
+        self.assertEqual(DetectionEvent.objects.filter(ip_address='198.51.100.8').count(), 2)
+
+    def test_overlapping_runs_add_up(self):
+        """
+        A summary created and incremented by another run while this one
+        records its events keeps both runs' counts.
+        """
+        self._log('198.51.100.9', '/', 1500)
+        create_summaries = SuspiciousIP.objects.bulk_create
+
+        def concurrent_run(*args, **kwargs):
+            SuspiciousIP.objects.create(ip_address='198.51.100.9', score=10, event_count=1,
+                                        max_severity=Severity.CRITICAL, last_seen=timezone.now())
+            return create_summaries(*args, **kwargs)
+
+        with patch.object(SuspiciousIP.objects, 'bulk_create', side_effect=concurrent_run):
+            detect_anomalies()
+        summary = SuspiciousIP.objects.get(ip_address='198.51.100.9')
+        self.assertEqual(summary.event_count, 2)
+        self.assertEqual(summary.score, 10 + Severity.HIGH)
+        self.assertEqual(summary.max_severity, Severity.CRITICAL)
+        self.assertEqual(summary.last_rule, DetectionRule.HIGH_TRAFFIC)
+
+    def test_top_offenders_since(self):
+        now = timezone.now()
+        for index, (score, days_ago) in enumerate([(5, 1), (9, 2), (50, 30)]):
+            SuspiciousIP.objects.create(ip_address=f'198.51.100.{index + 1}', score=score,
+                                        last_seen=now - timedelta(days=days_ago))
+        top = SuspiciousIP.objects.filter(
+            last_seen__gte=now - timedelta(days=7)).order_by('-score')
+        self.assertEqual([offender.ip_address for offender in top], ['198.51.100.2', '198.51.100.1'])
+
+
+class ReplicaRouterTestCase(TestCase):
+    """
+    Analytical reads go to the replica only where the call site allows it.
+    """
+
+    def setUp(self):
+        self.router = TrackingReplicaRouter()
+
+    @override_settings(IP_TRACKING_READ_REPLICA='replica')
+    def test_reads_use_replica_only_inside_block(self):
+        with patch('tracking_ip.routers.replica_lag', return_value=5.0):
+            self.assertIsNone(self.router.db_for_read(RequestLog))
+            with replica_reads(max_lag=60):
+                self.assertEqual(self.router.db_for_read(RequestLog), 'replica')
+                self.assertEqual(self.router.db_for_read(SuspiciousIP), 'replica')
+                # The blocklist and other apps stay on the primary.
+                self.assertIsNone(self.router.db_for_read(BlockedIP))
+                self.assertIsNone(self.router.db_for_read(User))
+                self.assertIsNone(self.router.db_for_write(RequestLog))
+            # Too far behind for this call site.
+            with replica_reads(max_lag=1):
+                self.assertIsNone(self.router.db_for_read(RequestLog))
+
+    def test_no_replica_configured(self):
+        with replica_reads(max_lag=60):
+            self.assertIsNone(self.router.db_for_read(RequestLog))
+
+    def test_call_sites_state_lag_tolerance(self):
+        with patch('tracking_ip.routers.replica_alias', return_value=None) as replica_alias:
+            geolocation_stats(RequestFactory().get('/api/stats/'))
+        self.assertEqual({call.args[0] for call in replica_alias.call_args_list}, {60})
+
+        RequestLog.objects.create(ip_address='198.51.100.9', path='/', sample_weight=150)
+        with patch('tracking_ip.routers.replica_alias', return_value=None) as replica_alias:
+            detect_anomalies()
+        self.assertEqual({call.args[0] for call in replica_alias.call_args_list}, {120})
+        self.assertTrue(SuspiciousIP.objects.filter(ip_address='198.51.100.9').exists())
+        RequestPath.objects.clear_cache()
+
+
+class LoggingDatabaseTestCase(TestCase):
+    """
+    Tracking tables on their own database alias, with a tuned SQLite setup.
+    """
+
+    def setUp(self):
+        self.router = TrackingDatabaseRouter()
+
+    @override_settings(IP_TRACKING_DATABASE='tracking')
+    def test_router_keeps_tracking_tables_on_their_alias(self):
+        self.assertEqual(self.router.db_for_write(RequestLog), 'tracking')
+        self.assertEqual(self.router.db_for_read(BlockedIP), 'tracking')
+        self.assertIsNone(self.router.db_for_write(User))
+        self.assertTrue(self.router.allow_migrate('tracking', 'tracking_ip'))
+        self.assertFalse(self.router.allow_migrate('default', 'tracking_ip'))
+        self.assertFalse(self.router.allow_migrate('tracking', 'auth'))
+        self.assertIsNone(self.router.allow_migrate('default', 'auth'))
+
+    def test_router_is_inert_with_default_alias(self):
+        self.assertIsNone(self.router.allow_migrate('default', 'tracking_ip'))
+        self.assertEqual(self.router.db_for_write(RequestLog), 'default')
+
+    def test_pragmas_applied(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conn = sqlite3.connect(os.path.join(tmpdir, 'tracking.sqlite3'))
+            apply_sqlite_pragmas(conn, DEFAULT_SQLITE_PRAGMAS)
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('PRAGMA page_size').fetchone()[0], 8192)
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1) # NORMAL
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+            self.assertEqual(conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0], 1000)
+            conn.close()
+
+    @override_settings(IP_TRACKING_DATABASE='tracking')
+    def test_pragmas_only_for_tracking_sqlite_connections(self):
+        for alias in ('other', 'default'):
+            other = MagicMock(vendor='sqlite', alias=alias)
+            configure_connection(sender=None, connection=other)
+            other.cursor.assert_not_called()
+        tracking = MagicMock(vendor='sqlite', alias='tracking')
+        configure_connection(sender=None, connection=tracking)
+        cursor = tracking.cursor.return_value.__enter__.return_value
+        self.assertIn('PRAGMA journal_mode = WAL',
+                      [call.args[0] for call in cursor.execute.call_args_list])
+
+    @override_settings(IP_TRACKING_DATABASE='default')
+    def test_shared_default_database_is_tuned_only_on_request(self):
+        shared = MagicMock(vendor='sqlite', alias='default')
+        configure_connection(sender=None, connection=shared)
+        shared.cursor.assert_not_called()
+        with override_settings(IP_TRACKING_SQLITE_PRAGMAS_ON_DEFAULT=True):
+            configure_connection(sender=None, connection=shared)
+        shared.cursor.assert_called_once()
+
+    def test_bench_log_db_runs(self):
+        out = StringIO()
+        call_command('bench_log_db', seconds=0.2, workers=2,
+                     scenario=['shared-stock', 'dedicated-tuned'], stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:]], ['shared-stock', 'dedicated-tuned'])
+
+
+class UniqueVisitorTestCase(TestCase):
+    """
+    HyperLogLog unique-visitor sketches, checked against a mocked Redis client.
+    """
+
+    def setUp(self):
+        self.client_mock = MagicMock()
+        self.pipe = self.client_mock.pipeline.return_value
+        self.counter = UniqueVisitorCounter(self.client_mock)
+        self.when = datetime(2024, 3, 6, 14, 25, tzinfo=dt_timezone.utc)  # Wednesday
+
+    def test_path_prefix(self):
+        self.assertEqual(path_prefix('/api/v1/items/'), '/api/')
+        self.assertEqual(path_prefix('/api/v1/items/', depth=2), '/api/v1/')
+        self.assertEqual(path_prefix('/'), '/')
+
+    def test_add_pipelines_one_pfadd_per_dimension(self):
+        self.counter.add('192.0.2.1', '/api/v1/items/', 'Kenya', when=self.when)
+        pfadds = [call.args for call in self.pipe.pfadd.call_args_list]
+        self.assertEqual(pfadds, [
+            ('tracking:uv:h:2024030614:all:*', '192.0.2.1'),
+            ('tracking:uv:h:2024030614:country:Kenya', '192.0.2.1'),
+            ('tracking:uv:h:2024030614:path:/api/', '192.0.2.1'),
+        ])
+        self.assertEqual(self.pipe.sadd.call_count, 3)
+        self.pipe.execute.assert_called_once()
+
+        # Index sets are written once per value and hour.
+        self.counter.add('192.0.2.2', '/api/other/', 'Kenya', when=self.when)
+        self.assertEqual(self.pipe.pfadd.call_count, 6)
+        self.assertEqual(self.pipe.sadd.call_count, 3)
+        self.counter.add('192.0.2.2', '/api/other/', 'Kenya', when=self.when + timedelta(hours=1))
+        self.assertEqual(self.pipe.sadd.call_count, 6)
+
+    def test_sources_for_closed_and_current_periods(self):
+        day = period_start('day', self.when)
+        self.assertEqual(self.counter._sources('day', day, self.when + timedelta(days=2)), [('day', day)])
+        current = self.counter._sources('day', day, self.when)
+        self.assertEqual(current[0], ('day', day))
+        self.assertEqual([start.hour for period, start in current[1:]], [12, 13, 14])
+
+        week = period_start('week', self.when)
+        self.assertEqual(week.weekday(), 0)
+        sources = self.counter._sources('week', week, self.when)
+        self.assertEqual([start.day for period, start in sources if period == 'day'], [4, 5, 6])
+
+    def test_rollup_merges_hours_into_day(self):
+        self.pipe.execute.side_effect = [[1, True, 2, True, 0, True], []]
+        self.client_mock.smembers.side_effect = [{b'*'}, {b'Kenya', b'Peru'}]
+        day = period_start('day', self.when)
+        self.counter.rollup('day', day)
+        merged = {call.args[0]: call.args[1:] for call in self.pipe.pfmerge.call_args_list}
+        self.assertEqual(set(merged), {
+            'tracking:uv:d:20240306:all:*',
+            'tracking:uv:d:20240306:country:Kenya',
+            'tracking:uv:d:20240306:country:Peru',
+        })
+        sources = merged['tracking:uv:d:20240306:country:Kenya']
+        self.assertEqual(len(sources), 24)
+        self.assertEqual(sources[0], 'tracking:uv:h:2024030600:country:Kenya')
+
+    def _get_uniques(self, params=None, user=None):
+        request = RequestFactory().get('/api/stats/uniques/', params)
+        request.user = user or User(username='investigator', is_staff=True)
+        return unique_visitors(request)
+
+    @override_settings(IP_TRACKING_UNIQUE_VISITORS={'ENABLED': False})
+    def test_endpoint_disabled(self):
+        self.assertEqual(self._get_uniques().status_code, 503)
+
+    @override_settings(
+        IP_TRACKING_UNIQUE_VISITORS={'ENABLED': True},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_endpoint_disabled_without_redis(self):
+        self.assertEqual(self._get_uniques().status_code, 503)
+
+    def test_endpoint_staff_only(self):
+        counter = MagicMock(standard_error=0.0081)
+        with patch('tracking_ip.views.UniqueVisitorCounter.from_settings', return_value=counter):
+            response = self._get_uniques(user=AnonymousUser())
+        self.assertEqual(response.status_code, 403)
+        counter.count.assert_not_called()
+
+    def test_endpoint_breakdown(self):
+        counter = MagicMock(standard_error=0.0081)
+        counter.count.return_value = 42
+        counter.breakdown.return_value = {'Kenya': 10, 'Peru': 30}
+        with patch('tracking_ip.views.UniqueVisitorCounter.from_settings', return_value=counter):
+            data = json.loads(self._get_uniques(
+                {'period': 'day', 'dimension': 'country', 'start': '2024-03-06'}).content)
+            bad = self._get_uniques({'period': 'year'})
+        self.assertEqual(data['unique_visitors'], 42)
+        self.assertEqual(data['start'], '2024-03-06T00:00:00+00:00')
+        self.assertEqual([row['country'] for row in data['country']], ['Peru', 'Kenya'])
+        self.assertEqual(bad.status_code, 400)
+
+    def test_sampled_out_requests_are_still_counted(self):
+        middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        middleware.uniques = MagicMock()
+        request = RequestFactory().get('/api/items/', REMOTE_ADDR='192.0.2.7')
+        with patch.object(middleware.sampler, 'sample_weight', return_value=None):
+            middleware(request)
+        middleware.uniques.add.assert_called_once_with('192.0.2.7', '/api/items/', None)
+        self.assertFalse(RequestLog.objects.exists())
+
+
+class HeavyHitterTestCase(TestCase):
+    """
+    Space-Saving top-K summaries and their merge into Redis.
+    """
+
+    def test_space_saving_is_exact_under_capacity(self):
+        summary = SpaceSaving(capacity=10)
+        for item in 'aababcabcd':
+            summary.offer(item)
+        self.assertEqual(summary.top(2), [('a', 4, 0), ('b', 3, 0)])
+        self.assertEqual(summary.min_count, 1)
+
+    def test_space_saving_bounds_on_skewed_stream(self):
+        rng = random.Random(1)
+        stream = ['hot'] * 2000 + ['warm'] * 500 + [f'cold-{rng.randrange(5000)}' for _ in range(5000)]
+        rng.shuffle(stream)
+        summary = SpaceSaving(capacity=50)
+        for item in stream:
+            summary.offer(item)
+        self.assertEqual(len(summary), 50)
+        self.assertEqual(sum(summary.counts.values()), len(stream))
+        top = {item: (count, error) for item, count, error in summary.top(2)}
+        self.assertEqual(set(top), {'hot', 'warm'})
+        for item, true_count in (('hot', 2000), ('warm', 500)):
+            count, error = top[item]
+            self.assertLessEqual(count - error, true_count)
+            self.assertGreaterEqual(count, true_count)
+        self.assertEqual(summary.min_count, min(summary.counts.values()))
+
+    def test_subnet_of(self):
+        self.assertEqual(subnet_of('192.0.2.77'), '192.0.2.0/24')
+        self.assertEqual(subnet_of('2001:db8:1:2::5'), '2001:db8:1::/48')
+
+    def test_flush_adds_counts_to_the_minute_and_resets(self):
+        client = MagicMock()
+        tracker = HeavyHitterTracker(client, capacity=100, flush_interval=3600)
+        for _ in range(3):
+            tracker.offer('192.0.2.1', '/login/')
+        tracker.offer('192.0.2.9', '/')
+        tracker.flush(now=120.0)
+        pipe = client.pipeline.return_value
+        increments = {(call.args[0], call.args[2]): call.args[1] for call in pipe.zincrby.call_args_list}
+        self.assertEqual(increments[('tracking:top:ip:2', '192.0.2.1')], 3)
+        self.assertEqual(increments[('tracking:top:subnet:2', '192.0.2.0/24')], 4)
+        self.assertEqual(increments[('tracking:top:path:2', '/login/')], 3)
+        pipe.zremrangebyrank.assert_any_call('tracking:top:ip:2', 0, -101)
+        self.assertEqual(len(tracker._summaries['ip']), 0)
+
+    def test_top_merges_minutes(self):
+        client = MagicMock()
+        client.pipeline.return_value.execute.return_value = [
+            [(b'192.0.2.1', 5.0), (b'192.0.2.2', 1.0)],
+            [(b'192.0.2.2', 7.0)],
+        ]
+        tracker = HeavyHitterTracker(client)
+        self.assertEqual(tracker.top('ip', k=1, window=120, now=600.0), [('192.0.2.2', 8)])
+        keys = [call.args[0] for call in client.pipeline.return_value.zrange.call_args_list]
+        self.assertEqual(keys, ['tracking:top:ip:9', 'tracking:top:ip:10'])
+
+    def _get_top(self, params=None, user=None):
+        request = RequestFactory().get('/api/top/', params)
+        request.user = user or User(username='investigator', is_staff=True)
+        return top_talkers(request)
+
+    @override_settings(IP_TRACKING_HEAVY_HITTERS={'ENABLED': False})
+    def test_endpoint_disabled(self):
+        self.assertEqual(self._get_top().status_code, 503)
+
+    @override_settings(
+        IP_TRACKING_HEAVY_HITTERS={'ENABLED': True},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    def test_endpoint_disabled_without_redis(self):
+        self.assertEqual(self._get_top().status_code, 503)
+
+    def test_endpoint(self):
+        tracker = MagicMock(window=300)
+        tracker.top.return_value = [('/login/', 12)]
+        with patch('tracking_ip.views.HeavyHitterTracker.from_settings', return_value=tracker):
+            data = json.loads(self._get_top({'dimension': 'path'}).content)
+            bad = self._get_top({'dimension': 'country'})
+        self.assertEqual(data, {'window': 300, 'path': [{'path': '/login/', 'requests': 12}]})
+        self.assertEqual(bad.status_code, 400)
+
+    def test_endpoint_staff_only(self):
+        tracker = MagicMock(window=300)
+        with patch('tracking_ip.views.HeavyHitterTracker.from_settings', return_value=tracker):
+            response = self._get_top(user=AnonymousUser())
+        self.assertEqual(response.status_code, 403)
+        tracker.top.assert_not_called()
+
+    def test_middleware_offers_sampled_out_requests(self):
+        middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        middleware.heavy_hitters = MagicMock()
+        request = RequestFactory().get('/api/items/', REMOTE_ADDR='192.0.2.7')
+        with patch.object(middleware.sampler, 'sample_weight', return_value=None):
+            middleware(request)
+        middleware.heavy_hitters.offer.assert_called_once_with('192.0.2.7', '/api/items/')
+        middleware(RequestFactory().get('/static/app.css', REMOTE_ADDR='192.0.2.7'))
+        middleware.heavy_hitters.offer.assert_called_once()
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'asn-tests'}})
+class ASNEnrichmentTestCase(TestCase):
+    """
+    GeoLite2-ASN enrichment: combined lookup and cache entry, storage,
+    detection and stats by ASN.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        city_path = os.path.join(tmpdir.name, 'GeoLite2-City.mmdb')
+        asn_path = os.path.join(tmpdir.name, 'GeoLite2-ASN.mmdb')
+        write_benchmark_city_db(city_path)
+        write_benchmark_asn_db(asn_path)
+        self.city_reader = geoip2.database.Reader(city_path)
+        self.asn_reader = geoip2.database.Reader(asn_path)
+        self.addCleanup(self.city_reader.close)
+        self.addCleanup(self.asn_reader.close)
+
+    def tearDown(self):
+        AutonomousSystem.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def test_lookup_is_combined_and_cached_once(self):
+        request = self.factory.get('/', REMOTE_ADDR='11.0.3.4')
+        with patch('tracking_ip.middleware._geoip_reader', self.city_reader), \
+             patch('tracking_ip.middleware._asn_reader', self.asn_reader):
+            self.middleware(request)
+        self.assertEqual(cache.get('geolocation:11.0.3.4'), {
+            'country': 'United States', 'city': 'Mountain View', 'asn': 15169, 'as_org': 'GOOGLE',
+        })
+        asn_reader = MagicMock()
+        with patch('tracking_ip.middleware._asn_reader', asn_reader):
+            self.middleware(request)
+        asn_reader.asn.assert_not_called()
+        logs = RequestLog.objects.all()
+        self.assertEqual([(log.asn, log.as_organization) for log in logs], [(15169, 'GOOGLE')] * 2)
+        self.assertEqual(RequestLog.objects.filter(asn=15169).count(), 2)
+
+    def test_address_not_in_asn_database(self):
+        with patch('tracking_ip.middleware._geoip_reader', None), \
+             patch('tracking_ip.middleware._asn_reader', self.asn_reader):
+            self.middleware(self.factory.get('/', REMOTE_ADDR='100.1.2.3'))
+        log = RequestLog.objects.get()
+        self.assertIsNone(log.asn)
+        self.assertIsNone(log.country)
+        self.assertEqual(cache.get('geolocation:100.1.2.3')['asn'], None)
+
+    def _seed_asn_traffic(self, ip_count, weight):
+        RequestLog.objects.bulk_create([
+            RequestLog(ip_address=f'198.51.100.{index + 1}', path='/', sample_weight=weight,
+                       asn=64500, as_organization='EXAMPLE-HOSTING')
+            for index in range(ip_count)
+        ] + [RequestLog(ip_address='192.0.2.1', path='/', sample_weight=5,
+                        asn=64501, as_organization='EXAMPLE-ISP')])
+
+    def test_asn_rule_flags_ips_of_a_busy_network(self):
+        # 20 IPs at 60 requests each: every IP stays under the per-IP threshold.
+        self._seed_asn_traffic(20, 60)
+        detect_anomalies()
+        events = DetectionEvent.objects.filter(rule=DetectionRule.ASN_TRAFFIC)
+        self.assertEqual(events.count(), 20)
+        self.assertEqual({event.target for event in events}, {'AS64500'})
+        self.assertFalse(DetectionEvent.objects.filter(rule=DetectionRule.HIGH_TRAFFIC).exists())
+        self.assertFalse(SuspiciousIP.objects.filter(ip_address='192.0.2.1').exists())
+
+    def test_stats_report_top_asns(self):
+        self._seed_asn_traffic(3, 10)
+        data = json.loads(geolocation_stats(self.factory.get('/api/stats/')).content)
+        self.assertEqual(data['top_asns'], [
+            {'asn': 64500, 'organization': 'EXAMPLE-HOSTING', 'count': 30},
+            {'asn': 64501, 'organization': 'EXAMPLE-ISP', 'count': 5},
+        ])
+
+
+class ClientContextTestCase(TestCase):
+    """
+    Client IP resolution: done once per request, trusted-proxy aware.
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_forwarded_header_ignored_from_untrusted_peer(self):
+        client = resolve_client({'REMOTE_ADDR': '198.51.100.7', 'HTTP_X_FORWARDED_FOR': '1.2.3.4'})
+        self.assertEqual(client.ip, '198.51.100.7')
+
+    @override_settings(IP_TRACKING_TRUSTED_PROXIES=['10.0.0.0/8'])
+    def test_right_most_untrusted_hop_is_the_client(self):
+        meta = {'REMOTE_ADDR': '10.0.0.2',
+                'HTTP_X_FORWARDED_FOR': '6.6.6.6, 203.0.113.9, 10.1.2.3'}
+        self.assertEqual(resolve_client(meta).ip, '203.0.113.9')
+        meta['HTTP_X_FORWARDED_FOR'] = 'garbage, 10.1.2.3'
+        self.assertEqual(resolve_client(meta).ip, '10.1.2.3')
+
+    def test_parse_address_normalizes(self):
+        self.assertEqual(str(parse_address('[2001:DB8::1]:443')), '2001:db8::1')
+        self.assertEqual(str(parse_address('203.0.113.5:8080')), '203.0.113.5')
+        self.assertEqual(str(parse_address('::ffff:203.0.113.5')), '203.0.113.5')
+        self.assertIsNone(parse_address('unknown'))
+
+    def test_ipv6_prefix_groups_a_rotating_client(self):
+        first = resolve_client({'REMOTE_ADDR': '2001:db8:1:2::aaaa'})
+        second = resolve_client({'REMOTE_ADDR': '2001:db8:1:2:ffff::1'})
+        self.assertEqual(first.prefix, '2001:db8:1:2::/64')
+        self.assertEqual(first.prefix, second.prefix)
+        self.assertEqual(resolve_client({'REMOTE_ADDR': '203.0.113.5'}).prefix, '203.0.113.5')
+
+    def test_resolved_once_and_shared(self):
+        request = self.factory.get('/api/test/', REMOTE_ADDR='192.0.2.44')
+        middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        with patch('tracking_ip.middleware._geoip_reader', None):
+            middleware(request)
+        client = request.client
+        with patch('tracking_ip.client.resolve_client') as resolve:
+            self.assertIs(get_client(request), client)
+            self.assertEqual(ratelimit_key('group', request), '192.0.2.44')
+            data = json.loads(api_test(request).content)
+            resolve.assert_not_called()
+        self.assertEqual(data['client_ip'], '192.0.2.44')
+        self.assertEqual(len(data['recent_requests']), 1)
+
+
+class ClientNetworkTestCase(TestCase):
+    """
+    Aggregation by client network: rotating IPv6 addresses within a /64
+    share one key for logging, geo caching and anomaly rules.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+
+    def tearDown(self):
+        RequestPath.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+
+    def test_network_stored_and_geo_cached_per_network(self):
+        with patch('tracking_ip.middleware._geoip_reader') as mock_reader:
+            mock_response = MagicMock()
+            mock_response.country.name = 'Germany'
+            mock_response.city.name = 'Berlin'
+            mock_reader.city.return_value = mock_response
+            for ip_address in ('2001:db8:1:2::1', '2001:db8:1:2::beef', '2001:db8:1:2:a:b:c:d'):
+                self.middleware(self.factory.get('/', REMOTE_ADDR=ip_address))
+            mock_reader.city.assert_called_once()
+        self.assertEqual(set(RequestLog.objects.values_list('client_network', flat=True)), {'2001:db8:1:2::'})
+        self.assertEqual(RequestLog.objects.get(ip_address='2001:db8:1:2::beef').country, 'Germany')
+
+    def test_ipv4_network_is_the_address(self):
+        with patch('tracking_ip.middleware._geoip_reader', None):
+            self.middleware(self.factory.get('/', REMOTE_ADDR='203.0.113.8'))
+        self.assertEqual(RequestLog.objects.get().client_network, '203.0.113.8')
+
+    @override_settings(IP_TRACKING_IPV4_PREFIX_LENGTH=24)
+    def test_ipv4_prefix_is_configurable(self):
+        client = resolve_client({'REMOTE_ADDR': '203.0.113.8'})
+        self.assertEqual(client.network_address, '203.0.113.0')
+        self.assertEqual(client.prefix, '203.0.113.0/24')
+
+    def test_rules_count_per_network(self):
+        # 120 requests from 120 addresses of one /64, plus legacy rows without a network.
+        RequestLog.objects.bulk_create(
+            [RequestLog(ip_address=f'2001:db8:1:2::{index + 1:x}', client_network='2001:db8:1:2::', path='/')
+             for index in range(120)]
+            + [RequestLog(ip_address='192.0.2.5', path='/', sample_weight=101)]
+        )
+        detect_anomalies()
+        flagged = set(SuspiciousIP.objects.values_list('ip_address', flat=True))
+        self.assertEqual(flagged, {'2001:db8:1:2::', '192.0.2.5'})
+        event = DetectionEvent.objects.get(ip_address='2001:db8:1:2::')
+        self.assertEqual(event.observed_count, 120)
+
+
+class PathCategoryTestCase(TestCase):
+    """
+    Ingest-time path categories compiled from a prefix trie.
+    """
+    CATEGORIES = {
+        1: ('admin', ['/admin/']),
+        2: ('login', ['/login/', '/accounts/login']),
+        3: ('sensitive_api', ['/api/v1/sensitive_data/']),
+        4: ('api', ['/api/']),
+    }
+
+    def tearDown(self):
+        RequestPath.objects.clear_cache()
+
+    def test_longest_prefix_wins(self):
+        categorizer = PathCategorizer(self.CATEGORIES, sensitive=['admin', 'login', 'missing'])
+        self.assertEqual(categorizer.categorize('/api/v1/sensitive_data/7'), 3)
+        self.assertEqual(categorizer.categorize('/api/v2/items'), 4)
+        self.assertEqual(categorizer.categorize('/accounts/login/'), 2)
+        self.assertEqual(categorizer.categorize('/ap'), UNCATEGORIZED)
+        self.assertEqual(categorizer.sensitive_ids, [1, 2])
+        self.assertEqual(categorizer.describe(2), '/login/, /accounts/login')
+
+    @override_settings(IP_TRACKING_PATH_CATEGORIES=CATEGORIES)
+    def test_rows_are_tagged_when_written(self):
+        RequestLog.objects.create(ip_address='192.0.2.1', path='/api/items/')
+        RequestLog.objects.bulk_create([RequestLog(ip_address='192.0.2.1', path='/admin/')])
+        self.assertEqual(sorted(RequestLog.objects.values_list('category', flat=True)), [1, 4])
+
+    @override_settings(IP_TRACKING_PATH_CATEGORIES={7: ('billing', ['/billing/'])},
+                       IP_TRACKING_SENSITIVE_CATEGORIES=['billing'])
+    def test_sensitive_rule_filters_on_category(self):
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address='198.51.100.3', path=f'/billing/invoice/{index}') for index in range(6))
+        with CaptureQueriesContext(connection) as context:
+            detect_anomalies()
+        event = DetectionEvent.objects.get(rule=DetectionRule.SENSITIVE_PATH)
+        self.assertEqual((event.ip_address, event.target, event.observed_count),
+                         ('198.51.100.3', '/billing/', 6))
+        self.assertFalse(any('LIKE' in query['sql'] for query in context.captured_queries))
+
+    def test_settings_change_recompiles(self):
+        with override_settings(IP_TRACKING_PATH_CATEGORIES={9: ('docs', ['/docs/'])}):
+            self.assertEqual(get_categorizer().categorize('/docs/x'), 9)
+        self.assertEqual(get_categorizer().categorize('/docs/x'), UNCATEGORIZED)
+
+    def test_stats_by_category(self):
+        RequestLog.objects.bulk_create([
+            RequestLog(ip_address='192.0.2.1', path='/admin/', sample_weight=3),
+            RequestLog(ip_address='192.0.2.1', path='/'),
+        ])
+        data = json.loads(geolocation_stats(RequestFactory().get('/api/stats/')).content)
+        self.assertEqual(data['categories'], [
+            {'category': 'admin', 'count': 3}, {'category': 'uncategorized', 'count': 1},
+        ])
+
+
+class GeolocateBackfillTestCase(TestCase):
+    """
+    geolocate_backfill: PK-range chunks looked up by a process pool.
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.city_path = os.path.join(tmpdir.name, 'GeoLite2-City.mmdb')
+        self.asn_path = os.path.join(tmpdir.name, 'GeoLite2-ASN.mmdb')
+        write_benchmark_city_db(self.city_path)
+        write_benchmark_asn_db(self.asn_path)
+        RequestLog.objects.bulk_create([
+            RequestLog(ip_address='11.0.0.1', path='/'),
+            RequestLog(ip_address='12.1.0.1', path='/'),
+            RequestLog(ip_address='11.0.0.1', path='/a/'),
+            RequestLog(ip_address='100.1.2.3', path='/'),
+            RequestLog(ip_address='12.1.0.2', path='/', country='Atlantis', city='Old'),
+        ])
+        self.ids = list(RequestLog.objects.order_by('pk').values_list('pk', flat=True))
+
+    def tearDown(self):
+        AutonomousSystem.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def _backfill(self, *args):
+        out = StringIO()
+        call_command('geolocate_backfill', '--city-db', self.city_path, '--workers', '2',
+                     '--chunk-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def _locations(self):
+        return [(log.country, log.city, log.asn) for log in RequestLog.objects.order_by('pk')]
+
+    def test_fills_missing_rows_only(self):
+        output = self._backfill('--asn-db', self.asn_path)
+        self.assertEqual(self._locations(), [
+            ('United States', 'Mountain View', 15169),
+            ('Germany', 'Berlin', 3320),
+            ('United States', 'Mountain View', 15169),
+            (None, None, None),
+            ('Atlantis', 'Old', 3320),
+        ])
+        self.assertIn('scanned 5 rows, updated 4', output)
+
+    def test_all_refreshes_stale_rows_and_keeps_asn(self):
+        RequestLog.objects.filter(pk=self.ids[0]).update(autonomous_system=AutonomousSystem.objects.create(number=64500))
+        self._backfill('--all')
+        self.assertEqual(self._locations()[0], ('United States', 'Mountain View', 64500))
+        self.assertEqual(self._locations()[4], ('Germany', 'Berlin', None))
+
+    def test_stale_refreshes_rows_logged_before_the_build(self):
+        RequestLog.objects.filter(pk=self.ids[4]).update(timestamp=timezone.now() - timedelta(days=2))
+        RequestLog.objects.filter(pk=self.ids[0]).update(geo=GeoLocation.objects.create(country='Atlantis'))
+        output = self._backfill('--stale')
+        self.assertIn('Refreshing rows logged before', output)
+        locations = self._locations()
+        self.assertEqual(locations[0][0], 'Atlantis')
+        self.assertEqual(locations[4][:2], ('Germany', 'Berlin'))
+        self.assertIn('scanned 4 rows, updated 3', output)
+
+    def test_before_refreshes_older_rows(self):
+        RequestLog.objects.filter(pk=self.ids[4]).update(timestamp=datetime(2024, 1, 1, tzinfo=dt_timezone.utc))
+        self._backfill('--before', '2024-01-02')
+        self.assertEqual(self._locations()[4][:2], ('Germany', 'Berlin'))
+        RequestLog.objects.filter(pk=self.ids[4]).update(geo=GeoLocation.objects.create(country='Atlantis'))
+        self._backfill('--before', '2023-12-31')
+        self.assertEqual(self._locations()[4][0], 'Atlantis')
+        with self.assertRaises(CommandError):
+            self._backfill('--before', 'last week')
+
+    def test_renamed_autonomous_systems_are_updated(self):
+        AutonomousSystem.objects.create(number=3320, organization='Deutsche Bundespost')
+        AutonomousSystem.objects.create(number=15169, organization='GOOGLE')
+        output = self._backfill('--asn-db', self.asn_path)
+        self.assertEqual(AutonomousSystem.objects.get(number=3320).organization, 'Deutsche Telekom AG')
+        self.assertIn('Renamed 1 autonomous systems', output)
+
+    def test_resumes_after_recorded_id(self):
+        state_file = os.path.join(self.tmpdir, 'state.json')
+        with open(state_file, 'w') as f:
+            json.dump({'last_id': self.ids[1]}, f)
+        output = self._backfill('--state-file', state_file)
+        self.assertIn(f'Resuming after id {self.ids[1]}', output)
+        self.assertEqual([country for country, _, _ in self._locations()],
+                         [None, None, 'United States', None, 'Atlantis'])
+        with open(state_file) as f:
+            self.assertEqual(json.load(f)['last_id'], self.ids[-1])
+
+    def test_missing_database_is_an_error(self):
+        with self.assertRaises(CommandError):
+            call_command('geolocate_backfill', '--city-db', os.path.join(self.tmpdir, 'none.mmdb'))
+
+
+class GeoCacheWarmingTestCase(TestCase):
+    """
+    Preloading the geolocation cache with the busiest recent clients.
+    """
+
+    def setUp(self):
+        cache.clear()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        city_path = os.path.join(tmpdir.name, 'GeoLite2-City.mmdb')
+        write_benchmark_city_db(city_path)
+        self.city_reader = geoip2.database.Reader(city_path)
+        self.addCleanup(self.city_reader.close)
+        patcher = patch('tracking_ip.middleware._geoip_reader', self.city_reader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        RequestLog.objects.bulk_create([
+            RequestLog(ip_address='11.0.0.1', path='/', sample_weight=50),
+            RequestLog(ip_address='2001:db8:1:2::5', client_network='2001:db8:1:2::', path='/', sample_weight=20),
+            RequestLog(ip_address='2001:db8:1:2::6', client_network='2001:db8:1:2::', path='/', sample_weight=20),
+            RequestLog(ip_address='12.1.0.1', path='/', sample_weight=10),
+        ])
+
+    def tearDown(self):
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def test_busiest_networks_first(self):
+        self.assertEqual(recent_clients(limit=2, hours=1), [
+            ('11.0.0.1', '11.0.0.1'), ('2001:db8:1:2::/64', '2001:db8:1:2::'),
+        ])
+
+    def test_command_loads_entries_the_middleware_reads(self):
+        out = StringIO()
+        call_command('warm_geo_cache', '--limit', '2', stdout=out)
+        self.assertIn('Loaded 2 of 2 client networks', out.getvalue())
+        self.assertEqual(cache.get('geolocation:11.0.0.1'), {'country': 'United States', 'city': 'Mountain View'})
+        # Not in the database, but cached, so the network skips the lookup too.
+        self.assertEqual(cache.get('geolocation:2001:db8:1:2::/64'), {'country': None, 'city': None})
+        self.assertIsNone(cache.get('geolocation:12.1.0.1'))
+        reader = MagicMock()
+        with patch('tracking_ip.middleware._geoip_reader', reader):
+            BasicIPLoggingMiddleware(lambda request: HttpResponse())(
+                RequestFactory().get('/', REMOTE_ADDR='11.0.0.1'))
+        reader.city.assert_not_called()
+
+    def test_writes_are_paced(self):
+        clients = recent_clients(limit=3, hours=1)
+        with patch('tracking_ip.warming.time.sleep') as sleep:
+            self.assertEqual(warm_geo_cache(clients, batch_size=1, rate=1), 3)
+        self.assertEqual(sleep.call_count, 3)
+        self.assertGreater(sleep.call_args_list[-1].args[0], 2)
+
+    def test_only_a_cold_cache_is_warmed(self):
+        out = StringIO()
+        call_command('warm_geo_cache', '--if-cold', stdout=out)
+        self.assertIn('Loaded 3', out.getvalue())
+        self.assertIsNotNone(cache.get(WARM_SENTINEL_KEY))
+        call_command('warm_geo_cache', '--if-cold', stdout=out)
+        self.assertIn('cache is warm', out.getvalue())
+
+        cache.delete('geolocation:11.0.0.1')
+        warm_geo_cache_if_cold()
+        self.assertIsNone(cache.get('geolocation:11.0.0.1'))
+        cache.clear()
+        warm_geo_cache_if_cold()
+        self.assertIsNotNone(cache.get('geolocation:11.0.0.1'))
+
+
+class SegmentSinkTestCase(TestCase):
+    """
+    Local segment-file log sink and the load_segments loader.
+    """
+
+    def setUp(self):
+        cache.clear()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def tearDown(self):
+        AutonomousSystem.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def _writer(self, **kwargs):
+        writer = SegmentWriter(self.directory, fsync_interval=60, node='edge1', **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def _load(self, *args):
+        out = StringIO()
+        call_command('load_segments', '--directory', self.directory, *args, stdout=out)
+        return out.getvalue()
+
+    def test_records_round_trip(self):
+        record = encode_record('2001:db8::1', '/api/x', 1700000000.25, network='2001:db8::',
+                               country='Germany', asn=3320, sample_weight=4,
+                               method=HttpMethod.POST, status=201, duration_us=1500, response_bytes=0)
+        [(end, decoded)] = list(read_records(record))
+        self.assertEqual(end, len(record))
+        self.assertEqual(decoded, {
+            'ip_address': '2001:db8::1', 'client_network': '2001:db8::',
+            'timestamp': datetime(2023, 11, 14, 22, 13, 20, 250000, tzinfo=dt_timezone.utc),
+            'sample_weight': 4, 'asn': 3320, 'path': '/api/x',
+            'country': 'Germany', 'city': None, 'as_organization': None,
+            'method': HttpMethod.POST, 'status': 201, 'duration_us': 1500, 'response_bytes': 0,
+        })
+        # Unknown response details stay unknown rather than becoming zero.
+        [(_, decoded)] = list(read_records(encode_record('192.0.2.1', '/', 1700000000)))
+        self.assertEqual([decoded[field] for field in ('method', 'status', 'duration_us', 'response_bytes')],
+                         [None, None, None, None])
+        # A torn tail (crash before the next fsync) is ignored.
+        self.assertEqual(len(list(read_records(record * 2 + record[:-3]))), 2)
+
+    def test_middleware_appends_instead_of_inserting(self):
+        with override_settings(IP_TRACKING_LOG_SINK='segments',
+                               IP_TRACKING_SEGMENTS={'DIRECTORY': self.directory, 'FSYNC_INTERVAL': 60}):
+            middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        self.addCleanup(middleware.segments.close)
+        with patch('tracking_ip.middleware._geoip_reader', None):
+            middleware(RequestFactory().get('/admin/', REMOTE_ADDR='192.0.2.7'))
+        self.assertFalse(RequestLog.objects.exists())
+        middleware.segments.close()
+        self.assertIn('Loaded 1 records', self._load())
+        log = RequestLog.objects.get()
+        self.assertEqual((log.ip_address, log.client_network, log.path, log.category),
+                         ('192.0.2.7', '192.0.2.7', '/admin/', 1))
+        self.assertEqual((log.method, log.status), (HttpMethod.GET, 200))
+        self.assertIsNotNone(log.duration_us)
+
+    def test_database_outage_fails_open_and_keeps_logging(self):
+        BlockedIP.objects.create(ip_address='192.0.2.66')
+        with override_settings(IP_TRACKING_LOG_SINK='segments',
+                               IP_TRACKING_SEGMENTS={'DIRECTORY': self.directory, 'FSYNC_INTERVAL': 60}):
+            middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        self.addCleanup(middleware.segments.close)
+        database = connections[router.db_for_read(BlockedIP)]
+        with patch('tracking_ip.middleware._geoip_reader', None), \
+             patch.object(database, 'cursor', side_effect=OperationalError('unable to open database file')):
+            response = middleware(RequestFactory().get('/api/items/', REMOTE_ADDR='192.0.2.66'))
+        self.assertEqual(response.status_code, 200)
+        middleware.segments.close()
+        [name] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            [(_, record)] = list(read_records(f.read()))
+        self.assertEqual((record['ip_address'], record['path'], record['status']),
+                         ('192.0.2.66', '/api/items/', 200))
+
+    def test_database_outage_is_an_error_without_segments(self):
+        middleware = BasicIPLoggingMiddleware(lambda request: HttpResponse())
+        database = connections[router.db_for_read(BlockedIP)]
+        with patch.object(database, 'cursor', side_effect=OperationalError('unable to open database file')):
+            with self.assertRaises(OperationalError):
+                middleware(RequestFactory().get('/api/items/', REMOTE_ADDR='192.0.2.66'))
+
+    def test_loading_is_idempotent_and_resumable(self):
+        writer = self._writer()
+        when = time.time() - 3600
+        for index in range(5):
+            writer.append(f'198.51.100.{index}', f'/p/{index % 2}', when, country='Japan', city='Tokyo')
+        writer.close()
+        [name] = os.listdir(self.directory)
+        self.assertTrue(name.startswith('edge1-') and name.endswith('.seg'))
+        # A previous run loaded the first two records, then stopped.
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            ends = [end for end, _ in read_records(f.read())]
+        LogSegment.objects.create(name=name[:-len('.seg')], offset=ends[1], records=2)
+
+        self._load('--batch-size', '2')
+        self._load('--delete')
+        self.assertEqual(sorted(RequestLog.objects.values_list('ip_address', flat=True)),
+                         ['198.51.100.2', '198.51.100.3', '198.51.100.4'])
+        segment = LogSegment.objects.get()
+        self.assertEqual((segment.offset, segment.records, segment.completed), (ends[-1], 5, True))
+        self.assertEqual(os.listdir(self.directory), [])
+        log = RequestLog.objects.first()
+        self.assertEqual((log.country, log.city), ('Japan', 'Tokyo'))
+        self.assertAlmostEqual(log.timestamp.timestamp(), when, places=3)
+
+    def test_open_segments_rotate(self):
+        writer = self._writer(segment_bytes=50)
+        writer.append('192.0.2.1', '/')
+        writer.flush()
+        writer.append('192.0.2.2', '/')
+        writer.flush()
+        # Each flush filled a segment past SEGMENT_BYTES, so both were closed.
+        self.assertEqual(sorted(name.endswith('.seg') for name in os.listdir(self.directory)), [True, True])
+        # A second writer in the process never reuses a name.
+        other = self._writer(segment_bytes=50)
+        for _ in range(3):
+            other.append('192.0.2.3', '/')
+            other.flush()
+        self.assertEqual(len(os.listdir(self.directory)), 5)
+        self.assertIn('Loaded 5 records', self._load())
+
+    def _open_segment(self, node, pid, ip):
+        path = os.path.join(self.directory, f'{node}-{pid}-1700000000000-000001.seg.open')
+        with open(path, 'wb') as f:
+            f.write(encode_record(ip, '/', 1700000000))
+        return path
+
+    def test_orphaned_open_segments_are_completed(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        host = socket.gethostname()
+        self._open_segment(host, process.pid, '192.0.2.1')
+        live = self._open_segment(host, os.getpid(), '192.0.2.2')
+        remote = self._open_segment('edge2', 123, '192.0.2.3')
+        stale = time.time() - 120
+        for path in (live, remote):
+            os.utime(path, (stale, stale))
+        # Only the segment of the exited local writer is an orphan; the
+        # other node's is not stale yet.
+        output = self._load('--stale-after', '600')
+        self.assertIn('its writer is gone', output)
+        self.assertIn('Loaded 1 records', output)
+        self.assertTrue(os.path.exists(live) and os.path.exists(remote))
+        self.assertIn('Loaded 1 records', self._load('--stale-after', '60', '--delete'))
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(live)])
+        self.assertEqual(sorted(RequestLog.objects.values_list('ip_address', flat=True)),
+                         ['192.0.2.1', '192.0.2.3'])
+        self.assertFalse(LogSegment.objects.filter(completed=False).exists())
+
+    def test_long_non_ascii_strings_are_cut_on_a_character_boundary(self):
+        # 65,535 bytes end in the middle of a character in both strings.
+        path = '/p' + '\u00e9' * 40000
+        city = 'x' + '\u6771' * 30000
+        [(_, decoded)] = list(read_records(encode_record('192.0.2.1', path, 1700000000, city=city)))
+        self.assertEqual(decoded['path'], path[:2 + 32766])
+        self.assertEqual(decoded['city'], city[:1 + 21844])
+
+    def test_append_costs_microseconds(self):
+        writer = self._writer()
+        start = time.perf_counter()
+        for index in range(2000):
+            writer.append('203.0.113.9', '/api/items/', country='Germany', city='Berlin')
+        mean_us = (time.perf_counter() - start) / 2000 * 1e6
+        self.assertLess(mean_us, 100)
+
+
+class RequestLogAPITestCase(TestCase):
+    """
+    /api/logs/: filtered, keyset-paginated, streamed log history.
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.staff = User.objects.create_user('investigator', password='x', is_staff=True)
+        self.base = base = timezone.now() - timedelta(minutes=30)
+        logs = []
+        for index in range(25):
+            logs.append(RequestLog(
+                ip_address=f'192.0.2.{index % 5}', path=f'/p/{index % 3}/',
+                # Pairs of rows share a timestamp, so the id breaks ties.
+                timestamp=base + timedelta(seconds=index // 2),
+                country='Germany' if index % 2 else 'Japan',
+            ))
+        logs.append(RequestLog(ip_address='2001:db8:1:2::9', client_network='2001:db8:1:2::',
+                               path='/admin/', timestamp=base))
+        RequestLog.objects.bulk_create(logs)
+
+    def tearDown(self):
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def _get(self, user=None, **params):
+        request = self.factory.get('/api/logs/', params)
+        request.user = user or self.staff
+        response = request_logs(request)
+        if response.status_code != 200:
+            return response.status_code, json.loads(response.content)
+        return 200, json.loads(b''.join(response.streaming_content))
+
+    def test_staff_only(self):
+        self.assertEqual(self._get(user=AnonymousUser())[0], 403)
+
+    def test_pages_cover_every_row_once(self):
+        expected = list(RequestLog.objects.order_by('-timestamp', '-pk').values_list('pk', flat=True))
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 4, **({'cursor': cursor} if cursor else {})}
+            status, data = self._get(**params)
+            seen += [row['id'] for row in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+    def test_deep_pages_cost_one_indexed_query(self):
+        _, data = self._get(limit=20)
+        with CaptureQueriesContext(connection) as context:
+            self._get(limit=2, cursor=data['next'])
+        [query] = context.captured_queries
+        self.assertNotIn('OFFSET', query['sql'].upper())
+
+    def test_filters(self):
+        def ids(**params):
+            return {row['ip_address'] for row in self._get(limit=100, **params)[1]['results']}
+
+        self.assertEqual(ids(ip='192.0.2.3'), {'192.0.2.3'})
+        self.assertEqual(ids(network='192.0.2.0/31'), {'192.0.2.0', '192.0.2.1'})
+        self.assertEqual(ids(network='2001:db8:1:2::/64'), {'2001:db8:1:2::9'})
+        self.assertEqual(ids(path='/adm'), {'2001:db8:1:2::9'})
+        _, data = self._get(country='germany', path='/p/1/', limit=100)
+        self.assertEqual(len(data['results']), 4)
+        self.assertEqual({(row['country'], row['path'], row['category']) for row in data['results']},
+                         {('Germany', '/p/1/', 'uncategorized')})
+        since = (self.base + timedelta(seconds=10)).isoformat()
+        self.assertEqual(len(self._get(since=since, limit=100)[1]['results']), 5)
+
+    def test_invalid_parameters(self):
+        for params in ({'cursor': 'nope'}, {'ip': 'x'}, {'network': '1.2.3.4/99'},
+                       {'since': 'yesterday'}, {'limit': 0}):
+            self.assertEqual(self._get(**params)[0], 400, params)
+
+
+class ResponseDetailsTestCase(TestCase):
+    """
+    Response status, method, latency and size in request logs, and the
+    latency percentiles rolled up from them.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+    def tearDown(self):
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def _request(self, view, request):
+        with patch('tracking_ip.middleware._geoip_reader', None):
+            return BasicIPLoggingMiddleware(view)(request)
+
+    def test_response_details_are_logged(self):
+        self._request(lambda request: HttpResponse('hello', status=201),
+                      self.factory.post('/api/x', REMOTE_ADDR='192.0.2.1'))
+        log = RequestLog.objects.get()
+        self.assertEqual((log.method, log.status, log.response_bytes), (HttpMethod.POST, 201, 5))
+        self.assertGreaterEqual(log.duration_us, 0)
+
+    def test_rejected_and_failed_responses_are_logged(self):
+        for status in (403, 429, 500):
+            self._request(lambda request: HttpResponse(status=status),
+                          self.factory.get('/api/x', REMOTE_ADDR='192.0.2.1'))
+        self.assertEqual(sorted(RequestLog.objects.values_list('status', flat=True)), [403, 429, 500])
+
+    def test_slow_view_duration(self):
+        def slow(request):
+            time.sleep(0.02)
+            return HttpResponse()
+
+        self._request(slow, self.factory.get('/', REMOTE_ADDR='192.0.2.1'))
+        self.assertGreaterEqual(RequestLog.objects.get().duration_us, 20000)
+
+    def test_streaming_size_and_unknown_method(self):
+        self._request(lambda request: StreamingHttpResponse(iter([b'a', b'b'])),
+                      self.factory.generic('PROPFIND', '/', REMOTE_ADDR='192.0.2.1'))
+        log = RequestLog.objects.get()
+        self.assertEqual((log.method, log.response_bytes), (HttpMethod.OTHER, None))
+
+    def _logs(self, path, durations, hour=None):
+        RequestLog.objects.bulk_create([
+            RequestLog(ip_address='192.0.2.1', path=path, duration_us=duration, status=200,
+                       timestamp=(hour or self.hour) + timedelta(minutes=index % 60))
+            for index, duration in enumerate(durations)
+        ])
+
+    def test_database_buckets_match_python(self):
+        durations = [0, 1, 2, 999, 1000, 1001, 54321, 2 ** 31 - 1]
+        self._logs('/b', durations)
+        rollup_hour(self.hour)
+        expected = {}
+        for duration in durations:
+            expected[bucket_of(duration)] = expected.get(bucket_of(duration), 0) + 1
+        self.assertEqual(dict(LatencyRollup.objects.values_list('bucket', 'requests')), expected)
+
+    def test_percentiles_from_rollups(self):
+        # 1..1000 ms, spread over two hours; rolling up twice is harmless.
+        durations = [ms * 1000 for ms in range(1, 1001)]
+        self._logs('/slow', durations[:500])
+        self._logs('/slow', durations[500:], self.hour + timedelta(hours=1))
+        self._logs('/fast', [100] * 10)
+        for hour in (self.hour, self.hour, self.hour + timedelta(hours=1)):
+            rollup_hour(hour)
+        results = {item['path']: item for item in latency_by_path(self.hour)}
+        slow = results['/slow']
+        self.assertEqual(slow['requests'], 1000)
+        for key, exact in (('p50_us', 500000), ('p95_us', 950000), ('p99_us', 990000)):
+            self.assertLess(abs(slow[key] - exact) / exact, 0.13, key)
+        self.assertEqual(results['/fast']['p99_us'], bucket_value(bucket_of(100)))
+        self.assertEqual(list(latency_by_path(self.hour, path_prefix='/f')), [results['/fast']])
+
+    def _get_latency(self, params=None, user=None):
+        request = self.factory.get('/api/stats/latency/', params)
+        request.user = user or User(username='investigator', is_staff=True)
+        return latency_stats(request)
+
+    def test_rollup_task_and_latency_stats(self):
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self._logs('/recent', [5000] * 3, hour)
+        rollup_latency()
+        data = json.loads(self._get_latency({'hours': 2}).content)
+        [item] = data['paths']
+        self.assertEqual((item['path'], item['requests']), ('/recent', 3))
+        self.assertLess(abs(item['p95_ms'] - 5) / 5, 0.13)
+        self.assertEqual(self._get_latency({'hours': 0}).status_code, 400)
+
+    def test_latency_stats_staff_only(self):
+        response = self._get_latency(user=AnonymousUser())
+        self.assertEqual(response.status_code, 403)
+
+    def test_status_breakdown(self):
+        self._logs('/s', [1000, 1000])
+        RequestLog.objects.filter(pk=RequestLog.objects.first().pk).update(status=429)
+        data = json.loads(geolocation_stats(self.factory.get('/api/stats/')).content)
+        self.assertEqual(sorted((item['status'], item['count']) for item in data['statuses']),
+                         [(200, 1), (429, 1)])
+
+
+class ReplayTrafficTestCase(TransactionTestCase):
+    """
+    Trace reading, seeded profiles and the replay_traffic command. Replay
+    workers are threads with their own connections, so this test case
+    does not wrap tests in a transaction.
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def tearDown(self):
+        cache.clear()
+        AutonomousSystem.objects.clear_cache()
+        GeoLocation.objects.clear_cache()
+        RequestPath.objects.clear_cache()
+
+    def test_read_trace(self):
+        lines = [
+            '{"timestamp": "2023-11-14T22:13:21", "ip": "192.0.2.2", "path": "/login/", "method": "post"}',
+            '',
+            '{"timestamp": 1700000000, "ip": "2001:DB8::1", "path": "/", "actor": "bot"}',
+        ]
+        self.assertEqual(read_trace(lines), [
+            TraceEvent(0.0, '2001:db8::1', '/', 'GET', 'bot'),
+            TraceEvent(1.0, '192.0.2.2', '/login/', 'POST', 'recorded'),
+        ])
+        for line in ('{"ip": "192.0.2.1", "path": "/"}', '{"timestamp": 1, "ip": "x", "path": "/"}',
+                     '{"timestamp": 1, "ip": "192.0.2.1", "path": "a"}', 'nope'):
+            with self.assertRaises(ValueError, msg=line):
+                read_trace([line])
+
+    def test_profiles_are_seeded(self):
+        events = generate_profile('mix', duration=20, rate=10, seed=3)
+        self.assertEqual(events, generate_profile('mix', duration=20, rate=10, seed=3))
+        self.assertNotEqual(events, generate_profile('mix', duration=20, rate=10, seed=4))
+        self.assertEqual({event.actor for event in events},
+                         {'normal', 'flood', 'credential_stuffing', 'crawler'})
+        self.assertGreaterEqual(min(event.offset for event in events if event.actor != 'normal'), 5)
+        self.assertEqual([event.offset for event in events], sorted(event.offset for event in events))
+        # Saved traces replay the same requests.
+        trace = StringIO()
+        write_trace(events, trace, start=1700000000)
+        replayed = read_trace(trace.getvalue().splitlines())
+        self.assertEqual([event[1:] for event in replayed], [event[1:] for event in events])
+
+    def _replay(self, events, *args):
+        trace = os.path.join(self.directory, 'trace.ndjson')
+        with open(trace, 'w') as trace_file:
+            write_trace(events, trace_file)
+        output = os.path.join(self.directory, 'results.json')
+        call_command('replay_traffic', '--trace', trace, '--speed', '0', '--workers', '1',
+                     '--database', 'configured', '--geoip', 'none', '--output', output,
+                     *args, stdout=StringIO())
+        with open(output) as output_file:
+            return json.load(output_file)
+
+    def test_replay_through_the_stack(self):
+        BlockedIP.objects.create(ip_address='192.0.2.66')
+        events = [TraceEvent(index * 0.01, '198.51.100.7', '/login/', 'POST', 'stuffing') for index in range(8)]
+        events += [TraceEvent(0.2, '192.0.2.1', '/', 'GET', 'normal'),
+                   TraceEvent(0.3, '192.0.2.1', '/missing/', 'GET', 'normal'),
+                   TraceEvent(0.4, '192.0.2.66', '/', 'GET', 'blocked')]
+        results = self._replay(events, '--detect-every', '0')
+        self.assertEqual(results['requests'], 11)
+        # The login rate limit is 5/m, answered with 403s; CSRF checks pass.
+        self.assertEqual(results['statuses'], {'200': 6, '403': 4, '404': 1})
+        stuffing = results['actors']['stuffing']
+        self.assertEqual((stuffing['requests'], stuffing['rejected'], stuffing['networks']), (8, 3, 1))
+        self.assertIsNotNone(stuffing['rejected_after_s'])
+        self.assertIsNone(results['actors']['normal']['rejected_after_s'])
+        self.assertGreater(results['operations']['db_writes'], 0)
+        self.assertGreater(results['operations']['cache_calls'], 0)
+        # Every request was logged, rejected and blocked ones included.
+        self.assertEqual(RequestLog.objects.count(), 11)
+        self.assertEqual(RequestLog.objects.filter(status=403).count(), 4)
+
+    def test_reaction_monitor_flags_and_blocks(self):
+        RequestLog.objects.bulk_create(
+            RequestLog(ip_address=FLOOD_IP, path='/login/') for _ in range(6))
+        monitor = ReactionMonitor(60, block=True)
+        monitor.start(time.time())
+        monitor.check()
+        monitor.stop()
+        self.assertEqual((monitor.runs, monitor.errors), (1, 0))
+        self.assertEqual(list(monitor.flagged), [FLOOD_IP])
+        self.assertTrue(BlockedIP.objects.filter(ip_address=FLOOD_IP).exists())
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command('replay_traffic', '--workers', '0', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('replay_traffic', '--trace', os.path.join(self.directory, 'missing.ndjson'),
+                         stdout=StringIO())
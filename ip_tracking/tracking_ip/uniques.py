@@ -0,0 +1,201 @@
+"""
+Unique-visitor counts kept as HyperLogLog sketches in Redis.
+
+Every tracked request adds its client (PFADD) to three hourly sketches:
+all traffic, its country and its path prefix. Clients are counted by
+their network key, so an IPv6 client rotating addresses within its /64
+counts once. Hourly sketches are merged
+(PFMERGE) into day and ISO-week sketches by rollup_unique_visitors, and
+PFCOUNT over several sketches returns the size of their union, so any
+period can be answered from a handful of keys. Each sketch takes at most
+12 KB and has a standard error of 0.81%.
+"""
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('all', 'country', 'path')
+PERIODS = ('hour', 'day', 'week')
+UNKNOWN = 'unknown'
+
+HOUR_TTL = 2 * 24 * 3600
+DAY_TTL = 35 * 24 * 3600
+WEEK_TTL = 400 * 24 * 3600
+
+
+def path_prefix(path, depth=1):
+    """
+    The first `depth` segments of `path`: '/api/v1/items/' -> '/api/'.
+    """
+    segments = [segment for segment in path.split('/') if segment][:depth]
+    if not segments:
+        return '/'
+    return '/' + '/'.join(segments) + '/'
+
+
+def period_start(period, moment):
+    """
+    Start (UTC) of the hour, day or ISO week containing `moment`.
+    """
+    moment = moment.astimezone(dt_timezone.utc)
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = datetime.combine(moment.date(), time(), tzinfo=dt_timezone.utc)
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - timedelta(days=moment.weekday())
+    raise ValueError(f"Unknown period '{period}'")
+
+
+def bucket(period, start):
+    if period == 'hour':
+        return start.strftime('%Y%m%d%H')
+    if period == 'day':
+        return start.strftime('%Y%m%d')
+    year, week, _ = start.isocalendar()
+    return f'{year}W{week:02d}'
+
+
+class UniqueVisitorCounter:
+    """
+    Writes and queries the HyperLogLog sketches. `client` is a redis-py
+    client; writes for one request go out in a single pipeline.
+    """
+    standard_error = 0.0081
+
+    def __init__(self, client, path_depth=1, prefix='tracking:uv'):
+        self.client = client
+        self.path_depth = path_depth
+        self.prefix = prefix
+        # Values already indexed for the current hour, so the index sets
+        # and key expiries are written once per hour per process.
+        self._hour = None
+        self._seen = set()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Counter for IP_TRACKING_UNIQUE_VISITORS, or None if it is disabled
+        or the configured cache is not backed by Redis.
+        """
+        config = getattr(settings, 'IP_TRACKING_UNIQUE_VISITORS', None) or {}
+        if not config.get('ENABLED', False):
+            return None
+        alias = config.get('CACHE_ALIAS', 'default')
+        try:
+            from django_redis import get_redis_connection
+            client = get_redis_connection(alias)
+        except (ImportError, NotImplementedError) as e:
+            logger.info(f"Unique visitor counts disabled: cache '{alias}' is not a Redis cache ({e})")
+            return None
+        return cls(client, path_depth=config.get('PATH_DEPTH', 1))
+
+    def key(self, period, start, dimension, value=None):
+        key = f'{self.prefix}:{period[0]}:{bucket(period, start)}:{dimension}'
+        return key if value is None else f'{key}:{value}'
+
+    def values_for(self, client, path, country):
+        return {
+            'all': '*',
+            'country': country or UNKNOWN,
+            'path': path_prefix(path, self.path_depth),
+        }
+
+    # --- Writes ---
+
+    def add(self, client, path, country, when=None):
+        """
+        Count `client` (an IP or client network key) in this hour's sketches
+        for its country and path prefix.
+        """
+        hour = period_start('hour', when or timezone.now())
+        if hour != self._hour:
+            self._hour = hour
+            self._seen = set()
+        pipe = self.client.pipeline(transaction=False)
+        for dimension, value in self.values_for(client, path, country).items():
+            key = self.key('hour', hour, dimension, value)
+            pipe.pfadd(key, client)
+            if (dimension, value) not in self._seen:
+                self._seen.add((dimension, value))
+                index = self.key('hour', hour, dimension)
+                pipe.sadd(index, value)
+                pipe.expire(index, HOUR_TTL)
+                pipe.expire(key, HOUR_TTL)
+        pipe.execute()
+
+    def rollup(self, period, start):
+        """
+        Merge the sketches of the hours (period='day') or days ('week')
+        starting at `start` into that period's sketches. Idempotent.
+        """
+        if period == 'day':
+            parts = [('hour', start + timedelta(hours=i)) for i in range(24)]
+            ttl = DAY_TTL
+        elif period == 'week':
+            parts = [('day', start + timedelta(days=i)) for i in range(7)]
+            ttl = WEEK_TTL
+        else:
+            raise ValueError(f"Cannot roll up into '{period}'")
+        pipe = self.client.pipeline(transaction=False)
+        for dimension in DIMENSIONS:
+            index = self.key(period, start, dimension)
+            pipe.sunionstore(index, [self.key(part, part_start, dimension) for part, part_start in parts])
+            pipe.expire(index, ttl)
+        values = dict(zip(DIMENSIONS, pipe.execute()[::2]))
+        members = {dimension: self.client.smembers(self.key(period, start, dimension))
+                   for dimension in DIMENSIONS if values[dimension]}
+        pipe = self.client.pipeline(transaction=False)
+        for dimension, dimension_values in members.items():
+            for value in dimension_values:
+                value = value.decode() if isinstance(value, bytes) else value
+                key = self.key(period, start, dimension, value)
+                pipe.pfmerge(key, *[self.key(part, part_start, dimension, value)
+                                    for part, part_start in parts])
+                pipe.expire(key, ttl)
+        pipe.execute()
+
+    # --- Queries ---
+
+    def _sources(self, period, start, now):
+        """
+        (period, start) pairs whose union covers `period` from `start`.
+        Completed periods are read from their rollup; the latest hours and
+        days, which may not be rolled up yet, are added individually.
+        """
+        sources = [(period, start)]
+        if period == 'hour':
+            return sources
+        end = start + (timedelta(days=1) if period == 'day' else timedelta(days=7))
+        if now >= end + timedelta(hours=2):
+            return sources
+        if period == 'week':
+            day = period_start('day', start)
+            while day <= min(now, end - timedelta(days=1)):
+                sources.append(('day', day))
+                day += timedelta(days=1)
+        hour = max(start, period_start('hour', now) - timedelta(hours=2))
+        while hour < end and hour <= now:
+            sources.append(('hour', hour))
+            hour += timedelta(hours=1)
+        return sources
+
+    def count(self, period, start, dimension='all', value='*', now=None):
+        sources = self._sources(period, start, now or timezone.now())
+        return self.client.pfcount(*[self.key(p, s, dimension, value) for p, s in sources])
+
+    def breakdown(self, period, start, dimension, now=None):
+        """
+        {value: unique IPs} for every value of `dimension` seen in the period.
+        """
+        sources = self._sources(period, start, now or timezone.now())
+        values = self.client.sunion([self.key(p, s, dimension) for p, s in sources])
+        pipe = self.client.pipeline(transaction=False)
+        values = sorted(value.decode() if isinstance(value, bytes) else value for value in values)
+        for value in values:
+            pipe.pfcount(*[self.key(p, s, dimension, value) for p, s in sources])
+        return dict(zip(values, pipe.execute()))
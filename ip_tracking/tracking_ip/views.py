@@ -1,18 +1,28 @@
 from django.shortcuts import render
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.db import models
-from .models import RequestLog
-from ipware import get_client_ip
+from .models import RequestLog, RequestPath, GeoLocation, AutonomousSystem, HttpMethod
+from .latency import RELATIVE_ERROR, latency_by_path
+from . import metrics
+from .routers import replica_reads
+from .heavy_hitters import DIMENSIONS as TOP_DIMENSIONS, HeavyHitterTracker
+from .uniques import DIMENSIONS, PERIODS, UniqueVisitorCounter, period_start
+from datetime import datetime, timedelta, timezone as dt_timezone
+from .categories import get_categorizer
+from .client import get_client, parse_address, prefix_length, ratelimit_key
+from .pagination import encode_cursor, keyset_queryset
 from django_ratelimit.decorators import ratelimit
+import ipaddress
 import json
+from django.utils import timezone
 
 def index(request):
     """Simple index view to test IP tracking."""
     return render(request, 'tracking_ip/index.html')
 
 
-@ratelimit(key='ip', rate='5/m', block=True, method=['GET', 'POST'])
+@ratelimit(key=ratelimit_key, rate='5/m', block=True, method=['GET', 'POST'])
 def login_view(request):
     """
     A dummy login view to apply rate limiting.
@@ -28,7 +38,7 @@ def home_view(request):
 
 def api_test(request):
     """API endpoint to test IP tracking."""
-    ip_address, _ = get_client_ip(request)
+    ip_address = get_client(request).ip
     
     # Get recent logs for this IP
     recent_logs = RequestLog.objects.filter(ip_address=ip_address).order_by('-timestamp')[:5]
@@ -50,22 +60,292 @@ def api_test(request):
     })
 
 
+# Aggregates over the whole log table; a minute of replication lag is invisible here.
+@replica_reads(max_lag=60)
 def geolocation_stats(request):
     """View to display geolocation statistics."""
-    total_requests = RequestLog.objects.count()
-    geolocated_requests = RequestLog.objects.exclude(
-        country__isnull=True, city__isnull=True
-    ).count()
+    # Counts are estimates: each row stands for `sample_weight` requests.
+    total_requests = RequestLog.objects.aggregate(
+        total=models.Sum('sample_weight')
+    )['total'] or 0
+    geolocated_requests = RequestLog.objects.filter(geo__isnull=False).aggregate(
+        total=models.Sum('sample_weight')
+    )['total'] or 0
     
-    country_stats = RequestLog.objects.exclude(
-        country__isnull=True
-    ).values('country').annotate(
-        count=models.Count('country')
-    ).order_by('-count')
+    # Group on the integer geo key, then fold cities into their countries;
+    # this avoids a GROUP BY over text columns on the large log table.
+    geo_counts = RequestLog.objects.filter(geo__isnull=False).values(
+        'geo_id'
+    ).annotate(
+        count=models.Sum('sample_weight')
+    ).order_by()
+    geo_counts = {item['geo_id']: item['count'] for item in geo_counts}
+    countries = {}
+    for geo in GeoLocation.objects.filter(pk__in=list(geo_counts), country__isnull=False):
+        countries[geo.country] = countries.get(geo.country, 0) + geo_counts[geo.pk]
+    country_stats = [
+        {'country': country, 'count': count}
+        for country, count in sorted(countries.items(), key=lambda item: -item[1])
+    ]
+
+    # ASNs are already integer keys; only the top ten are joined to their names.
+    asn_counts = list(RequestLog.objects.filter(autonomous_system__isnull=False).values(
+        'autonomous_system'
+    ).annotate(
+        count=models.Sum('sample_weight')
+    ).order_by('-count')[:10])
+    organizations = AutonomousSystem.objects.in_bulk(
+        [item['autonomous_system'] for item in asn_counts]
+    )
+    asn_stats = [
+        {
+            'asn': item['autonomous_system'],
+            'organization': organizations[item['autonomous_system']].organization,
+            'count': item['count'],
+        }
+        for item in asn_counts
+    ]
+
+    # Per path category, grouped on the small integer column.
+    categorizer = get_categorizer()
+    category_stats = [
+        {'category': categorizer.name(item['category']), 'count': item['count']}
+        for item in RequestLog.objects.values('category').annotate(
+            count=models.Sum('sample_weight')
+        ).order_by('-count')
+    ]
     
+    # Served vs. rejected traffic, by response status.
+    status_stats = [
+        {'status': item['status'], 'count': item['count']}
+        for item in RequestLog.objects.filter(status__isnull=False).values('status').annotate(
+            count=models.Sum('sample_weight')
+        ).order_by('-count')
+    ]
+
     return JsonResponse({
         'total_requests': total_requests,
         'geolocated_requests': geolocated_requests,
         'coverage_percentage': round((geolocated_requests / total_requests * 100), 2) if total_requests > 0 else 0,
-        'top_countries': list(country_stats[:10])
+        'top_countries': list(country_stats[:10]),
+        'top_asns': asn_stats,
+        'categories': category_stats,
+        'statuses': status_stats,
+    })
+
+
+@replica_reads(max_lag=60)
+def latency_stats(request):
+    """
+    p50/p95/p99 response latency per path over the last `hours`, slowest
+    (by p95) first, read from the hourly LatencyRollup rows.
+    Staff only.
+    Query: ?hours=24&limit=20&path=/api/
+    """
+    if not (request.user.is_active and request.user.is_staff):
+        return JsonResponse({'error': 'Staff access required.'}, status=403)
+    try:
+        hours = int(request.GET.get('hours', 24))
+        limit = min(int(request.GET.get('limit', 20)), 100)
+    except ValueError:
+        return JsonResponse({'error': 'hours and limit must be integers.'}, status=400)
+    if not 0 < hours <= 24 * 31 or limit <= 0:
+        return JsonResponse({'error': 'hours must be between 1 and 744 and limit positive.'}, status=400)
+    since = timezone.now() - timedelta(hours=hours)
+    paths = sorted(latency_by_path(since, path_prefix=request.GET.get('path')),
+                   key=lambda item: -item['p95_us'])[:limit]
+    return JsonResponse({
+        'since': since.isoformat(),
+        'relative_error': round(RELATIVE_ERROR, 3),
+        'paths': [
+            {
+                'path': item['path'],
+                'requests': item['requests'],
+                'p50_ms': round(item['p50_us'] / 1000, 3),
+                'p95_ms': round(item['p95_us'] / 1000, 3),
+                'p99_ms': round(item['p99_us'] / 1000, 3),
+            }
+            for item in paths
+        ],
     })
+
+
+def unique_visitors(request):
+    """
+    Estimated unique visitor IPs for one hour, day or week, in total and
+    broken down by country or path prefix.
+    Staff only.
+    Query: ?period=hour|day|week&dimension=all|country|path&start=YYYY-MM-DD[THH]
+    """
+    if not (request.user.is_active and request.user.is_staff):
+        return JsonResponse({'error': 'Staff access required.'}, status=403)
+    counter = UniqueVisitorCounter.from_settings()
+    if counter is None:
+        return JsonResponse({'error': 'Unique visitor counts are not enabled.'}, status=503)
+    period = request.GET.get('period', 'day')
+    dimension = request.GET.get('dimension', 'all')
+    if period not in PERIODS or dimension not in DIMENSIONS:
+        return JsonResponse({'error': f'period must be one of {PERIODS}, dimension one of {DIMENSIONS}.'}, status=400)
+    start = request.GET.get('start')
+    if start:
+        try:
+            start = datetime.fromisoformat(start)
+        except ValueError:
+            return JsonResponse({'error': 'start must be an ISO date or datetime.'}, status=400)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=dt_timezone.utc)
+    start = period_start(period, start or timezone.now())
+
+    data = {
+        'period': period,
+        'start': start.isoformat(),
+        'unique_visitors': counter.count(period, start),
+        'standard_error': counter.standard_error,
+    }
+    if dimension != 'all':
+        breakdown = counter.breakdown(period, start, dimension)
+        data[dimension] = [
+            {dimension: value, 'unique_visitors': count}
+            for value, count in sorted(breakdown.items(), key=lambda item: -item[1])
+        ]
+    return JsonResponse(data)
+
+
+def top_talkers(request):
+    """
+    Heaviest client IPs, subnets and paths over the last `window` seconds,
+    from the Redis heavy-hitter sketches; never queries the database.
+    Staff only.
+    Query: ?dimension=ip|subnet|path (all by default)&limit=10&window=300
+    """
+    if not (request.user.is_active and request.user.is_staff):
+        return JsonResponse({'error': 'Staff access required.'}, status=403)
+    tracker = HeavyHitterTracker.from_settings()
+    if tracker is None:
+        return JsonResponse({'error': 'Heavy hitter tracking is not enabled.'}, status=503)
+    dimension = request.GET.get('dimension')
+    if dimension is not None and dimension not in TOP_DIMENSIONS:
+        return JsonResponse({'error': f'dimension must be one of {TOP_DIMENSIONS}.'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 100)
+        window = min(int(request.GET.get('window', tracker.window)), tracker.window)
+    except ValueError:
+        return JsonResponse({'error': 'limit and window must be integers.'}, status=400)
+    if limit <= 0 or window <= 0:
+        return JsonResponse({'error': 'limit and window must be positive.'}, status=400)
+
+    data = {'window': window}
+    for name in [dimension] if dimension else TOP_DIMENSIONS:
+        data[name] = [
+            {name: item, 'requests': count}
+            for item, count in tracker.top(name, k=limit, window=window)
+        ]
+    return JsonResponse(data)
+
+
+LOG_PAGE_SIZE = 100
+MAX_LOG_PAGE_SIZE = 1000
+LOG_FIELDS = ('id', 'timestamp', 'ip_address', 'client_network', 'method', 'path', 'category',
+              'status', 'duration_us', 'response_bytes', 'country', 'city', 'asn', 'sample_weight')
+
+
+def _parse_time(value, name):
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO date or datetime.')
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=dt_timezone.utc)
+    return moment
+
+
+def _filter_logs(queryset, params):
+    """
+    Apply the /api/logs/ filters; raise ValueError for invalid values.
+    Paths and countries are resolved against their small dictionary
+    tables first, as in the admin search.
+    """
+    if params.get('ip'):
+        address = parse_address(params['ip'])
+        if address is None:
+            raise ValueError(f"'{params['ip']}' is not a valid IP address.")
+        queryset = queryset.filter(ip_address=str(address))
+    if params.get('network'):
+        try:
+            network = ipaddress.ip_network(params['network'], strict=False)
+        except ValueError:
+            raise ValueError(f"'{params['network']}' is not a valid network.")
+        if network.prefixlen == prefix_length(network.version):
+            # One aggregation network, e.g. a /64: an indexed match on client_network.
+            queryset = queryset.filter(client_network=str(network.network_address))
+        else:
+            queryset = queryset.filter(ip_address__range=(
+                str(network.network_address), str(network.broadcast_address)))
+    if params.get('path'):
+        queryset = queryset.filter(
+            path_ref__in=RequestPath.objects.filter(path__startswith=params['path']))
+    if params.get('country'):
+        queryset = queryset.filter(
+            geo__in=GeoLocation.objects.filter(country__iexact=params['country']))
+    if params.get('since'):
+        queryset = queryset.filter(timestamp__gte=_parse_time(params['since'], 'since'))
+    if params.get('until'):
+        queryset = queryset.filter(timestamp__lt=_parse_time(params['until'], 'until'))
+    return queryset
+
+
+def _stream_logs(rows, limit):
+    """
+    Encode a page of log rows as JSON, one row at a time. The cursor of
+    the next page follows the results.
+    """
+    categorizer = get_categorizer()
+    next_cursor = last = None
+    yield '{"results": ['
+    for index, row in enumerate(rows.iterator(chunk_size=500)):
+        if index == limit:
+            # The extra row only shows that another page exists.
+            next_cursor = encode_cursor(*last)
+            break
+        last = (row['timestamp'], row['id'])
+        row['timestamp'] = row['timestamp'].isoformat()
+        row['category'] = categorizer.name(row['category'])
+        if row['method'] is not None:
+            row['method'] = HttpMethod(row['method']).label
+        yield (',' if index else '') + json.dumps(row)
+    yield f'], "next": {json.dumps(next_cursor)}}}'
+
+
+def request_logs(request):
+    """
+    Request log history for investigations, newest first, streamed as
+    JSON. Pages are linked by an opaque keyset cursor on (timestamp, id)
+    instead of an OFFSET, so page 10,000 costs the same as page 1.
+    Staff only.
+    Query: ?ip=&network=CIDR&path=/prefix&country=&since=&until=&limit=100&cursor=
+    """
+    if not (request.user.is_active and request.user.is_staff):
+        return JsonResponse({'error': 'Staff access required.'}, status=403)
+    try:
+        limit = int(request.GET.get('limit', LOG_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer.'}, status=400)
+    if not 0 < limit <= MAX_LOG_PAGE_SIZE:
+        return JsonResponse({'error': f'limit must be between 1 and {MAX_LOG_PAGE_SIZE}.'}, status=400)
+    try:
+        queryset = _filter_logs(RequestLog.objects.all(), request.GET)
+        queryset = keyset_queryset(queryset, 'timestamp', request.GET.get('cursor') or None)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    rows = queryset.values(*LOG_FIELDS)[:limit + 1]
+    return StreamingHttpResponse(_stream_logs(rows, limit), content_type='application/json')
+
+
+def metrics_view(request):
+    """
+    Expose tracking metrics in the Prometheus text format.
+    """
+    return HttpResponse(
+        metrics.REGISTRY.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
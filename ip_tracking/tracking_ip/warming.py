@@ -0,0 +1,113 @@
+"""
+Geolocation cache warming. After a Redis restart or a cache flush every
+client takes the middleware's cold path (mmdb lookup plus cache.set) at
+the same moment; warming preloads the entries of the busiest recent
+client networks instead, busiest first.
+
+Clients are resolved in batches and each batch is written with one
+set_many, which django-redis sends as a single pipeline. Writes are
+paced to a maximum rate, so warming does not compete with live traffic
+for Redis.
+
+A sentinel key marks the cache as warm. It disappears along with every
+other key when the cache is flushed or restarted empty, which is how
+warm_geo_cache_if_cold (run when Celery workers start, and by beat)
+notices that the cache needs reloading.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+from tracking_ip import middleware
+from tracking_ip.client import ClientContext, parse_address
+from tracking_ip.models import RequestLog
+from tracking_ip.routers import replica_reads
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+WARM_SENTINEL_KEY = 'tracking:geo_cache_warm'
+
+DEFAULT_WARMING = {
+    'LIMIT': 10000,
+    'HOURS': 24,
+    'BATCH_SIZE': 500,
+    'RATE': 5000,
+}
+
+
+def warming_config():
+    """
+    IP_TRACKING_GEO_CACHE_WARMING over the defaults.
+    """
+    return {**DEFAULT_WARMING, **(getattr(settings, 'IP_TRACKING_GEO_CACHE_WARMING', None) or {})}
+
+
+def recent_clients(limit, hours):
+    """
+    [(cache key, ip to look up)] for the `limit` client networks with the
+    most requests in the last `hours`, busiest first. Networks are looked
+    up by their network address, like the middleware's shared entry.
+    """
+    since = timezone.now() - timedelta(hours=hours)
+    # Ranking tolerates a few minutes of replication lag.
+    with replica_reads(max_lag=300):
+        rows = list(
+            RequestLog.objects.filter(timestamp__gte=since).with_network()
+            .values('network').annotate(hits=Sum('sample_weight'))
+            .order_by('-hits')[:limit]
+        )
+    clients = []
+    for row in rows:
+        address = parse_address(row['network'])
+        if address is not None:
+            clients.append((ClientContext(address).prefix, str(address)))
+    return clients
+
+
+def warm_geo_cache(clients, batch_size=500, rate=5000):
+    """
+    Look up `clients` ([(cache key, ip)]) and load their entries with one
+    set_many per batch, writing at most `rate` keys per second (0: no
+    limit). Returns the number of keys loaded.
+    """
+    city_reader, asn_reader = middleware._geoip_reader, middleware._asn_reader
+    if not city_reader and not asn_reader:
+        logger.warning("Skipping geolocation cache warming: GeoIP2 reader not initialized.")
+        return 0
+    loaded = 0
+    started = time.monotonic()
+    for start in range(0, len(clients), batch_size):
+        entries = {}
+        for key, ip in clients[start:start + batch_size]:
+            try:
+                entries[middleware.geo_cache_key(key)] = middleware.lookup_ip(ip, city_reader, asn_reader)
+            except Exception as e:
+                logger.error(f"Error during GeoIP2 lookup for {ip}: {e}")
+        cache.set_many(entries, middleware.GEO_CACHE_TIMEOUT)
+        loaded += len(entries)
+        if rate:
+            ahead = loaded / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    mark_warm()
+    return loaded
+
+
+def mark_warm():
+    cache.set(WARM_SENTINEL_KEY, timezone.now().isoformat(), None)
+
+
+def mark_cold():
+    cache.delete(WARM_SENTINEL_KEY)
+
+
+def claim_cold_cache():
+    """
+    True if the cache lost its sentinel (it was flushed or restarted
+    empty). The sentinel is set again atomically, so of several workers
+    noticing at once only one warms the cache.
+    """
+    return cache.add(WARM_SENTINEL_KEY, timezone.now().isoformat(), None)